@@ -1,11 +1,20 @@
 # src/ai_flows/chat_flow.py
 import asyncio
-from typing import AsyncGenerator
+from typing import Any, AsyncGenerator, Dict, List, Optional
 from ..ai_schemas.chat_schema import ChatInputSchema, ChatOutputSchema
-from ..ai_config import genai  # Sử dụng cấu hình từ ai_config.py
+from ..services.model_registry import get_model
+from ..services.llm_gateway import llm_gateway
+from ..services.rate_limiter import INTERACTIVE
 
 MODEL_NAME = "gemini-2.5-flash"
 
+GENERATION_CONFIG = {
+    "temperature": 0.7,
+    "max_output_tokens": 8192,
+    "response_mime_type": "application/json",
+    # "response_schema": ChatOutputSchema # Có thể bật nếu thư viện hỗ trợ
+}
+
 # --- SYSTEM INSTRUCTION ---
 # Đưa instruction vào đây để Flow tự quản lý
 SYSTEM_INSTRUCTION = """
@@ -66,25 +75,42 @@ Bạn phải trả về JSON khớp với schema sau:
 }
 """
 
-async def chat(input: ChatInputSchema) -> AsyncGenerator[str, None]:
+async def stream_chat(
+    history: List[Dict[str, Any]],
+    user_parts: List[Dict[str, Any]],
+    system_instruction: str = SYSTEM_INSTRUCTION,
+    generation_config: Optional[Dict[str, Any]] = None,
+    model: Any = None,
+) -> AsyncGenerator[str, None]:
     """
-    Hàm xử lý chat flow sử dụng Google Generative AI SDK trực tiếp.
+    Gửi một lượt chat và stream từng đoạn text thô của model.
+    Dùng chung cho flow này và endpoint SSE /api/chat/stream.
+    Truyền `model` để dùng model có sẵn (vd: model từ context cache).
     """
-    # 1. Cấu hình Model
-    generation_config = {
-        "temperature": 0.7,
-        "max_output_tokens": 8192,
-        "response_mime_type": "application/json",
-        # "response_schema": ChatOutputSchema # Có thể bật nếu thư viện hỗ trợ
-    }
+    if model is None:
+        # Model dùng chung từ registry thay vì dựng mới mỗi lượt chat
+        model = get_model(MODEL_NAME, generation_config or GENERATION_CONFIG, system_instruction)
 
-    model = genai.GenerativeModel(
-        model_name=MODEL_NAME,
-        generation_config=generation_config,
-        system_instruction=SYSTEM_INSTRUCTION
+    chat_session = model.start_chat(history=history)
+
+    # send_message_async trả về một awaitable response, response này có thể iter khi stream=True
+    # Qua gateway (ưu tiên cao nhất): deadline + 429 ở lượt mở stream được thử lại tự động
+    response = await llm_gateway.call(
+        lambda: chat_session.send_message_async(user_parts, stream=True),
+        endpoint="chat-stream",
+        priority=INTERACTIVE,
     )
 
-    # 2. Chuyển đổi lịch sử chat sang định dạng Gemini
+    async for chunk in response:
+        if chunk.text:
+            yield chunk.text
+
+
+async def chat(input: ChatInputSchema) -> AsyncGenerator[str, None]:
+    """
+    Hàm xử lý chat flow sử dụng Google Generative AI SDK trực tiếp.
+    """
+    # 1. Chuyển đổi lịch sử chat sang định dạng Gemini
     gemini_history = []
     if input.history:
         for turn in input.history:
@@ -95,10 +121,7 @@ async def chat(input: ChatInputSchema) -> AsyncGenerator[str, None]:
                 "parts": [{"text": turn.content}]
             })
 
-    # 3. Khởi tạo phiên chat
-    chat_session = model.start_chat(history=gemini_history)
-
-    # 4. Chuẩn bị tin nhắn hiện tại
+    # 2. Chuẩn bị tin nhắn hiện tại
     user_parts = [{"text": input.message}]
     
     # Xử lý media nếu có (Cơ bản)
@@ -108,10 +131,6 @@ async def chat(input: ChatInputSchema) -> AsyncGenerator[str, None]:
         for media in input.media:
              user_parts.append({"text": f"[User sent media: {media.url}]"})
 
-    # 5. Gửi tin nhắn và stream kết quả
-    # send_message_async trả về một awaitable response, response này có thể iter khi stream=True
-    response = await chat_session.send_message_async(user_parts, stream=True)
-
-    async for chunk in response:
-        if chunk.text:
-            yield chunk.text
\ No newline at end of file
+    # 3. Gửi tin nhắn và stream kết quả
+    async for text in stream_chat(gemini_history, user_parts):
+        yield text
@@ -1,6 +1,7 @@
 # src/ai_flows/generate_exercises_flow.py
 import genkit.ai as ai
 from genkit import flow
+from ..services.llm_gateway import llm_gateway
 from pydantic import BaseModel, Field
 
 MODEL = "gemini-2.5-flash"
@@ -23,5 +24,5 @@ Chủ đề: {input.topic}"""
 
 @flow
 async def generate_exercises(input: GenerateExercisesInput) -> GenerateExercisesOutput:
-    response = await generate_exercises_prompt.generate(input=input)
+    response = await llm_gateway.call(lambda: generate_exercises_prompt.generate(input=input), endpoint="genkit-generate-exercises")
     return response.output
\ No newline at end of file
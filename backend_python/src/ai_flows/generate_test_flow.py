@@ -1,6 +1,7 @@
 # src/ai_flows/generate_test_flow.py
 import genkit.ai as ai
 from genkit import flow
+from ..services.llm_gateway import llm_gateway
 from pydantic import BaseModel, Field
 from ..ai_schemas.test_schema import TestSchema
 from typing import Literal # 👈 Thêm Literal
@@ -80,5 +81,5 @@ def generate_test_prompt(input: GenerateTestInput) -> ai.Prompt[GenerateTestZOut
 
 @flow
 async def generate_test(input: GenerateTestInput) -> GenerateTestOutput:
-    response = await generate_test_prompt.generate(input=input)
+    response = await llm_gateway.call(lambda: generate_test_prompt.generate(input=input), endpoint="genkit-generate-test")
     return response.output
\ No newline at end of file
@@ -1,6 +1,7 @@
 # src/ai_flows/geogebra_flow.py
 import genkit.ai as ai
 from genkit import flow
+from ..services.llm_gateway import llm_gateway
 from ..ai_schemas.geogebra_schema import GeogebraInputSchema, GeogebraOutputSchema
 
 MODEL = "gemini-2.5-flash"
@@ -32,5 +33,5 @@ def geogebra_prompt_v2(input_request: str) -> ai.Prompt[GeogebraOutputSchema]:
 @flow
 async def generate_geogebra_commands(input: GeogebraInputSchema) -> GeogebraOutputSchema:
     # Sử dụng v2 nếu bạn muốn prompt dài hoạt động như một chỉ dẫn hệ thống
-    response = await geogebra_prompt_v2.generate(input_request=input.request)
+    response = await llm_gateway.call(lambda: geogebra_prompt_v2.generate(input_request=input.request), endpoint="genkit-geogebra")
     return response.output
\ No newline at end of file
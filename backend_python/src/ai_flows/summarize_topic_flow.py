@@ -1,6 +1,7 @@
 # src/ai_flows/summarize_topic_flow.py
 import genkit.ai as ai
 from genkit import flow
+from ..services.llm_gateway import llm_gateway
 from pydantic import BaseModel, Field
 
 MODEL = "gemini-2.5-flash"
@@ -24,5 +25,5 @@ Chủ đề: {input.topic}
 
 @flow
 async def summarize_topic(input: SummarizeTopicInput) -> SummarizeTopicOutput:
-    response = await summarize_topic_prompt.generate(input=input)
+    response = await llm_gateway.call(lambda: summarize_topic_prompt.generate(input=input), endpoint="genkit-summarize-topic")
     return response.output
\ No newline at end of file
@@ -1,25 +1,46 @@
 # src/main.py
-import re
+import asyncio
 import uvicorn
 import json
 import os
 import hashlib 
 from pathlib import Path
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Response
+from fastapi.responses import StreamingResponse
 from src.routes.node_progress import router as node_progress_router
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel, Field
-from typing import List, Literal, Optional
-import PyPDF2
-from docx import Document
+from typing import List, Literal, Optional, Tuple
 from src.models import NodeProgress
 from src.supabase_client import supabase
 
-# Import config
-from src.ai_config import genai
-from src.ai_flows.chat_flow import chat as chat_flow
+from src.ai_flows.chat_flow import chat as chat_flow, stream_chat
 from src.ai_schemas.chat_schema import ChatInputSchema
-from src.services import rag_service
+from src.services import model_registry, rag_service
+from src.services.chat_session_store import ChatSession, session_store
+from src.services.context_cache import context_cache
+from src.services.embedding_cache import embedding_cache
+from src.services.ingestion_jobs import FINAL_STATUSES, ingestion_jobs
+from src.services.llm_gateway import llm_gateway
+from src.services.media_service import MediaError, media_service
+from src.services.request_prep import (
+    MEDIA_STEP_TIMEOUT_SECONDS,
+    RAG_STEP_TIMEOUT_SECONDS,
+    REFERENCE_STEP_TIMEOUT_SECONDS,
+    PrepStep,
+    request_prep,
+)
+from src.services.single_flight import canonical_key, single_flight
+from src.services.vector_index import vector_index
+from src.services.semantic_cache import SEMANTIC_CACHE_ENABLED, semantic_cache
+from src.services.prompt_assembler import PROMPT_TOKENS_HEADER, PromptPlan, count_tokens, prompt_assembler
+from src.services.rate_limiter import INTERACTIVE, rate_limiter
+from src.services.reference_corpus import reference_corpus
+from src.services.reference_index import reference_index
+from src.utils import pdf_extract
+from src.utils.body_limit import BodySizeLimitMiddleware
+from src.utils.json_extract import extract_json, parse_model_json
+from src.utils.json_stream import ChatStreamParser
 from src.routes import student_profile
 
 app = FastAPI(title="Math Tutor API")
@@ -31,79 +52,15 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Prompt-Tokens", "X-Semantic-Cache", "Retry-After"],
 )
+# Chặn body quá lớn (ảnh base64) trước khi parse JSON
+app.add_middleware(BodySizeLimitMiddleware)
 
 # Thêm router node progress
 app.include_router(node_progress_router)
 app.include_router(student_profile.router)
 
-# ===== DOCUMENT PROCESSING =====
-
-def extract_text_from_pdf(pdf_path: str) -> str:
-    """Extract text from a PDF file"""
-    try:
-        with open(pdf_path, 'rb') as file:
-            pdf_reader = PyPDF2.PdfReader(file)
-            text = ""
-            for page in pdf_reader.pages:
-                text += page.extract_text() + "\n"
-        return text
-    except Exception as e:
-        print(f"Error reading PDF {pdf_path}: {e}")
-        return ""
-
-def extract_text_from_word(docx_path: str) -> str:
-    """Extract text from a Word (.docx) file"""
-    try:
-        doc = Document(docx_path)
-        text = ""
-        for paragraph in doc.paragraphs:
-            text += paragraph.text + "\n"
-        return text
-    except Exception as e:
-        print(f"Error reading Word file {docx_path}: {e}")
-        return ""
-
-def extract_text_from_file(file_path: str) -> str:
-    """Extract text from PDF or Word file based on extension"""
-    file_path_obj = Path(file_path)
-    extension = file_path_obj.suffix.lower()
-    
-    if extension == '.pdf':
-        return extract_text_from_pdf(file_path)
-    elif extension in ['.docx', '.doc']:
-        return extract_text_from_word(file_path)
-    else:
-        print(f"Unsupported file format: {extension}")
-        return ""
-
-def load_reference_materials(folder_path: str, max_files: int = 5) -> str:
-    """Load and combine text from multiple PDF/Word files in a folder"""
-    folder = Path(folder_path)
-    if not folder.exists():
-        print(f"Warning: Folder {folder_path} does not exist")
-        return ""
-    
-    # Get both PDF and Word files
-    pdf_files = list(folder.glob("*.pdf"))
-    docx_files = list(folder.glob("*.docx"))
-    doc_files = list(folder.glob("*.doc"))
-    
-    all_files = (pdf_files + docx_files + doc_files)[:max_files]
-    
-    if not all_files:
-        print(f"Warning: No PDF or Word files found in {folder_path}")
-        return ""
-    
-    combined_text = ""
-    for file in all_files:
-        print(f"📄 Loading: {file.name}")
-        text = extract_text_from_file(str(file))
-        if text:
-            combined_text += f"\n\n=== TÀI LIỆU: {file.name} ===\n{text}\n"
-    
-    return combined_text
-
 # ===== PATHS CONFIGURATION =====
 
 # ===== PATHS CONFIGURATION =====
@@ -359,6 +316,70 @@ TEST_SYSTEM_INSTRUCTION = """Bạn là chuyên gia biên soạn đề thi THPT Q
 
 SUMMARIZE_SYSTEM_INSTRUCTION = """Bạn là một giảng viên toán học chuyên tóm tắt kiến thức một cách súc tích."""
 
+NODE_TEST_SYSTEM_INSTRUCTION = "Bạn là hệ thống sinh đề kiểm tra toán chuẩn THPT."
+
+# ===== MODEL CONFIGURATION =====
+
+MODEL_NAME = "gemini-2.5-flash"
+
+CHAT_GENERATION_CONFIG = {
+    "temperature": 0.7,
+    "top_p": 0.95,
+    "top_k": 40,
+    "max_output_tokens": 8192,
+    "response_mime_type": "application/json",
+}
+EXERCISE_GENERATION_CONFIG = {"temperature": 0.7}
+NODE_TEST_GENERATION_CONFIG = {"temperature": 0.6, "response_mime_type": "application/json"}
+TEST_GENERATION_CONFIG = {"temperature": 0.6, "response_mime_type": "application/json"}
+SUMMARIZE_GENERATION_CONFIG = {"temperature": 0.5}
+GEOGEBRA_GENERATION_CONFIG = {"temperature": 0.3, "response_mime_type": "application/json"}
+ANALYZE_GENERATION_CONFIG = {"temperature": 0.6}
+
+# Các cấu hình model cố định, được dựng sẵn một lần lúc khởi động
+MODEL_SPECS = [
+    (MODEL_NAME, EXERCISE_GENERATION_CONFIG, EXERCISE_SYSTEM_INSTRUCTION),
+    (MODEL_NAME, NODE_TEST_GENERATION_CONFIG, NODE_TEST_SYSTEM_INSTRUCTION),
+    (MODEL_NAME, TEST_GENERATION_CONFIG, TEST_SYSTEM_INSTRUCTION),
+    (MODEL_NAME, SUMMARIZE_GENERATION_CONFIG, SUMMARIZE_SYSTEM_INSTRUCTION),
+    (MODEL_NAME, GEOGEBRA_GENERATION_CONFIG, GEOGEBRA_SYSTEM_INSTRUCTION),
+    (MODEL_NAME, ANALYZE_GENERATION_CONFIG, None),
+    # learning_assistant._call_model & audio_service.transcribe_audio
+    ("gemini-1.5-flash", None, None),
+]
+
+
+# Prefix tĩnh của chat (system instruction + blueprint JSON) được cache phía Gemini
+CHAT_CONTEXT_PREFIX = "chat"
+SEMANTIC_CACHE_HEADER = "X-Semantic-Cache"
+CHAT_PREFIX_TOKENS = count_tokens(CHAT_SYSTEM_INSTRUCTION) + count_tokens(CHAT_RESPONSE_BLUEPRINT)
+
+
+@app.on_event("startup")
+async def warm_up_models():
+    built = model_registry.registry.warm_up(MODEL_SPECS)
+    print(f"✅ Model registry warmed up: {built} models")
+    await asyncio.to_thread(
+        context_cache.register,
+        CHAT_CONTEXT_PREFIX,
+        MODEL_NAME,
+        [CHAT_SYSTEM_INSTRUCTION, CHAT_RESPONSE_BLUEPRINT],
+    )
+    context_cache.start_refresher()
+    ingestion_jobs.start()
+    reference_index.load([EXERCISES_FOLDER, TESTS_FOLDER])
+    reference_corpus.start([EXERCISES_FOLDER, TESTS_FOLDER])
+
+
+@app.on_event("shutdown")
+async def release_context_cache():
+    await ingestion_jobs.stop()
+    await reference_corpus.stop()
+    await asyncio.to_thread(context_cache.close)
+    llm_gateway.shutdown()
+    embedding_cache.close()
+    pdf_extract.shutdown_pool()
+
 # ===== FASTAPI APP =====
 
 
@@ -370,22 +391,10 @@ def extract_reply_only(raw_text: str) -> str:
     """
     if not raw_text:
         return ""
-
-    # Bỏ dấu xuống dòng dư thừa để regex dễ làm việc
-    text = raw_text.strip()
-
-    # Cố gắng tìm "reply": "...."
-    match = re.search(r'"reply"\s*:\s*"([^"]*)"', text, re.DOTALL)
-    if match:
-        return match.group(1).strip()
-
-    # Nếu model dùng 'reply': '...' (dùng nháy đơn) thì bắt thêm
-    match2 = re.search(r"'reply'\s*:\s*'([^']*)'", text, re.DOTALL)
-    if match2:
-        return match2.group(1).strip()
-
-    # Không tìm được thì trả nguyên
-    return text
+    parser = ChatStreamParser()
+    parser.feed(raw_text)
+    parser.close()
+    return parser.reply_text.strip() or raw_text.strip()
 
 
 # ===== SCHEMAS =====
@@ -416,6 +425,10 @@ class GeogebraInstruction(BaseModel):
 
 class ChatInputSchema(BaseModel):
     userId: Optional[str] = None
+    # Có conversationId thì server tự giữ lịch sử, client chỉ cần gửi tin nhắn mới
+    conversationId: Optional[str] = None
+    # Chủ đề mindmap đang học (dùng để phân vùng semantic cache)
+    topic: Optional[str] = None
     message: str
     history: List[ConversationTurn] = Field(default_factory=list)
     media: Optional[List[MediaPart]] = None
@@ -465,19 +478,24 @@ class GenerateTestInput(BaseModel):
     numQuestions: int = 5       # số câu hỏi
 
 
-def get_test_cache_path(req: GenerateTestInput) -> Path:
-    """
-    Tạo đường dẫn file cache dựa trên nội dung request.
-    Hai request giống hệt nhau (userId/topic/difficulty/testType/numQuestions)
-    sẽ dùng chung một file cache.
-    """
-    key_data = {
+def test_request_key(req: GenerateTestInput) -> dict:
+    """Các trường xác định một đề thi (dùng cho file cache và single-flight)."""
+    return {
         "userId": req.userId,
         "topic": req.topic,
         "difficulty": req.difficulty,
         "testType": req.testType,
         "numQuestions": req.numQuestions,
     }
+
+
+def get_test_cache_path(req: GenerateTestInput) -> Path:
+    """
+    Tạo đường dẫn file cache dựa trên nội dung request.
+    Hai request giống hệt nhau (userId/topic/difficulty/testType/numQuestions)
+    sẽ dùng chung một file cache.
+    """
+    key_data = test_request_key(req)
     key_str = json.dumps(key_data, ensure_ascii=False, sort_keys=True)
     key_hash = hashlib.sha256(key_str.encode("utf-8")).hexdigest()[:16]
     return GENERATED_TESTS_FOLDER / f"test_{key_hash}.json"
@@ -503,41 +521,14 @@ def evaluate_node_status(score: float, has_opened: bool) -> str:
 # --- SỬA LỖI: HÀM DỌN DẸP JSON ---
 def clean_json_response(raw_text: str) -> str:
     """
-    Tìm khối JSON đầu tiên trong chuỗi, loại bỏ ```json và các ký tự không hợp lệ.
+    Tìm khối JSON ngoài cùng trong chuỗi (bỏ ```json, văn bản thừa) và sửa
+    LaTeX chưa escape, xuống dòng thật, ngoặc kép kiểu “ ” trong một lượt quét.
     """
-    if not raw_text:
-        return ""
-
-    # Tìm JSON trong chuỗi AI trả về
-    json_match = re.search(r"{[\s\S]*}", raw_text)
-    if not json_match:
+    json_text = extract_json(raw_text)
+    if raw_text and not json_text:
         print("❌ Không tìm thấy JSON trong output AI")
         print("Raw response:", raw_text[:400])
-        return "" # Trả về chuỗi rỗng nếu không tìm thấy
-
-    json_text = json_match.group(0).strip()
-
-    # Loại ký tự điều khiển (nguyên nhân chính gây JSONDecodeError)
-    json_text = re.sub(r"[\x00-\x1F\x7F]", " ", json_text)
-    # Loại emoji và ký tự mở rộng Unicode
-    json_text = re.sub(r"[\U00010000-\U0010ffff]", "", json_text)
-    # Chuẩn hoá dấu ngoặc kép Unicode về ASCII
-    json_text = json_text.replace("“", "\"").replace("”", "\"")
-    json_text = json_text.replace("‘", "'").replace("’", "'")
-    # Loại bỏ xuống dòng thật và tab thật
-    json_text = json_text.replace("\n", " ").replace("\t", " ")
-    # Loại escape thừa dạng "\\n", "\\t"
-    json_text = json_text.replace("\\n", " ").replace("\\t", " ")
-
-    # Xử lý nếu AI trả về dạng ```json ... ``` hoặc ```...```
-    if json_text.startswith("```json"):
-        json_text = json_text[7:]
-    elif json_text.startswith("```"):
-        json_text = json_text[3:]
-    if json_text.endswith("```"):
-        json_text = json_text[:-3]
-
-    return json_text.strip()
+    return json_text
 # --- KẾT THÚC HÀM DỌN DẸP JSON ---
 
 
@@ -552,9 +543,11 @@ async def root():
         "supported_formats": ["PDF (.pdf)", "Word (.docx, .doc)"],
         "endpoints": [
             "/api/chat",
+            "/api/chat/stream",
             "/api/generate-exercises", 
             "/api/generate-test",
             "/api/process-document",
+            "/api/ingestion-jobs/{job_id}",
             "/api/summarize-topic",
             "/api/geogebra",
             "/api/analyze-test-result",
@@ -566,93 +559,227 @@ async def root():
         }
     }
 
-# ===== OPTIMIZATION: CACHED MODELS =====
-# We can initialize models globally if config is static, but here config varies slightly.
-# However, we can keep the client initialization lightweight.
-# The `genai.configure` is already done globally.
+@app.get("/api/metrics")
+async def get_metrics():
+    """Các bộ đếm nội bộ (cache/registry) để theo dõi hiệu năng."""
+    return {
+        "model_registry": model_registry.registry.stats(),
+        "context_cache": context_cache.stats(),
+        "chat_sessions": session_store.stats(),
+        "semantic_cache": semantic_cache.stats(),
+        "media": media_service.stats(),
+        "request_prep": request_prep.stats(),
+        "single_flight": single_flight.stats(),
+        "llm_gateway": llm_gateway.stats(),
+        "embedding_cache": embedding_cache.stats(),
+        "vector_index": vector_index.stats(),
+        "ingestion_jobs": ingestion_jobs.stats(),
+        "pdf_extract": pdf_extract.stats(),
+        "reference_corpus": reference_corpus.stats(),
+        "reference_index": reference_index.stats(),
+        "rate_limiter": rate_limiter.stats(),
+    }
+
+
+def build_gemini_history(turns: List[ConversationTurn]) -> List[dict]:
+    """Chuyển lịch sử hội thoại từ frontend sang định dạng history của Gemini."""
+    gemini_history = []
+    for turn in turns:
+        if not turn.content:
+            continue
+        mapped_role = "user" if turn.role == "user" else "model"
+        gemini_history.append(
+            {
+                "role": mapped_role,
+                "parts": [{"text": turn.content}],
+            }
+        )
+    return gemini_history
+
+
+def resolve_chat_history(request: ChatInputSchema) -> Tuple[Optional[ChatSession], List[dict]]:
+    """
+    Lịch sử cho lượt chat: lấy từ session phía server nếu có userId + conversationId,
+    ngược lại dùng history client gửi lên như trước.
+    """
+    if request.userId and request.conversationId:
+        session = session_store.get_or_create(
+            request.userId,
+            request.conversationId,
+            seed_turns=[{"role": t.role, "content": t.content} for t in request.history],
+        )
+        return session, session_store.build_history(session)
+    return None, build_gemini_history(request.history)
+
+
+def format_rag_block(title: str, entries: List[str], footer: str = "") -> str:
+    """Ghép các đoạn tài liệu (đã qua ngân sách token) thành khối tham khảo trong prompt."""
+    if not entries:
+        return ""
+    return f"\n\n=== {title} ===\n" + "".join(entries) + footer
+
+
+async def build_chat_context(request: ChatInputSchema) -> List[str]:
+    """RAG: lấy đoạn tài liệu liên quan của học sinh (nếu đăng nhập), theo thứ tự liên quan."""
+    entries: List[str] = []
+    if request.userId:
+        print(f"🔍 Searching documents for user {request.userId}...")
+        docs = await rag_service.search_similar_documents(request.message, request.userId, purpose="chat")
+        if docs:
+            entries = [f"- [{d['file_name']}]: {d['content']}\n" for d in docs]
+            print(f"✅ Found {len(docs)} relevant chunks")
+    return entries
+
+
+async def search_test_materials(query: str, user_id: Optional[str]) -> List[str]:
+    """RAG trên tài liệu đề thi của học sinh (dùng cho các endpoint sinh bài/đề)."""
+    if not user_id:
+        return []
+    docs = await rag_service.search_similar_documents(query, user_id, purpose="test")
+    return [f"- {d['content']}\n" for d in docs or []]
+
+
+def rag_step(run) -> PrepStep:
+    """RAG chậm thì bỏ qua: request vẫn chạy tiếp, chỉ không có ngữ cảnh RAG."""
+    return PrepStep("rag", run, timeout=RAG_STEP_TIMEOUT_SECONDS, default=[])
+
+
+def reference_step(folder: Path, topic: str, max_files: int = 3) -> PrepStep:
+    """Các đoạn tài liệu mẫu (PDF/Word) liên quan tới chủ đề, từ index cục bộ."""
+    return PrepStep(
+        "reference",
+        lambda: reference_index.passages(folder, topic, max_files),
+        timeout=REFERENCE_STEP_TIMEOUT_SECONDS,
+        default=[],
+    )
+
+
+async def build_media_parts(request: ChatInputSchema) -> Tuple[List[dict], List[str]]:
+    """
+    Ảnh từ frontend (data URL base64 hoặc ``media:<hash>`` của lượt trước)
+    -> parts cho Gemini. Mỗi ảnh chỉ upload một lần, lượt sau dùng lại handle.
+    """
+    if not request.media:
+        return [], []
+    try:
+        return await media_service.build_parts([m.url for m in request.media])
+    except MediaError as e:
+        raise HTTPException(status_code=e.status_code, detail=str(e))
+
+
+async def prepare_chat_inputs(request: ChatInputSchema) -> Tuple[List[str], Tuple[List[dict], List[str]]]:
+    """RAG và xử lý ảnh chạy song song; RAG quá hạn thì trả lời không có ngữ cảnh tài liệu."""
+    prepared = await request_prep.run(
+        rag_step(lambda: build_chat_context(request)),
+        PrepStep(
+            "media",
+            lambda: build_media_parts(request),
+            timeout=MEDIA_STEP_TIMEOUT_SECONDS,
+            required=True,
+        ),
+    )
+    return prepared["rag"], prepared["media"]
+
+
+def prepare_chat_turn(
+    request: ChatInputSchema, rag_entries: List[str], media_parts: List[dict]
+) -> Tuple[Optional[ChatSession], List[dict], List[dict], PromptPlan]:
+    """
+    Lắp prompt cho một lượt chat trong ngân sách token:
+    history (mới nhất trước), RAG (liên quan nhất trước), ảnh.
+    Blueprint JSON đã nằm trong prefix được cache nên không gửi lại ở đây.
+    """
+    session, gemini_history = resolve_chat_history(request)
+    summary = session.summary if session else ""
+
+    plan = prompt_assembler.plan()
+    plan.add_tokens("system", CHAT_PREFIX_TOKENS)
+    plan.add("history", summary)
+    rag = plan.fit("rag", rag_entries)
+    media_parts = plan.fit_media(media_parts)
+    history = plan.fit_history(gemini_history)
+    plan.add("prompt", request.message)
+
+    summary_text = f"=== TÓM TẮT CÁC LƯỢT TRƯỚC ===\n{summary}\n" if summary else ""
+    context_text = format_rag_block(
+        "THÔNG TIN THAM KHẢO TỪ TÀI LIỆU CỦA BẠN",
+        rag,
+        footer="==============================================\n",
+    )
+    user_prompt = f"""{summary_text}{context_text}\nHọc sinh vừa hỏi: {request.message}"""
+    return session, history, [{"text": user_prompt}] + media_parts, plan
+
+
+def is_semantic_cache_eligible(
+    request: ChatInputSchema,
+    session: Optional[ChatSession],
+    gemini_history: List[dict],
+    rag_entries: List[str],
+) -> bool:
+    """Chỉ cache câu hỏi lượt đầu, không lịch sử, không ảnh, không tài liệu cá nhân."""
+    return (
+        SEMANTIC_CACHE_ENABLED
+        and not gemini_history
+        and not (session and session.summary)
+        and not rag_entries
+        and not request.media
+    )
+
+
+async def lookup_semantic_cache(request: ChatInputSchema):
+    """Trả (payload đã cache hoặc None, vector câu hỏi để lưu sau khi sinh)."""
+    vector = await semantic_cache.embed(request.message)
+    if vector is None:
+        return None, None
+    return semantic_cache.lookup(request.topic, request.message, vector), vector
+
+
+def normalize_geogebra_block(geogebra_block, fallback_prompt: str) -> dict:
+    """Chuẩn hoá khối geogebra của model về đúng cấu trúc frontend cần."""
+    if not isinstance(geogebra_block, dict):
+        geogebra_block = {}
+    return {
+        "should_draw": bool(geogebra_block.get("should_draw")),
+        "reason": geogebra_block.get("reason") or "",
+        "prompt": geogebra_block.get("prompt") or fallback_prompt,
+        "commands": geogebra_block.get("commands")
+        if isinstance(geogebra_block.get("commands"), list)
+        else [],
+    }
+
 
 # --- SỬA LỖI 1: TỐI ƯU HÓA TỐC ĐỘ CHAT ---
 @app.post("/api/chat")
-async def handle_chat(request: ChatInputSchema):
+async def handle_chat(request: ChatInputSchema, http_response: Response):
     """Handle chat using a persistent ChatSession for speed."""
     try:
-        generation_config = {
-            "temperature": 0.7,
-            "top_p": 0.95,
-            "top_k": 40,
-            "max_output_tokens": 8192,
-            "response_mime_type": "application/json",
-        }
-
-        # 1) Xây dựng lại lịch sử cho Gemini ChatSession
-        gemini_history = []
-        gemini_history = []
-        for turn in request.history:
-            if not turn.content:
-                continue
-            mapped_role = "user" if turn.role == "user" else "model"
-            gemini_history.append(
-                {
-                    "role": mapped_role,
-                    "parts": [{"text": turn.content}],
-                }
-            )
+        # 1) RAG + lắp prompt trong ngân sách token
+        #    (history từ session server hoặc từ client, RAG, ảnh)
+        rag_entries, (media_parts, media_refs) = await prepare_chat_inputs(request)
+        session, gemini_history, user_parts, plan = prepare_chat_turn(request, rag_entries, media_parts)
+        http_response.headers[PROMPT_TOKENS_HEADER] = plan.header_value()
+
+        # Câu hỏi lượt đầu (không dữ liệu cá nhân) có thể trả thẳng từ semantic cache
+        cache_vector = None
+        if is_semantic_cache_eligible(request, session, gemini_history, rag_entries):
+            cached, cache_vector = await lookup_semantic_cache(request)
+            http_response.headers[SEMANTIC_CACHE_HEADER] = "hit" if cached else "miss"
+            if cached:
+                if session:
+                    session_store.record_turn(session, request.message, cached["reply"])
+                return cached
 
         # 2) Khởi tạo ChatSession với lịch sử đã có
-        #    Điều này cho phép model duy trì ngữ cảnh mà không cần gửi lại toàn bộ
-        #    OPTIMIZATION: Initialize model here or use cached one
-        model = genai.GenerativeModel(
-            "gemini-2.5-flash",
-            generation_config=generation_config,
-            system_instruction=CHAT_SYSTEM_INSTRUCTION,
-        )
+        #    Model dùng prefix (system instruction + blueprint) đã cache sẵn
+        model = context_cache.get_model(CHAT_CONTEXT_PREFIX, CHAT_GENERATION_CONFIG)
         chat = model.start_chat(history=gemini_history)
 
-        # 3) Chuẩn bị nội dung tin nhắn MỚI
-        # RAG INTEGRATION
-        context_text = ""
-        if request.userId:
-            print(f"🔍 Searching documents for user {request.userId}...")
-            docs = await rag_service.search_similar_documents(request.message, request.userId, purpose="chat")
-            if docs:
-                context_text = "\n\n=== THÔNG TIN THAM KHẢO TỪ TÀI LIỆU CỦA BẠN ===\n"
-                for d in docs:
-                    context_text += f"- [{d['file_name']}]: {d['content']}\n"
-                context_text += "==============================================\n"
-                print(f"✅ Found {len(docs)} relevant chunks")
-
-        user_prompt = f"""{CHAT_RESPONSE_BLUEPRINT}\n\n{context_text}\nHọc sinh vừa hỏi: {request.message}"""
-        user_parts = [{"text": user_prompt}]
-
-        if request.media:
-            for media in request.media:
-                # Kiểm tra xem có phải là Data URL không (từ frontend gửi lên dạng base64)
-                if media.url.startswith("data:"):
-                    try:
-                        # Tách header và data. Vd: "data:image/png;base64,JVBERi..."
-                        header, base64_data = media.url.split(",", 1)
-                        
-                        # Lấy mime_type từ header (vd: "image/png")
-                        mime_type = header.split(":")[1].split(";")[0]
-                        
-                        # Thêm vào user_parts theo đúng chuẩn của Gemini SDK
-                        user_parts.append({
-                            "inline_data": {
-                                "mime_type": mime_type,
-                                "data": base64_data
-                            }
-                        })
-                    except Exception as e:
-                        print(f"❌ Lỗi xử lý ảnh: {e}")
-                else:
-                    # Trường hợp là URL ảnh online (nếu có hỗ trợ sau này)
-                    # Gemini không hỗ trợ trực tiếp URL ảnh công khai qua chat session kiểu này
-                    # trừ khi dùng File API, nhưng với base64 thì dùng inline_data là chuẩn nhất.
-                    print(f"⚠️ URL không phải định dạng base64: {media.url[:30]}...")
-
         # 4) Gửi tin nhắn mới (async)
         #    Model sẽ tự động nối lịch sử đã có với tin nhắn mới này
-        response = await chat.send_message_async(user_parts)
+        #    Chat là lớp ưu tiên cao nhất của rate limiter
+        response = await llm_gateway.call(
+            lambda: chat.send_message_async(user_parts), endpoint="chat", priority=INTERACTIVE
+        )
 
         # Lấy raw text từ model
         raw_text = response.text if hasattr(response, "text") else None
@@ -661,22 +788,11 @@ async def handle_chat(request: ChatInputSchema):
 
         # Mặc định: không mindmap, không vẽ geogebra
         mindmap_data = []
-        normalized_geogebra = {
-            "should_draw": False,
-            "reason": "",
-            "prompt": request.message,
-            "commands": [],
-        }
+        normalized_geogebra = normalize_geogebra_block({}, request.message)
 
         # ===================== TRY PARSE JSON =====================
         try:
-            # SỬA LỖI: Sử dụng hàm dọn dẹp JSON
-            json_candidate = clean_json_response(raw_text)
-            
-            if not json_candidate:
-                raise ValueError("Không tìm thấy JSON hợp lệ trong phản hồi")
-
-            payload = json.loads(json_candidate)
+            payload = parse_model_json(raw_text)
 
             # Nếu parse được JSON, ưu tiên lấy reply trong JSON
             reply_text = (
@@ -691,31 +807,138 @@ async def handle_chat(request: ChatInputSchema):
                 mindmap_data = md
 
             # geogebra nếu có cấu trúc đúng thì dùng cho luồng GeoGebra
-            geogebra_block = payload.get("geogebra") or {}
-            normalized_geogebra = {
-                "should_draw": bool(geogebra_block.get("should_draw")),
-                "reason": geogebra_block.get("reason") or "",
-                "prompt": geogebra_block.get("prompt") or request.message,
-                "commands": geogebra_block.get("commands")
-                if isinstance(geogebra_block.get("commands"), list)
-                else [],
-            }
+            normalized_geogebra = normalize_geogebra_block(payload.get("geogebra"), request.message)
+            json_ok = bool(reply_text)
 
         except Exception as e:
             # JSON hỏng -> chỉ lấy phần reply, bỏ mindmap & geogebra
             print(f"JSON parse failed, fallback to reply-only: {e}")
             reply_text = extract_reply_only(raw_text)
+            json_ok = False
+
+        if session:
+            session_store.record_turn(session, request.message, reply_text)
 
         # Trả response về frontend: chat chỉ dùng field "reply"
-        return {
+        result = {
             "reply": reply_text,
             "mindmap_insights": mindmap_data,
             "geogebra": normalized_geogebra,
+            # Frontend gửi lại "media:<hash>" thay cho data URL ở lượt sau
+            "media_refs": media_refs,
         }
+        if cache_vector is not None and json_ok:
+            semantic_cache.store(request.topic, request.message, cache_vector, result)
+        return result
 
+    except HTTPException:
+        raise
     except Exception as e:
         print(f"Chat error: {e}")
         raise HTTPException(status_code=500, detail=str(e))
+
+
+@app.delete("/api/chat/sessions/{user_id}/{conversation_id}")
+async def delete_chat_session(user_id: str, conversation_id: str):
+    """Xoá lịch sử hội thoại phía server (vd: khi học sinh bắt đầu cuộc trò chuyện mới)."""
+    return {"deleted": session_store.delete(user_id, conversation_id)}
+
+
+def _sse_event(event: str, data) -> str:
+    """Đóng gói một sự kiện Server-Sent Events (data là JSON)."""
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+@app.post("/api/chat/stream")
+async def handle_chat_stream(request: ChatInputSchema):
+    """
+    Phiên bản streaming (SSE) của /api/chat.
+    - event "reply": từng đoạn text của reply ngay khi model sinh ra ({"delta": "..."})
+    - event "mindmap_insights" / "geogebra": gửi khi khối JSON tương ứng đóng lại
+    - event "done": payload đầy đủ giống /api/chat để frontend đối chiếu
+    - event "error": lỗi giữa chừng
+    """
+    rag_entries, (media_parts, media_refs) = await prepare_chat_inputs(request)
+    session, gemini_history, user_parts, plan = prepare_chat_turn(request, rag_entries, media_parts)
+
+    cached, cache_vector = None, None
+    if is_semantic_cache_eligible(request, session, gemini_history, rag_entries):
+        cached, cache_vector = await lookup_semantic_cache(request)
+
+    async def cached_stream():
+        yield _sse_event("reply", {"delta": cached["reply"]})
+        yield _sse_event("mindmap_insights", cached["mindmap_insights"])
+        yield _sse_event("geogebra", cached["geogebra"])
+        if session:
+            session_store.record_turn(session, request.message, cached["reply"])
+        yield _sse_event("done", cached)
+
+    async def event_stream():
+        parser = ChatStreamParser()
+        mindmap_data = []
+        normalized_geogebra = normalize_geogebra_block({}, request.message)
+
+        def to_sse(events):
+            nonlocal mindmap_data, normalized_geogebra
+            out = []
+            for key, value in events:
+                if key == "reply":
+                    out.append(_sse_event("reply", {"delta": value}))
+                elif key == "mindmap_insights":
+                    mindmap_data = value if isinstance(value, list) else []
+                    out.append(_sse_event("mindmap_insights", mindmap_data))
+                elif key == "geogebra":
+                    normalized_geogebra = normalize_geogebra_block(value, request.message)
+                    out.append(_sse_event("geogebra", normalized_geogebra))
+            return out
+
+        try:
+            async for text in stream_chat(
+                gemini_history,
+                user_parts,
+                model=context_cache.get_model(CHAT_CONTEXT_PREFIX, CHAT_GENERATION_CONFIG),
+            ):
+                for event in to_sse(parser.feed(text)):
+                    yield event
+            for event in to_sse(parser.close()):
+                yield event
+
+            if session:
+                session_store.record_turn(session, request.message, parser.reply_text)
+
+            result = {
+                "reply": parser.reply_text,
+                "mindmap_insights": mindmap_data,
+                "geogebra": normalized_geogebra,
+                "media_refs": media_refs,
+            }
+            if cache_vector is not None and parser.complete and parser.reply_text:
+                semantic_cache.store(request.topic, request.message, cache_vector, result)
+            yield _sse_event("done", result)
+        except HTTPException as e:
+            # 429 (rate limit), 503 (breaker mở), 504 (quá deadline): báo kèm thời gian thử lại
+            print(f"Chat stream error {e.status_code}: {e.detail}")
+            payload = {"detail": e.detail, "status": e.status_code}
+            retry_after = (e.headers or {}).get("Retry-After")
+            if retry_after:
+                payload["retry_after"] = int(retry_after)
+            yield _sse_event("error", payload)
+        except Exception as e:
+            print(f"Chat stream error: {e}")
+            yield _sse_event("error", {"detail": str(e)})
+
+    headers = {
+        "Cache-Control": "no-cache",
+        "X-Accel-Buffering": "no",
+        PROMPT_TOKENS_HEADER: plan.header_value(),
+    }
+    if cache_vector is not None:
+        headers[SEMANTIC_CACHE_HEADER] = "hit" if cached else "miss"
+    return StreamingResponse(
+        cached_stream() if cached else event_stream(),
+        media_type="text/event-stream",
+        headers=headers,
+    )
 # --- KẾT THÚC SỬA LỖI CHAT ---
 
 
@@ -751,33 +974,26 @@ def open_node(user_id: int, node_id: int):
 
 
 @app.post("/api/generate-exercises")
-async def handle_generate_exercises(request: GenerateExercisesInput):
+async def handle_generate_exercises(request: GenerateExercisesInput, http_response: Response):
     """Generate math exercises based on topic"""
     try:
         print(f"📚 Generating exercises for topic: {request.topic}")
         
-        # RAG Integration
-        context_text = ""
-        if request.userId:
-             docs = await rag_service.search_similar_documents(request.topic, request.userId, purpose="test") # Use test materials
-             if docs:
-                context_text = "\n\n=== TÀI LIỆU THAM KHẢO ===\n"
-                for d in docs:
-                    context_text += f"- {d['content']}\n"
-        
-        # Fallback to local files if no RAG results (optional, or keep both)
-        reference_text = load_reference_materials(str(EXERCISES_FOLDER), max_files=3)
-        
-        generation_config = {
-            "temperature": 0.7,
-        }
-        
-        # OPTIMIZATION: Re-use model if possible, but for now just keep it local as it's stateless
-        model = genai.GenerativeModel(
-            'gemini-2.5-flash',
-            generation_config=generation_config,
-            system_instruction=EXERCISE_SYSTEM_INSTRUCTION
+        # RAG (tài liệu đề thi của học sinh) và tài liệu mẫu chạy song song
+        prepared = await request_prep.run(
+            rag_step(lambda: search_test_materials(request.topic, request.userId)),
+            reference_step(EXERCISES_FOLDER, request.topic),
         )
+        rag_entries = prepared["rag"]
+        reference_passages = prepared["reference"]
+
+        # Ngân sách token: RAG của học sinh trước, tài liệu mẫu lấp phần còn lại
+        plan = prompt_assembler.plan()
+        plan.add("system", EXERCISE_SYSTEM_INSTRUCTION)
+        context_text = format_rag_block("TÀI LIỆU THAM KHẢO", plan.fit("rag", rag_entries))
+        reference_text = "".join(plan.fit("rag", reference_passages))
+        
+        model = model_registry.get_model(MODEL_NAME, EXERCISE_GENERATION_CONFIG, EXERCISE_SYSTEM_INSTRUCTION)
         
         prompt = f"""Tạo {request.count} bài tập toán học về chủ đề: "{request.topic}"
 Độ khó: {request.difficulty}
@@ -808,8 +1024,10 @@ YÊU CẦU:
 
 ## Bài 2
 [Tiếp tục...]"""
+        plan.count_prompt(prompt)
+        http_response.headers[PROMPT_TOKENS_HEADER] = plan.header_value()
         
-        response = model.generate_content(prompt)
+        response = await llm_gateway.generate(model, prompt, endpoint="generate-exercises")
         
         if not response or not hasattr(response, 'text'):
             raise ValueError("Model không trả về phản hồi")
@@ -825,28 +1043,77 @@ YÊU CẦU:
             "exercises": exercises_text
         }
         
+    except HTTPException:
+        raise
     except Exception as e:
         print(f"❌ Generate exercises error: {e}")
         import traceback
         traceback.print_exc()
         raise HTTPException(status_code=500, detail=f"Lỗi: {str(e)}")
 
-@app.post("/api/process-document")
+INGESTION_EVENTS_POLL_SECONDS = 1.0
+
+
+def ingestion_job_view(job: dict) -> dict:
+    """Trạng thái job cho frontend (không lộ thông tin worker)."""
+    return {
+        "jobId": job["id"],
+        "documentId": job["document_id"],
+        "status": job["status"],
+        "attempts": job["attempts"],
+        "chunksDone": job["chunks_done"],
+        "chunksTotal": job.get("chunks_total"),
+        "progress": job.get("progress", 0),
+        "error": job.get("last_error"),
+    }
+
+
+@app.post("/api/process-document", status_code=202)
 async def process_document(request: ProcessDocumentInput):
-    """Trigger document processing (RAG)"""
+    """Trigger document processing (RAG): xếp job vào hàng đợi và trả về ngay."""
     try:
-        success = await rag_service.process_document(
-            user_id=request.userId,
-            document_id=request.documentId,
-            purpose=request.purpose
-        )
-        if not success:
-            raise HTTPException(status_code=500, detail="Processing failed")
-        return {"status": "ok", "message": "Document processed successfully"}
+        job = await ingestion_jobs.enqueue(request.userId, request.documentId, request.purpose)
+        return {"status": "queued", "message": "Document queued for processing", **ingestion_job_view(job)}
     except Exception as e:
         print(f"Process document error: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
+
+@app.get("/api/ingestion-jobs/{job_id}")
+async def get_ingestion_job(job_id: str):
+    job = await ingestion_jobs.get(job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return ingestion_job_view(job)
+
+
+@app.get("/api/ingestion-jobs/{job_id}/events")
+async def stream_ingestion_job(job_id: str):
+    """SSE: event "progress" mỗi khi tiến độ thay đổi, kết thúc bằng "done" (hoặc "error")."""
+    job = await ingestion_jobs.get(job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Job not found")
+
+    async def events():
+        nonlocal job
+        last = None
+        while True:
+            view = ingestion_job_view(job)
+            if view != last:
+                yield _sse_event("progress", view)
+                last = view
+            if job["status"] in FINAL_STATUSES:
+                yield _sse_event("done" if job["status"] == "completed" else "error", view)
+                return
+            await asyncio.sleep(INGESTION_EVENTS_POLL_SECONDS)
+            job = await ingestion_jobs.get(job_id) or job
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
 # ==============================
 #  API TẠO TEST DỰA TRÊN NODE
 # ==============================
@@ -862,7 +1129,6 @@ class NodeTestRequest(BaseModel):
 from pydantic import BaseModel
 from fastapi import HTTPException
 import json
-import google.generativeai as genai
 
 
 class NodeTestRequest(BaseModel):
@@ -871,31 +1137,23 @@ class NodeTestRequest(BaseModel):
 
 
 @app.post("/api/generate-node-test")
-async def generate_node_test(req: NodeTestRequest):
+async def generate_node_test(req: NodeTestRequest, http_response: Response):
     """Generate test based on current node content"""
     try:
         topic = req.topic
 
-        model = genai.GenerativeModel(
-            "gemini-2.5-flash",
-            generation_config={
-                "temperature": 0.6,
-                "response_mime_type": "application/json",
-            },
-            system_instruction="Bạn là hệ thống sinh đề kiểm tra toán chuẩn THPT."
-        )
+        model = model_registry.get_model(MODEL_NAME, NODE_TEST_GENERATION_CONFIG, NODE_TEST_SYSTEM_INSTRUCTION)
 
         # ========================
         #      PROMPT CHUẨN (SỬA LỖI 2A: BẮT BUỘC DÙNG LATEX)
         # ========================
-        # RAG Integration
-        context_text = ""
-        if req.userId:
-            docs = await rag_service.search_similar_documents(topic, req.userId, purpose="test")
-            if docs:
-                context_text = "\n\n=== TÀI LIỆU THAM KHẢO ===\n"
-                for d in docs:
-                    context_text += f"- {d['content']}\n"
+        # RAG Integration (quá hạn thì tạo đề không có tài liệu riêng)
+        prepared = await request_prep.run(rag_step(lambda: search_test_materials(topic, req.userId)))
+        rag_entries = prepared["rag"]
+
+        plan = prompt_assembler.plan()
+        plan.add("system", NODE_TEST_SYSTEM_INSTRUCTION)
+        context_text = format_rag_block("TÀI LIỆU THAM KHẢO", plan.fit("rag", rag_entries))
 
         prompt = f"""
 Tạo đề kiểm tra toán lớp 12 dựa 100% trên chủ đề: "{topic}"
@@ -977,23 +1235,21 @@ KHÔNG markdown.
 KHÔNG code block.
 TẤT CẢ DẤU \\ TRONG LATEX PHẢI ĐƯỢC ESCAPE (ví dụ: \\\\frac, \\\\lim, \\\\infty).
 """
+        plan.count_prompt(prompt)
+        http_response.headers[PROMPT_TOKENS_HEADER] = plan.header_value()
 
 
         # ========================
         #        GỌI AI
         # ========================
-        response = model.generate_content(prompt)
+        response = await llm_gateway.generate(model, prompt, endpoint="generate-node-test")
         raw = response.text
 
         # ========================
         # VALIDATE JSON (SỬA LỖI 2B: DÙNG HÀM CLEAN_JSON)
         # ========================
         try:
-            json_text = clean_json_response(raw)
-            if not json_text:
-                raise ValueError("Không tìm thấy JSON hợp lệ")
-            
-            data = json.loads(json_text)
+            data = parse_model_json(raw)
         except Exception as e:
             print(f"❌ RAW JSON ERROR: {e}")
             print(f"Raw response: {raw[:300]}...")
@@ -1011,6 +1267,8 @@ TẤT CẢ DẤU \\ TRONG LATEX PHẢI ĐƯỢC ESCAPE (ví dụ: \\\\frac, \\\\
             "test": data
         }
 
+    except HTTPException:
+        raise
     except Exception as e:
         print(f"❌ NODE TEST ERROR: {e}")
         raise HTTPException(status_code=500, detail=str(e))
@@ -1029,7 +1287,7 @@ def escape_backslashes(obj):
         return obj
 
 @app.post("/api/generate-test")
-async def handle_generate_test(request: GenerateTestInput):
+async def handle_generate_test(request: GenerateTestInput, http_response: Response):
     """Generate a test based on PDF/Word reference materials"""
     try:
         # 1️⃣ Kiểm tra cache trước: nếu đã có file thì trả luôn, không gọi Gemini nữa
@@ -1044,64 +1302,59 @@ async def handle_generate_test(request: GenerateTestInput):
                 print(f"⚠️ Lỗi đọc cache {cache_path}: {e}. Sẽ tạo đề mới.")
 
         print(f"📝 Loading test reference materials for topic: {request.topic}")
-        reference_text = load_reference_materials(str(TESTS_FOLDER), max_files=3)
-
-        generation_config = {
-            "temperature": 0.6,
-            "response_mime_type": "application/json",
-        }
-
-        model = genai.GenerativeModel(
-            'gemini-2.5-flash',
-            generation_config=generation_config,
-            system_instruction=TEST_SYSTEM_INSTRUCTION
+        # Đề mẫu và RAG chạy song song, mỗi bước có timeout riêng
+        prepared = await request_prep.run(
+            reference_step(TESTS_FOLDER, request.topic),
+            rag_step(lambda: search_test_materials(request.topic, request.userId)),
         )
+        reference_passages = prepared["reference"]
+        rag_entries = prepared["rag"]
 
-        # RAG Integration
-        context_text = ""
-        if request.userId:
-            docs = await rag_service.search_similar_documents(request.topic, request.userId, purpose="test")
-            if docs:
-                context_text = "\n\n=== TÀI LIỆU THAM KHẢO TỪ RAG ===\n"
-                for d in docs:
-                    context_text += f"- {d['content']}\n"
+        model = model_registry.get_model(MODEL_NAME, TEST_GENERATION_CONFIG, TEST_SYSTEM_INSTRUCTION)
+
+        # Ngân sách token: RAG của học sinh trước, đề mẫu lấp phần còn lại
+        plan = prompt_assembler.plan()
+        plan.add("system", TEST_SYSTEM_INSTRUCTION)
+        context_text = format_rag_block("TÀI LIỆU THAM KHẢO TỪ RAG", plan.fit("rag", rag_entries))
+        reference_text = "".join(plan.fit("rag", reference_passages))
 
         # ⚠️ Prompt dùng đúng y như bạn gửi
         prompt = f"""Tạo đề kiểm tra TOÁN LỚP 12 về chủ đề: "{request.topic}" Độ khó: {request.difficulty} TÀI LIỆU THAM KHẢO: {context_text} {reference_text if reference_text else "Không có tài liệu. Tạo đề theo chuẩn THPT QG."} QUY TẮC QUAN TRỌNG (CHUẨN FORM THPT 2025): 1. Mỗi câu hỏi PHẢI có đầy đủ dữ liệu (phương trình, hàm số, đồ thị...) 2. Sử dụng LaTeX cho công thức: $x^2$ hoặc $x^2 + 2x + 1 = 0$ 3. Câu hỏi phải CỤ THỂ, KHÔNG mơ hồ 4. Đáp án phải CHÍNH XÁC 5. Cấu trúc đề: - Phần 1: Trắc nghiệm 4 lựa chọn (A,B,C,D) - Phần 2: Trắc nghiệm Đúng/Sai (4 ý a,b,c,d) - Phần 3: Trả lời ngắn (Điền số) VÍ DỤ MẪU: TRẮC NGHIỆM TỐT: "Câu 1: Phương trình $x^2 - 5x + 6 = 0$ có bao nhiêu nghiệm?" TRẮC NGHIỆM SAI (THIẾU DỮ LIỆU): "Câu 1: Phương trình có bao nhiêu nghiệm?" ❌ ĐÚNG/SAI TỐT: "Câu 5: Cho hàm số $y = x^3 - 3x + 1$. Xét tính đúng/sai của các mệnh đề sau: a) Hàm số đồng biến trên khoảng $(1; +\\infty)$ b) Đồ thị hàm số cắt trục hoành tại 3 điểm c) Hàm số có cực đại tại $x = -1$ d) $\\lim_{{x \\to +\\infty}} y = +\\infty$" QUAN TRỌNG - PHẦN ĐÚNG/SAI: Câu hỏi đúng/sai PHẢI có cấu trúc: - prompt: "Câu X: Cho [dữ liệu cụ thể]. Xét tính đúng/sai của các mệnh đề sau:" - statements: Mảng 4 mệnh đề CỤ THỂ, có thể đánh giá được VÍ DỤ MẪU ĐÚNG: {{ "id": "tf1", "type": "true-false", "prompt": "Câu 5: Cho hàm số $y = x^3 - 3x + 1$. Xét tính đúng/sai:", "statements": [ "Hàm số đồng biến trên khoảng $(1; +\\infty)$", "Đồ thị hàm số cắt trục hoành tại 3 điểm", "Hàm số có cực đại tại $x = -1$", "Giới hạn $\\lim_{{x \\to +\\infty}} y = +\\infty$" ], "answer": [true, true, true, true] }} VÍ DỤ SAI (KHÔNG LÀM THẾ NÀY): {{ "statements": ["a) Đúng", "b) Sai", "c) Đúng", "d) Sai"] ❌ }} ***QUAN TRỌNG VỀ JSON (BẮT BUỘC):*** Toàn bộ đầu ra là một chuỗi JSON. Do đó, tất cả các ký tự gạch chéo ngược (\\) BÊN TRONG chuỗi (ví dụ: trong LaTeX) PHẢI được thoát (escaped) bằng cách nhân đôi. VÍ DỤ: - SAI: "$\\frac{{1}}{{2}}$" - ĐÚNG: "$\\\\frac{{1}}{{2}}$" - SAI: "$\\lim_{{x \\to 0}}$" - ĐÚNG: "$\\\\lim_{{x \\\\to 0}}$" - SAI: "$(1; +\\infty)$" - ĐÚNG: "$(1; +\\\\infty)$" YÊU CẦU: Trả về JSON thuần túy, KHÔNG markdown code block: Trả về JSON: {{ "title": "KIỂM TRA {request.topic.upper()}", "parts": {{ "multipleChoice": {{ ... }}, "trueFalse": {{ "title": "PHẦN 2: ĐÚNG/SAI", "questions": [ {{ "id": "tf1", "type": "true-false", "prompt": "Câu 5: Cho hàm số $y = 2x^2 - 4x + 1$. Xét tính đúng/sai của các mệnh đề sau:", "statements": [ "Đồ thị hàm số có trục đối xứng $x = 1$", "Hàm số có giá trị nhỏ nhất bằng $-1$", "Đồ thị hàm số đi qua điểm $(0, 1)$", "Hàm số nghịch biến trên khoảng $(-\\\\infty; 1)$" ], "answer": [true, true, true, true] }} ] }}, "shortAnswer": {{ ... }} }} }} KHÔNG dùng a), b), c), d) trong statements! Mỗi statement là một mệnh đề hoàn chỉnh! LƯU Ý BẮT BUỘC: - KHÔNG dùng markdown
 json ...
 - Mỗi câu hỏi PHẢI có đầy đủ dữ liệu cụ thể - LaTeX dùng $ cho inline, $ cho display - TẤT CẢ DẤU \\ TRONG LATEX PHẢI ĐƯỢC ESCAPE (ví dụ: \\\\frac, \\\\lim, \\\\infty) - answer trong multipleChoice: 0=option[0], 1=option[1], 2=option[2], 3=option[3] - answer trong trueFalse: [true, false, true, false] - answer trong shortAnswer: string số (max 6 ký tự)"""
+        plan.count_prompt(prompt)
+        http_response.headers[PROMPT_TOKENS_HEADER] = plan.header_value()
 
-        response = model.generate_content(prompt)
-
-        # --- Parse JSON an toàn (giữ logic cũ của bạn) ---
-        try:
-            json_text = clean_json_response(response.text)
-            if not json_text:
-                raise ValueError("Không tìm thấy JSON hợp lệ")
-
-            json_text = clean_json_response(response.text)
-            if not json_text:
-                raise ValueError("Không tìm thấy JSON hợp lệ")
-
-            # ✨ giữ hack cũ: escape \ trước khi json.loads
-            safe_json_text = json_text.replace("\\", "\\\\")  # tất cả \ → \\
-
-            result = json.loads(safe_json_text)
+        async def generate() -> dict:
+            response = await llm_gateway.generate(model, prompt, endpoint="generate-test")
 
-        except json.JSONDecodeError as e:
-            print(f"❌ JSON parse error: {e}")
-            print(f"Raw response: {response.text[:500]}")
-            raise HTTPException(
-                status_code=500,
-                detail="AI trả về dữ liệu không hợp lệ. Vui lòng thử lại."
-            )
-
-        # Validate structure
-        if "parts" not in result or "multipleChoice" not in result["parts"]:
-            raise HTTPException(
-                status_code=500,
-                detail="Dữ liệu đề thi thiếu cấu trúc 'parts' hoặc 'multipleChoice'"
-            )
+            # --- Parse JSON an toàn ---
+            try:
+                # raw_backslashes: mọi \ trong chuỗi giữ nguyên là ký tự thật
+                # (giữ đúng định dạng LaTeX của đề đã cache)
+                result = parse_model_json(response.text, raw_backslashes=True)
+
+            except ValueError as e:
+                print(f"❌ JSON parse error: {e}")
+                print(f"Raw response: {response.text[:500]}")
+                raise HTTPException(
+                    status_code=500,
+                    detail="AI trả về dữ liệu không hợp lệ. Vui lòng thử lại."
+                )
+
+            # Validate structure
+            if "parts" not in result or "multipleChoice" not in result["parts"]:
+                raise HTTPException(
+                    status_code=500,
+                    detail="Dữ liệu đề thi thiếu cấu trúc 'parts' hoặc 'multipleChoice'"
+                )
+            return result
+
+        # Nhiều học sinh cùng xin một đề (cùng chủ đề/độ khó/dạng đề) trong lúc
+        # đề đang được tạo -> chờ chung một lần gọi Gemini. userId được thay bằng
+        # chính phần RAG riêng của học sinh, nên ai không có tài liệu riêng sẽ dùng chung.
+        flight_key = {**test_request_key(request), "userId": None, "rag": rag_entries}
+        result = await single_flight.do(canonical_key("generate-test", flight_key), generate)
 
         # Đóng gói response chuẩn
         response_data = {
@@ -1127,33 +1380,17 @@ json ...
         print(f"❌ Generate test error: {e}")
         import traceback
         traceback.print_exc()
-
-        error_message = str(e)
-        if "429" in error_message or "Resource exhausted" in error_message:
-            raise HTTPException(
-                status_code=429,
-                detail="API Google đang quá tải. Vui lòng đợi 1-2 phút rồi thử lại."
-            )
-
         raise HTTPException(status_code=500, detail=str(e))
 
 
 
 @app.post("/api/summarize-topic")
-async def handle_summarize_topic(request: SummarizeTopicInput):
+async def handle_summarize_topic(request: SummarizeTopicInput, http_response: Response):
     """Summarize a math topic"""
     try:
         print(f"📖 Summarizing topic: {request.topic}")
         
-        generation_config = {
-            "temperature": 0.5,
-        }
-        
-        model = genai.GenerativeModel(
-            'gemini-2.5-flash',
-            generation_config=generation_config,
-            system_instruction=SUMMARIZE_SYSTEM_INSTRUCTION
-        )
+        model = model_registry.get_model(MODEL_NAME, SUMMARIZE_GENERATION_CONFIG, SUMMARIZE_SYSTEM_INSTRUCTION)
         
         prompt = f"""Tóm tắt chủ đề sau một cách ngắn gọn, súc tích và dễ hiểu. 
 Sử dụng:
@@ -1163,24 +1400,37 @@ Sử dụng:
 
 Chủ đề: {request.topic}
 Độ chi tiết: {request.detail_level}"""
+        plan = prompt_assembler.plan()
+        plan.add("system", SUMMARIZE_SYSTEM_INSTRUCTION)
+        plan.count_prompt(prompt)
+        http_response.headers[PROMPT_TOKENS_HEADER] = plan.header_value()
         
-        response = model.generate_content(prompt)
-        
-        if not response or not hasattr(response, 'text'):
-            raise ValueError("Model không trả về phản hồi")
-        
-        summary_text = response.text.strip()
-        
-        if not summary_text:
-            raise ValueError("Model trả về nội dung trống")
-        
-        print(f"✅ Generated summary: {len(summary_text)} characters")
+        async def generate() -> str:
+            response = await llm_gateway.generate(model, prompt, endpoint="summarize-topic")
+
+            if not response or not hasattr(response, 'text'):
+                raise ValueError("Model không trả về phản hồi")
+
+            summary_text = response.text.strip()
+
+            if not summary_text:
+                raise ValueError("Model trả về nội dung trống")
+
+            print(f"✅ Generated summary: {len(summary_text)} characters")
+            return summary_text
+
+        summary_text = await single_flight.do(
+            canonical_key("summarize-topic", {"topic": request.topic, "detail_level": request.detail_level}),
+            generate,
+        )
         
         return {
             "topic": request.topic,
             "summary": summary_text
         }
         
+    except HTTPException:
+        raise
     except Exception as e:
         print(f"❌ Summarize topic error: {e}")
         import traceback
@@ -1189,19 +1439,10 @@ Chủ đề: {request.topic}
 
 
 @app.post("/api/geogebra")
-async def handle_geogebra(request: GeogebraInputSchema):
+async def handle_geogebra(request: GeogebraInputSchema, http_response: Response):
     """Generate GeoGebra commands"""
     try:
-        generation_config = {
-            "temperature": 0.3,
-            "response_mime_type": "application/json",
-        }
-        
-        model = genai.GenerativeModel(
-            'gemini-2.5-flash',
-            generation_config=generation_config,
-            system_instruction=GEOGEBRA_SYSTEM_INSTRUCTION
-        )
+        model = model_registry.get_model(MODEL_NAME, GEOGEBRA_GENERATION_CONFIG, GEOGEBRA_SYSTEM_INSTRUCTION)
         
         prompt = f"""Tạo lệnh GeoGebra cho: {request.request}
 
@@ -1209,39 +1450,36 @@ Trả về JSON:
 {{
   "commands": ["command1", "command2"]
 }}"""
+        plan = prompt_assembler.plan()
+        plan.add("system", GEOGEBRA_SYSTEM_INSTRUCTION)
+        plan.count_prompt(prompt)
+        http_response.headers[PROMPT_TOKENS_HEADER] = plan.header_value()
         
-        response = model.generate_content(prompt)
-        # SỬA LỖI: Dùng hàm clean_json
-        json_text = clean_json_response(response.text)
-        if not json_text:
-            raise ValueError("Không tìm thấy JSON hợp lệ")
-            
-        result = json.loads(json_text)
-        
-        if "commands" not in result or not isinstance(result["commands"], list):
-            raise ValueError("Invalid response format")
-        
-        return result
+        async def generate() -> dict:
+            response = await llm_gateway.generate(model, prompt, endpoint="geogebra")
+            result = parse_model_json(response.text)
+
+            if "commands" not in result or not isinstance(result["commands"], list):
+                raise ValueError("Invalid response format")
+            return result
+
+        # Prompt chỉ phụ thuộc vào request.request
+        return await single_flight.do(canonical_key("geogebra", {"request": request.request}), generate)
         
+    except HTTPException:
+        raise
     except Exception as e:
         print(f"Geogebra error: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
 
 @app.post("/api/analyze-test-result")
-async def handle_analyze_test_result(request: AnalyzeTestResultInput):
+async def handle_analyze_test_result(request: AnalyzeTestResultInput, http_response: Response):
     """
     Phân tích kết quả bài kiểm tra và đưa ra đánh giá, lời khuyên chi tiết
     """
     try:
-        generation_config = {
-            "temperature": 0.6,
-        }
-        
-        model = genai.GenerativeModel(
-            'gemini-2.5-flash',
-            generation_config=generation_config,
-        )
+        model = model_registry.get_model(MODEL_NAME, ANALYZE_GENERATION_CONFIG)
         
         attempt = request.testAttempt
         weak_topics = request.weakTopics
@@ -1318,25 +1556,23 @@ async def handle_analyze_test_result(request: AnalyzeTestResultInput):
 LƯU Ý: 
 - Dùng giọng điệu thân thiện, khích lệ, như một gia sư
 - Tập trung vào việc giúp học sinh TỰ TIN hơn"""
+        plan = prompt_assembler.plan()
+        plan.count_prompt(prompt)
+        http_response.headers[PROMPT_TOKENS_HEADER] = plan.header_value()
         
-        response = model.generate_content(prompt)
+        response = await llm_gateway.generate(model, prompt, endpoint="analyze-test-result")
         
-        # SỬA LỖI: Dùng hàm clean_json
-        json_text = clean_json_response(response.text)
-        if not json_text:
-            print("❌ Không tìm thấy JSON trong output AI")
-            print("Raw response:", response.text[:400])
-            raise HTTPException(status_code=500, detail="AI trả về dữ liệu không hợp lệ")
-
         try:
-            result = json.loads(json_text)
-        except json.JSONDecodeError as e:
+            result = parse_model_json(response.text)
+        except ValueError as e:
             print("❌ JSON decode error:", e)
-            print("JSON extracted:", json_text[:400])
+            print("Raw response:", response.text[:400])
             raise HTTPException(status_code=500, detail="AI trả về JSON lỗi")
 
         return result
         
+    except HTTPException:
+        raise
     except Exception as e:
         print(f"❌ Analyze test result error: {e}")
         import traceback
@@ -1345,7 +1581,7 @@ LƯU Ý:
 
 
 @app.post("/api/generate-adaptive-test")
-async def handle_generate_adaptive_test(request: GenerateAdaptiveTestInput):
+async def handle_generate_adaptive_test(request: GenerateAdaptiveTestInput, http_response: Response):
     """
     Tạo đề thi thích ứng dựa trên điểm yếu của học sinh
     """
@@ -1353,16 +1589,7 @@ async def handle_generate_adaptive_test(request: GenerateAdaptiveTestInput):
         print(f"📝 Generating adaptive test for user: {request.userId}")
         print(f"Weak topics: {request.weakTopics}")
         
-        generation_config = {
-            "temperature": 0.6,
-            "response_mime_type": "application/json",
-        }
-        
-        model = genai.GenerativeModel(
-            'gemini-2.5-flash',
-            generation_config=generation_config,
-            system_instruction=TEST_SYSTEM_INSTRUCTION
-        )
+        model = model_registry.get_model(MODEL_NAME, TEST_GENERATION_CONFIG, TEST_SYSTEM_INSTRUCTION)
         
         topics_str = ", ".join(request.weakTopics)
         
@@ -1397,16 +1624,17 @@ LƯU Ý BẮT BUỘC:
 - TẤT CẢ DẤU \\ TRONG LATEX PHẢI ĐƯỢC ESCAPE (ví dụ: \\\\frac, \\\\lim, \\\\infty)
 
 Trả về JSON thuần túy (KHÔNG dùng markdown code block)."""
+        plan = prompt_assembler.plan()
+        plan.add("system", TEST_SYSTEM_INSTRUCTION)
+        plan.count_prompt(prompt)
+        http_response.headers[PROMPT_TOKENS_HEADER] = plan.header_value()
         
-        response = model.generate_content(prompt)
+        response = await llm_gateway.generate(model, prompt, endpoint="generate-adaptive-test")
         
         # --- SỬA LỖI 2C: BỔ SUNG PARSING JSON AN TOÀN ---
         try:
-            json_text = clean_json_response(response.text)
-            if not json_text:
-                raise ValueError("Không tìm thấy JSON hợp lệ")
-            result = json.loads(json_text)
-        except json.JSONDecodeError as e:
+            result = parse_model_json(response.text)
+        except ValueError as e:
             print(f"❌ JSON parse error: {e}")
             raise HTTPException(status_code=500, detail="AI trả về dữ liệu không hợp lệ")
         
@@ -1417,6 +1645,8 @@ Trả về JSON thuần túy (KHÔNG dùng markdown code block)."""
             "test": result
         }
         
+    except HTTPException:
+        raise
     except Exception as e:
         print(f"❌ Generate adaptive test error: {e}")
         raise HTTPException(status_code=500, detail=str(e))
@@ -90,5 +90,7 @@ async def generate_adaptive_test(request: GenerateAdaptiveTestRequest):
         )
 
         return {"test": output.test, "effectiveDifficulty": effective_difficulty}
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to generate adaptive test: {e}")
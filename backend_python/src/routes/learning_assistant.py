@@ -9,8 +9,11 @@ from typing import Any, Dict, List, Optional, Set
 from fastapi import APIRouter, HTTPException
 from pydantic import BaseModel, Field
 
-from src.ai_config import genai
 from src.services import rag_service
+from src.services.chunker import split_text
+from src.services.llm_gateway import llm_gateway
+from src.services.model_registry import get_model
+from src.services.single_flight import single_flight
 from src.supabase_client import supabase
 
 router = APIRouter(prefix="/api/learning", tags=["learning"])
@@ -127,21 +130,15 @@ class UploadArtifactRequest(BaseModel):
 async def _call_model(prompt: str, fallback: str) -> str:
     """Call Gemini with strong guardrails; fall back to deterministic text."""
     try:
-        model = genai.GenerativeModel("gemini-1.5-flash")
-        result = model.generate_content(prompt)
+        model = get_model("gemini-1.5-flash")
+        result = await llm_gateway.generate(model, prompt, endpoint="learning")
         return result.text or fallback
     except Exception as exc:  # pragma: no cover - network issues
         print(f"Gemini call failed, fallback used: {exc}")
         return fallback
 
 
-@router.post("/node-content", response_model=NodeContentResponse)
-async def generate_node_content(body: NodeContentRequest) -> NodeContentResponse:
-    payload_key = _cache_key("content", body.dict())
-    cached = _CONTENT_CACHE.get(payload_key)
-    if cached and _now() - cached["ts"] < _CACHE_TTL_SECONDS:
-        return cached["value"]  # type: ignore[return-value]
-
+async def _build_node_content(body: NodeContentRequest, payload_key: str) -> NodeContentResponse:
     references: List[str] = []
     try:
         docs = await rag_service.search_similar_documents(body.topic, body.userId, purpose="knowledge")
@@ -183,6 +180,16 @@ async def generate_node_content(body: NodeContentRequest) -> NodeContentResponse
     return response
 
 
+@router.post("/node-content", response_model=NodeContentResponse)
+async def generate_node_content(body: NodeContentRequest) -> NodeContentResponse:
+    payload_key = _cache_key("content", body.dict())
+    cached = _CONTENT_CACHE.get(payload_key)
+    if cached and _now() - cached["ts"] < _CACHE_TTL_SECONDS:
+        return cached["value"]  # type: ignore[return-value]
+    # Request giống hệt đang chạy thì chờ chung kết quả thay vì gọi Gemini lần nữa
+    return await single_flight.do(f"node-content:{payload_key}", lambda: _build_node_content(body, payload_key))
+
+
 @router.post("/node-exercises", response_model=NodeExerciseResponse)
 async def generate_node_exercises(body: NodeExerciseRequest) -> NodeExerciseResponse:
     """Generate RAG-backed exercises and avoid duplicates for the same user."""
@@ -332,7 +339,7 @@ async def thptqg_practice(body: ThptqgPracticeRequest) -> ThptqgPracticeResponse
 @router.post("/artifact", status_code=201)
 async def upload_artifact(body: UploadArtifactRequest) -> Dict[str, Any]:
     """Chunk, embed, and store uploaded content into Supabase for shared RAG."""
-    chunks = rag_service.split_text(body.content, max_chars=800)
+    chunks = split_text(body.content, max_chars=800)
     if not chunks:
         raise HTTPException(status_code=400, detail="Content is empty")
 
@@ -3,6 +3,9 @@ import os
 import edge_tts
 import google.generativeai as genai
 from src.ai_config import genai
+from src.services.llm_gateway import llm_gateway
+from src.services.model_registry import get_model
+from src.services.rate_limiter import INTERACTIVE
 
 async def transcribe_audio(file_path: str, mime_type: str = "audio/mp3") -> str:
     """
@@ -11,15 +14,20 @@ async def transcribe_audio(file_path: str, mime_type: str = "audio/mp3") -> str:
     uploaded_file = None
     try:
         print(f"Uploading file {file_path} to Gemini...")
-        uploaded_file = genai.upload_file(file_path, mime_type=mime_type)
+        uploaded_file = await llm_gateway.run_blocking(
+            genai.upload_file, file_path, mime_type=mime_type, endpoint="audio-upload", priority=INTERACTIVE
+        )
         
         # Dùng model 1.5-flash cho nhanh và rẻ
-        model = genai.GenerativeModel("gemini-1.5-flash")
+        model = get_model("gemini-1.5-flash")
         
         print("Generating transcription...")
         # Prompt tiếng Việt để nhận diện tốt hơn
-        result = model.generate_content(
+        result = await llm_gateway.generate(
+            model,
             [uploaded_file, "Hãy nghe file âm thanh này và chép lại chính xác nội dung thành văn bản. Chỉ trả về nội dung văn bản, không thêm lời dẫn."],
+            endpoint="audio-transcribe",
+            priority=INTERACTIVE,
         )
         return result.text.strip()
     except Exception as e:
@@ -30,7 +38,7 @@ async def transcribe_audio(file_path: str, mime_type: str = "audio/mp3") -> str:
         # Quan trọng: Xóa file trên Google Server sau khi dùng xong
         if uploaded_file:
             try:
-                uploaded_file.delete()
+                await llm_gateway.run_blocking(uploaded_file.delete, endpoint="audio-delete", priority=INTERACTIVE)
                 print("Deleted remote file on Gemini.")
             except:
                 pass
@@ -0,0 +1,174 @@
+# src/services/chat_session_store.py
+"""Server-side chat sessions with rolling summarization.
+
+Sessions are keyed by (userId, conversationId) and kept in an in-process LRU
+with idle TTL. Clients only send the new message; the server keeps the recent
+turns verbatim and, once they pass a token budget, compacts older turns into a
+running summary so per-turn prompt size stays roughly constant.
+"""
+import asyncio
+import os
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from src.services.llm_gateway import llm_gateway
+from src.services.model_registry import get_model
+from src.services.prompt_assembler import count_tokens
+from src.services.rate_limiter import BACKGROUND
+
+CHAT_SESSION_MAX_SESSIONS = int(os.getenv("CHAT_SESSION_MAX_SESSIONS", "2000"))
+CHAT_SESSION_TTL_SECONDS = int(os.getenv("CHAT_SESSION_TTL_SECONDS", str(6 * 3600)))
+# Ngân sách token cho các lượt giữ nguyên văn; vượt quá thì tóm tắt phần cũ
+CHAT_HISTORY_TOKEN_BUDGET = int(os.getenv("CHAT_HISTORY_TOKEN_BUDGET", "3000"))
+# Số lượt gần nhất luôn giữ nguyên văn khi tóm tắt
+CHAT_HISTORY_KEEP_TURNS = int(os.getenv("CHAT_HISTORY_KEEP_TURNS", "6"))
+
+SUMMARY_MODEL_NAME = "gemini-2.5-flash"
+SUMMARY_GENERATION_CONFIG = {"temperature": 0.2, "max_output_tokens": 1024}
+SUMMARY_SYSTEM_INSTRUCTION = (
+    "Bạn tóm tắt hội thoại giữa học sinh và gia sư toán. "
+    "Giữ lại: đề bài đang làm, các bước học sinh đã làm đúng/sai, "
+    "kiến thức còn hổng và gợi ý gia sư đã đưa. Viết ngắn gọn, giữ công thức LaTeX."
+)
+
+SessionKey = Tuple[str, str]
+
+
+@dataclass
+class ChatSession:
+    user_id: str
+    conversation_id: str
+    turns: List[Dict[str, str]] = field(default_factory=list)
+    summary: str = ""
+    summarized_turns: int = 0
+    updated_at: float = field(default_factory=time.time)
+    compacting: bool = False
+
+    def history_tokens(self) -> int:
+        return sum(count_tokens(t["content"]) for t in self.turns)
+
+
+async def summarize_turns(previous_summary: str, turns: List[Dict[str, str]]) -> str:
+    """Gộp tóm tắt cũ với các lượt sắp bị loại khỏi lịch sử."""
+    transcript = "\n".join(
+        f"{'Học sinh' if t['role'] == 'user' else 'Gia sư'}: {t['content']}" for t in turns
+    )
+    prompt = (
+        f"Tóm tắt trước đó:\n{previous_summary or '(chưa có)'}\n\n"
+        f"Các lượt mới cần gộp vào tóm tắt:\n{transcript}\n\n"
+        "Viết lại MỘT bản tóm tắt duy nhất (tối đa 200 từ)."
+    )
+    model = get_model(SUMMARY_MODEL_NAME, SUMMARY_GENERATION_CONFIG, SUMMARY_SYSTEM_INSTRUCTION)
+    response = await llm_gateway.generate(model, prompt, endpoint="chat-summary", priority=BACKGROUND)
+    return (response.text or "").strip()
+
+
+class ChatSessionStore:
+    def __init__(
+        self,
+        max_sessions: int = CHAT_SESSION_MAX_SESSIONS,
+        ttl_seconds: int = CHAT_SESSION_TTL_SECONDS,
+        token_budget: int = CHAT_HISTORY_TOKEN_BUDGET,
+        keep_turns: int = CHAT_HISTORY_KEEP_TURNS,
+    ) -> None:
+        self._sessions: "OrderedDict[SessionKey, ChatSession]" = OrderedDict()
+        self.max_sessions = max_sessions
+        self.ttl_seconds = ttl_seconds
+        self.token_budget = token_budget
+        self.keep_turns = keep_turns
+        self.evictions = 0
+        self.compactions = 0
+
+    def _evict(self) -> None:
+        now = time.time()
+        for key in [k for k, s in self._sessions.items() if now - s.updated_at > self.ttl_seconds]:
+            del self._sessions[key]
+            self.evictions += 1
+        while len(self._sessions) > self.max_sessions:
+            self._sessions.popitem(last=False)
+            self.evictions += 1
+
+    def get(self, user_id: str, conversation_id: str) -> Optional[ChatSession]:
+        key = (user_id, conversation_id)
+        session = self._sessions.get(key)
+        if session is None:
+            return None
+        if time.time() - session.updated_at > self.ttl_seconds:
+            del self._sessions[key]
+            self.evictions += 1
+            return None
+        self._sessions.move_to_end(key)
+        return session
+
+    def get_or_create(
+        self,
+        user_id: str,
+        conversation_id: str,
+        seed_turns: Optional[Iterable[Dict[str, str]]] = None,
+    ) -> ChatSession:
+        """Lấy session; session mới có thể được khởi tạo từ history client gửi lên."""
+        session = self.get(user_id, conversation_id)
+        if session is None:
+            session = ChatSession(user_id=user_id, conversation_id=conversation_id)
+            if seed_turns:
+                session.turns = [dict(t) for t in seed_turns if t.get("content")]
+            self._sessions[(user_id, conversation_id)] = session
+            self._evict()
+        return session
+
+    def delete(self, user_id: str, conversation_id: str) -> bool:
+        return self._sessions.pop((user_id, conversation_id), None) is not None
+
+    def build_history(self, session: ChatSession) -> List[Dict[str, Any]]:
+        """Các lượt giữ nguyên văn, ở định dạng history của Gemini."""
+        return [
+            {
+                "role": "user" if t["role"] == "user" else "model",
+                "parts": [{"text": t["content"]}],
+            }
+            for t in session.turns
+        ]
+
+    def record_turn(self, session: ChatSession, user_message: str, reply: str) -> None:
+        """Lưu lượt vừa xong và tóm tắt nền nếu lịch sử vượt ngân sách."""
+        session.turns.append({"role": "user", "content": user_message})
+        session.turns.append({"role": "assistant", "content": reply})
+        session.updated_at = time.time()
+        if not session.compacting and session.history_tokens() > self.token_budget:
+            session.compacting = True
+            asyncio.create_task(self._compact(session))
+
+    async def _compact(self, session: ChatSession) -> None:
+        try:
+            cut = len(session.turns) - self.keep_turns
+            if cut <= 0:
+                return
+            old_turns = session.turns[:cut]
+            try:
+                summary = await summarize_turns(session.summary, old_turns)
+            except Exception as e:
+                print(f"⚠️ Chat summary failed: {e}")
+                summary = ""
+            if summary:
+                session.summary = summary
+            elif session.history_tokens() <= 2 * self.token_budget:
+                # Chưa vượt quá nhiều, giữ nguyên để thử tóm tắt ở lượt sau
+                return
+            # Chỉ bỏ các lượt đã được tóm tắt; lượt mới thêm trong lúc chờ vẫn giữ
+            del session.turns[:cut]
+            session.summarized_turns += len(old_turns)
+            self.compactions += 1
+        finally:
+            session.compacting = False
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "sessions": len(self._sessions),
+            "evictions": self.evictions,
+            "compactions": self.compactions,
+        }
+
+
+session_store = ChatSessionStore()
@@ -0,0 +1,296 @@
+# src/services/chunk_writer.py
+"""Bulk writers for ``document_chunks`` / ``test_material_chunks``.
+
+Chunk rows used to go through PostgREST as JSON (embeddings as float arrays),
+one small request per batch. ``CopyChunkWriter`` uses the SQLAlchemy engine
+from ``src/db.py`` instead, with one short transaction per batch:
+
+- the batch is streamed with ``COPY ... FROM STDIN`` (text format, vectors in
+  pgvector's ``[x,y,...]`` text form) into a temp staging table;
+- the staging table is merged with a single
+  ``INSERT ... ON CONFLICT (fk, chunk_index) DO UPDATE`` and committed.
+
+Like the PostgREST path, saved batches are visible to search while the rest
+of the file is still being processed, and a retried job skips them by
+``content_hash``. A pooled connection is only checked out for the duration of
+one batch write, never across embedding calls. ``finish`` deletes the stale
+tail in its own transaction.
+
+Without ``DATABASE_URL`` / psycopg2, or with ``CHUNK_WRITER=rest``, the
+PostgREST path (``RestChunkWriter``: upsert per batch) is used.
+
+Benchmark against a local Postgres with pgvector (``DATABASE_URL``)::
+
+    python -m src.services.chunk_writer 20000
+"""
+import asyncio
+import io
+import os
+import sys
+import time
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional
+
+from src.supabase_client import supabase
+
+CHUNK_WRITER = os.getenv("CHUNK_WRITER", "copy").lower()
+
+# Thứ tự cột trong COPY / INSERT
+CHUNK_COLUMNS = [
+    "user_id",
+    "chunk_index",
+    "content",
+    "content_length",
+    "content_hash",
+    "source_path",
+    "embedding_status",
+    "embedding",
+    "visibility",
+]
+_UPDATE_COLUMNS = [c for c in CHUNK_COLUMNS if c not in ("user_id", "chunk_index")]
+
+_COPY_ESCAPES = str.maketrans({"\\": "\\\\", "\t": "\\t", "\n": "\\n", "\r": "\\r"})
+
+_engine: Any = None
+_engine_error: Optional[str] = None
+
+
+def get_engine():
+    """Engine của src/db.py, hoặc None nếu không dùng được (thiếu DATABASE_URL / driver)."""
+    global _engine, _engine_error
+    if _engine is None and _engine_error is None:
+        try:
+            from src.db import engine
+
+            if engine.dialect.driver != "psycopg2":
+                raise RuntimeError(f"COPY cần psycopg2, engine dùng {engine.dialect.driver}")
+            _engine = engine
+        except Exception as e:  # RuntimeError khi thiếu DATABASE_URL, ImportError khi thiếu driver
+            _engine_error = str(e)
+            print(f"⚠️ Chunk writer: không dùng được COPY ({e}), ghi qua PostgREST")
+    return _engine
+
+
+def _copy_value(value: Any) -> str:
+    if value is None:
+        return "\\N"
+    if isinstance(value, (list, tuple)):
+        return "[" + ",".join(map(str, value)) + "]"
+    return str(value).translate(_COPY_ESCAPES)
+
+
+def copy_lines(rows: Iterable[Dict[str, Any]], columns: List[str]) -> Iterator[bytes]:
+    for row in rows:
+        yield ("\t".join(_copy_value(row.get(column)) for column in columns) + "\n").encode("utf-8")
+
+
+class _CopyStream(io.RawIOBase):
+    """File-like đọc dần từ generator (copy_expert không cần cả payload trong bộ nhớ)."""
+
+    def __init__(self, lines: Iterator[bytes]) -> None:
+        self._lines = lines
+        self._buffer = bytearray()
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, target) -> int:
+        while len(self._buffer) < len(target):
+            try:
+                self._buffer += next(self._lines)
+            except StopIteration:
+                break
+        size = min(len(target), len(self._buffer))
+        target[:size] = self._buffer[:size]
+        del self._buffer[:size]
+        return size
+
+
+class RestChunkWriter:
+    """Ghi qua PostgREST: upsert từng batch (unique fk, chunk_index)."""
+
+    kind = "rest"
+
+    def __init__(self, chunk_table: str, fk_col: str, document_id: str) -> None:
+        self.chunk_table = chunk_table
+        self.fk_col = fk_col
+        self.document_id = document_id
+        self.rows = 0
+
+    async def write(self, rows: List[Dict[str, Any]]) -> None:
+        await asyncio.to_thread(
+            lambda: supabase.table(self.chunk_table)
+            .upsert([{**row, self.fk_col: self.document_id} for row in rows], on_conflict=f"{self.fk_col},chunk_index")
+            .execute()
+        )
+        self.rows += len(rows)
+
+    async def finish(self, delete_from: Optional[int] = None) -> None:
+        """Xoá một lần mọi chunk có chunk_index >= delete_from (phần đuôi cũ đã bị bỏ)."""
+        if delete_from is None:
+            return
+        await asyncio.to_thread(
+            lambda: supabase.table(self.chunk_table)
+            .delete()
+            .eq(self.fk_col, self.document_id)
+            .gte("chunk_index", delete_from)
+            .execute()
+        )
+
+    async def abort(self) -> None:
+        return None
+
+
+def merge_copy(conn: Any, table: str, fk_col: str, rows: Iterable[Dict[str, Any]]) -> None:
+    """COPY ``rows`` vào bảng tạm rồi upsert vào ``table`` theo (fk, chunk_index); caller commit."""
+    columns = [fk_col] + CHUNK_COLUMNS
+    names = ", ".join(columns)
+    updates = ", ".join(f"{c} = EXCLUDED.{c}" for c in _UPDATE_COLUMNS)
+    with conn.cursor() as cursor:
+        cursor.execute(f"CREATE TEMP TABLE chunk_stage (LIKE {table} INCLUDING DEFAULTS) ON COMMIT DROP")
+        cursor.copy_expert(
+            f"COPY chunk_stage ({names}) FROM STDIN WITH (FORMAT text)",
+            io.BufferedReader(_CopyStream(copy_lines(rows, columns)), buffer_size=1024 * 1024),
+        )
+        cursor.execute(
+            f"INSERT INTO {table} ({names}) SELECT {names} FROM chunk_stage "
+            f"ON CONFLICT ({fk_col}, chunk_index) DO UPDATE SET {updates}"
+        )
+
+
+class CopyChunkWriter:
+    """COPY + merge mỗi batch trong một transaction ngắn (commit ngay, như upsert PostgREST)."""
+
+    kind = "copy"
+
+    def __init__(self, engine: Any, chunk_table: str, fk_col: str, document_id: str) -> None:
+        self.chunk_table = chunk_table
+        self.fk_col = fk_col
+        self.document_id = document_id
+        self.rows = 0
+        self._engine = engine
+
+    def _run(self, work: Callable[[Any], None]) -> None:
+        # Mượn connection từ pool chỉ trong lúc ghi, không giữ qua các lần gọi embed
+        conn = self._engine.raw_connection()
+        try:
+            work(conn)
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+
+    def _copy(self, rows: List[Dict[str, Any]]) -> None:
+        rows = [{**row, self.fk_col: self.document_id} for row in rows]
+        self._run(lambda conn: merge_copy(conn, f"public.{self.chunk_table}", self.fk_col, rows))
+
+    def _delete_tail(self, delete_from: int) -> None:
+        def work(conn) -> None:
+            with conn.cursor() as cursor:
+                cursor.execute(
+                    f"DELETE FROM public.{self.chunk_table} WHERE {self.fk_col} = %s AND chunk_index >= %s",
+                    (self.document_id, delete_from),
+                )
+
+        self._run(work)
+
+    async def write(self, rows: List[Dict[str, Any]]) -> None:
+        await asyncio.to_thread(self._copy, rows)
+        self.rows += len(rows)
+
+    async def finish(self, delete_from: Optional[int] = None) -> None:
+        """Xoá một lần mọi chunk có chunk_index >= delete_from (phần đuôi cũ đã bị bỏ)."""
+        if delete_from is not None:
+            await asyncio.to_thread(self._delete_tail, delete_from)
+
+    async def abort(self) -> None:
+        return None
+
+
+def open_chunk_writer(chunk_table: str, fk_col: str, document_id: str):
+    """Writer cho một tài liệu: COPY nếu có engine Postgres, ngược lại PostgREST."""
+    engine = get_engine() if CHUNK_WRITER == "copy" else None
+    if engine is not None:
+        return CopyChunkWriter(engine, chunk_table, fk_col, document_id)
+    return RestChunkWriter(chunk_table, fk_col, document_id)
+
+
+def _benchmark(total_rows: int, dimensions: int = 768, batch_rows: int = 64) -> None:
+    """COPY (bảng tạm + merge, commit mỗi batch như writer) so với INSERT nhiều dòng mỗi câu lệnh."""
+    import random
+    import uuid
+
+    engine = get_engine()
+    if engine is None:
+        print("DATABASE_URL (psycopg2 + pgvector) is required")
+        return
+    user_id = str(uuid.uuid4())
+    rows = [
+        {
+            "user_id": user_id,
+            "chunk_index": i,
+            "content": f"Bài {i}: Tính tích phân $\\int_0^1 x^{i % 5} dx$\n" * 8,
+            "content_length": 0,
+            "content_hash": None,
+            "source_path": "bench",
+            "embedding_status": "completed",
+            "embedding": [round(random.uniform(-1, 1), 6) for _ in range(dimensions)],
+            "visibility": "private",
+        }
+        for i in range(total_rows)
+    ]
+    setup = (
+        "CREATE TEMP TABLE bench_chunks (id uuid DEFAULT gen_random_uuid(), document_id uuid, user_id uuid,"
+        " chunk_index int, content text, content_length int, content_hash text, source_path text,"
+        f" embedding_status text, embedding extensions.vector({dimensions}), visibility text,"
+        " UNIQUE (document_id, chunk_index))"
+    )
+
+    def run(label: str, write) -> None:
+        conn = engine.raw_connection()
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute(setup)
+            conn.commit()
+            started = time.perf_counter()
+            write(conn)
+            elapsed = time.perf_counter() - started
+            print(f"{label:>8}: {total_rows} rows in {elapsed:.2f}s ({total_rows / elapsed:,.0f} rows/s)")
+        finally:
+            with conn.cursor() as cursor:
+                cursor.execute("DROP TABLE IF EXISTS bench_chunks")
+            conn.commit()
+            conn.close()
+
+    columns = ["document_id"] + CHUNK_COLUMNS
+    document_id = str(uuid.uuid4())
+
+    def insert(conn) -> None:
+        placeholders = "(" + ", ".join(["%s"] * len(columns)) + ")"
+        with conn.cursor() as cursor:
+            for start in range(0, total_rows, batch_rows):
+                batch = rows[start:start + batch_rows]
+                values = [
+                    tuple(_copy_value(row.get(c)) if c == "embedding" else row.get(c, document_id) for c in columns)
+                    for row in batch
+                ]
+                cursor.execute(
+                    f"INSERT INTO bench_chunks ({', '.join(columns)}) VALUES "
+                    + ", ".join([placeholders] * len(values)),
+                    [v for value in values for v in value],
+                )
+                conn.commit()
+
+    def copy(conn) -> None:
+        for start in range(0, total_rows, batch_rows):
+            batch = rows[start:start + batch_rows]
+            merge_copy(conn, "bench_chunks", "document_id", ({**row, "document_id": document_id} for row in batch))
+            conn.commit()
+
+    run("insert", insert)
+    run("copy", copy)
+
+
+if __name__ == "__main__":
+    _benchmark(int(sys.argv[1]) if len(sys.argv) > 1 else 10000)
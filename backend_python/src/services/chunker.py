@@ -0,0 +1,156 @@
+# src/services/chunker.py
+"""Structure-aware chunking for RAG ingestion.
+
+Replaces fixed 1000-char windows with 200-char overlap. Text is first cut
+into blocks at headings, numbered exercises ("Bài 3", "Câu 12", "Ví dụ 2")
+and blank lines; blocks are packed into chunks up to a token budget
+(``CHUNK_TARGET_TOKENS``, counted with the same estimator as the prompt
+assembler). A block that is too large is split at sentence boundaries, then
+at whitespace; no split ever lands inside a LaTeX span (``$...$``, ``$$...$$``,
+``\\(...\\)``, ``\\[...\\]``). A new heading / exercise starts a new chunk once
+the current one is reasonably full, so one exercise stays in one chunk.
+Overlap is only the last short sentence carried into the next chunk of the
+same section (``CHUNK_OVERLAP_TOKENS``).
+"""
+import os
+import re
+from typing import Iterable, Iterator, List, Tuple
+
+from src.services.prompt_assembler import count_tokens
+
+CHUNK_TARGET_TOKENS = int(os.getenv("CHUNK_TARGET_TOKENS", "400"))  # ~1000 ký tự như chunk_text cũ
+CHUNK_OVERLAP_TOKENS = int(os.getenv("CHUNK_OVERLAP_TOKENS", "40"))
+
+_MATH_RE = re.compile(r"\$\$.+?\$\$|\$[^$\n]+?\$|\\\(.+?\\\)|\\\[.+?\\\]", re.DOTALL)
+_SECTION_RE = re.compile(
+    r"^\s*(?:#{1,6}\s|(?:chương|chuong|phần|phan|bài|bai|câu|cau|ví dụ|vi du|dạng|dang)\s*[0-9IVXLC]+\b"
+    r"|[IVX]+\.\s)",
+    re.IGNORECASE,
+)
+_SENTENCE_END_RE = re.compile(r"(?<=[.!?;:])\s+|\n")
+
+
+def _math_spans(text: str) -> List[Tuple[int, int]]:
+    return [m.span() for m in _MATH_RE.finditer(text)]
+
+
+def _inside(pos: int, spans: List[Tuple[int, int]]) -> bool:
+    return any(start < pos < end for start, end in spans)
+
+
+def _split_at(text: str, pattern: "re.Pattern[str]") -> List[str]:
+    """Cắt ``text`` theo ``pattern`` nhưng bỏ qua các vị trí nằm trong công thức."""
+    spans = _math_spans(text)
+    pieces, last = [], 0
+    for match in pattern.finditer(text):
+        if _inside(match.start(), spans) or _inside(match.end(), spans):
+            continue
+        pieces.append(text[last:match.start()])
+        last = match.end()
+    pieces.append(text[last:])
+    return [p.strip() for p in pieces if p.strip()]
+
+
+def _split_words(text: str, budget: int) -> List[str]:
+    """Câu quá dài: cắt ở khoảng trắng ngoài công thức (công thức dài giữ nguyên)."""
+    parts: List[str] = []
+    current = ""
+    for word in _split_at(text, re.compile(r"\s+")):
+        candidate = f"{current} {word}" if current else word
+        if current and count_tokens(candidate) > budget:
+            parts.append(current)
+            current = word
+        else:
+            current = candidate
+    if current:
+        parts.append(current)
+    return parts
+
+
+def _blocks(text: str) -> List[Tuple[bool, str]]:
+    """(bắt đầu mục mới?, đoạn) theo dòng trống và tiêu đề / bài / câu."""
+    blocks: List[Tuple[bool, str]] = []
+    for paragraph in _split_at(text, re.compile(r"\n\s*\n")):
+        current: List[str] = []
+        starts = False
+        for line in paragraph.split("\n"):
+            if _SECTION_RE.match(line) and current:
+                blocks.append((starts, "\n".join(current).strip()))
+                current = []
+            if not current:
+                starts = bool(_SECTION_RE.match(line))
+            current.append(line)
+        if current:
+            blocks.append((starts, "\n".join(current).strip()))
+    return [(s, b) for s, b in blocks if b]
+
+
+def split_into_chunks(
+    text: str,
+    target_tokens: int = CHUNK_TARGET_TOKENS,
+    overlap_tokens: int = CHUNK_OVERLAP_TOKENS,
+) -> List[str]:
+    if not text or not text.strip():
+        return []
+    text = text.replace("\r\n", "\n").replace("\r", "\n")
+
+    # 1) Đơn vị nhỏ nhất: đoạn vừa ngân sách, hoặc câu / nhóm từ của đoạn quá dài
+    units: List[Tuple[bool, str]] = []
+    for starts, block in _blocks(text):
+        if count_tokens(block) <= target_tokens:
+            units.append((starts, block))
+            continue
+        first = starts
+        for sentence in _split_at(block, _SENTENCE_END_RE):
+            for piece in (
+                [sentence] if count_tokens(sentence) <= target_tokens else _split_words(sentence, target_tokens)
+            ):
+                units.append((first, piece))
+                first = False
+
+    # 2) Gom đơn vị thành chunk
+    chunks: List[str] = []
+    current: List[str] = []
+    used = 0
+    for starts, unit in units:
+        tokens = count_tokens(unit)
+        new_section = starts and used >= target_tokens * 0.6
+        if current and (used + tokens > target_tokens or new_section):
+            chunks.append("\n".join(current))
+            carry = current[-1]
+            # Overlap tối thiểu: câu cuối ngắn, chỉ khi vẫn cùng một mục
+            if not starts and count_tokens(carry) <= overlap_tokens and count_tokens(carry) + tokens <= target_tokens:
+                current, used = [carry], count_tokens(carry)
+            else:
+                current, used = [], 0
+        current.append(unit)
+        used += tokens
+    if current:
+        chunks.append("\n".join(current))
+    return chunks
+
+
+def iter_chunks(pieces: Iterable[str], target_tokens: int = CHUNK_TARGET_TOKENS) -> Iterator[str]:
+    """Chunk một luồng text (vd: từng trang PDF) với bộ nhớ cố định.
+
+    Sau mỗi mảnh, mọi chunk trừ chunk cuối được phát ra; chunk cuối có thể còn
+    tiếp ở mảnh sau nên được giữ lại và ghép với mảnh tiếp theo.
+    """
+    carry = ""
+    for piece in pieces:
+        if not piece:
+            continue
+        chunks = split_into_chunks(f"{carry}\n{piece}" if carry else piece, target_tokens=target_tokens)
+        if not chunks:
+            continue
+        yield from chunks[:-1]
+        carry = chunks[-1]
+    if carry:
+        yield carry
+
+
+def split_text(text: str, max_chars: int = 0, target_tokens: int = CHUNK_TARGET_TOKENS) -> List[str]:
+    """Như ``split_into_chunks``; ``max_chars`` (API cũ) đổi ra ngân sách token (~4 ký tự/token)."""
+    if max_chars:
+        target_tokens = max(1, max_chars // 4)
+    return split_into_chunks(text, target_tokens=target_tokens)
@@ -0,0 +1,221 @@
+# src/services/context_cache.py
+"""Context caching for large, static prompt prefixes.
+
+A prefix (system instruction + fixed blueprint text) is registered once and
+stored upstream with Gemini context caching, so each chat turn only sends the
+new message, its RAG context and history. Entries are refreshed before their
+TTL runs out by a background task.
+
+Backends:
+- ``gemini``: ``google.generativeai.caching.CachedContent`` (default).
+- ``local``: stub that folds the prefix into a plain system instruction. Used
+  for tests (``CONTEXT_CACHE_BACKEND=local``) and as the fallback whenever the
+  upstream cache cannot be created (e.g. prefix below the minimum token count).
+"""
+import asyncio
+import datetime
+import json
+import os
+import time
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional
+
+from src.ai_config import genai
+from src.services.model_registry import get_model
+
+CONTEXT_CACHE_BACKEND = os.getenv("CONTEXT_CACHE_BACKEND", "gemini").lower()
+CONTEXT_CACHE_TTL_SECONDS = int(os.getenv("CONTEXT_CACHE_TTL_SECONDS", "3600"))
+# Gia hạn khi còn ít hơn khoảng này trước khi hết hạn
+CONTEXT_CACHE_REFRESH_MARGIN_SECONDS = int(os.getenv("CONTEXT_CACHE_REFRESH_MARGIN_SECONDS", "600"))
+CONTEXT_CACHE_CHECK_INTERVAL_SECONDS = 60
+# Tạo cache upstream lỗi (lỗi tạm thời lúc khởi động...): thử lại sau khoảng này
+CONTEXT_CACHE_RETRY_SECONDS = int(os.getenv("CONTEXT_CACHE_RETRY_SECONDS", "300"))
+
+
+@dataclass
+class CachedPrefix:
+    name: str
+    model_name: str
+    system_instruction: str
+    handle: Any = None
+    expires_at: float = 0.0
+    backend: str = "local"
+    retry_at: float = 0.0
+    models: Dict[str, Any] = field(default_factory=dict)
+
+
+class LocalCacheBackend:
+    """Stub backend: không gọi API, model dùng prefix như system instruction thường."""
+
+    name = "local"
+
+    def create(self, prefix: CachedPrefix, ttl: int) -> Any:
+        return {"name": f"local/{prefix.name}"}
+
+    def refresh(self, prefix: CachedPrefix, ttl: int) -> None:
+        return None
+
+    def delete(self, prefix: CachedPrefix) -> None:
+        return None
+
+    def build_model(self, prefix: CachedPrefix, generation_config: Optional[Dict[str, Any]]):
+        return get_model(prefix.model_name, generation_config, prefix.system_instruction)
+
+
+class GeminiCacheBackend:
+    name = "gemini"
+
+    def create(self, prefix: CachedPrefix, ttl: int) -> Any:
+        from google.generativeai import caching
+
+        model_name = prefix.model_name
+        if not model_name.startswith("models/"):
+            model_name = f"models/{model_name}"
+        return caching.CachedContent.create(
+            model=model_name,
+            display_name=f"math-tutor-{prefix.name}",
+            system_instruction=prefix.system_instruction,
+            ttl=datetime.timedelta(seconds=ttl),
+        )
+
+    def refresh(self, prefix: CachedPrefix, ttl: int) -> None:
+        prefix.handle.update(ttl=datetime.timedelta(seconds=ttl))
+
+    def delete(self, prefix: CachedPrefix) -> None:
+        prefix.handle.delete()
+
+    def build_model(self, prefix: CachedPrefix, generation_config: Optional[Dict[str, Any]]):
+        return genai.GenerativeModel.from_cached_content(
+            cached_content=prefix.handle,
+            generation_config=generation_config,
+        )
+
+
+_BACKENDS = {
+    "local": LocalCacheBackend,
+    "gemini": GeminiCacheBackend,
+}
+
+
+class ContextCache:
+    def __init__(self, backend: str = CONTEXT_CACHE_BACKEND, ttl: int = CONTEXT_CACHE_TTL_SECONDS) -> None:
+        self.backend = _BACKENDS.get(backend, GeminiCacheBackend)()
+        self.fallback = LocalCacheBackend()
+        self.ttl = ttl
+        self._prefixes: Dict[str, CachedPrefix] = {}
+        self._refresher: Optional[asyncio.Task] = None
+        self.creates = 0
+        self.refreshes = 0
+        self.fallbacks = 0
+
+    def _backend_for(self, prefix: CachedPrefix):
+        return self.backend if prefix.backend == self.backend.name else self.fallback
+
+    def register(self, name: str, model_name: str, parts: List[str]) -> CachedPrefix:
+        """Đăng ký một prefix tĩnh (các đoạn được nối thành system instruction)."""
+        prefix = CachedPrefix(
+            name=name,
+            model_name=model_name,
+            system_instruction="\n\n".join(p.strip() for p in parts if p),
+        )
+        self._prefixes[name] = prefix
+        self._create(prefix)
+        return prefix
+
+    def _create(self, prefix: CachedPrefix) -> None:
+        try:
+            prefix.handle = self.backend.create(prefix, self.ttl)
+            prefix.backend = self.backend.name
+            self.creates += 1
+            print(f"✅ Context cache ready: {prefix.name} ({self.backend.name})")
+        except Exception as e:
+            print(f"⚠️ Context cache create failed for {prefix.name}, using local prefix: {e}")
+            prefix.handle = self.fallback.create(prefix, self.ttl)
+            prefix.backend = self.fallback.name
+            prefix.retry_at = time.time() + CONTEXT_CACHE_RETRY_SECONDS
+            self.fallbacks += 1
+        prefix.expires_at = time.time() + self.ttl
+        prefix.models.clear()
+
+    def refresh(self, name: str) -> None:
+        """Gia hạn TTL; nếu gia hạn lỗi (cache đã bị xoá) thì tạo lại.
+
+        Prefix đang dùng fallback local thì thử tạo lại cache upstream.
+        """
+        prefix = self._prefixes[name]
+        if prefix.backend != self.backend.name:
+            self._create(prefix)
+            return
+        try:
+            self._backend_for(prefix).refresh(prefix, self.ttl)
+            prefix.expires_at = time.time() + self.ttl
+            self.refreshes += 1
+        except Exception as e:
+            print(f"⚠️ Context cache refresh failed for {name}, recreating: {e}")
+            self._create(prefix)
+
+    def refresh_due(self) -> None:
+        now = time.time()
+        for name, prefix in list(self._prefixes.items()):
+            retry = prefix.backend != self.backend.name and now >= prefix.retry_at
+            if retry or prefix.expires_at - now <= CONTEXT_CACHE_REFRESH_MARGIN_SECONDS:
+                self.refresh(name)
+
+    def get_model(self, name: str, generation_config: Optional[Dict[str, Any]] = None):
+        """Model dùng prefix đã cache. Nếu cache lỡ hết hạn thì dùng prefix local cho request này."""
+        prefix = self._prefixes[name]
+        if prefix.expires_at <= time.time():
+            self.fallbacks += 1
+            return self.fallback.build_model(prefix, generation_config)
+
+        key = json.dumps(generation_config or {}, sort_keys=True)
+        model = prefix.models.get(key)
+        if model is None:
+            try:
+                model = self._backend_for(prefix).build_model(prefix, generation_config)
+            except Exception as e:
+                print(f"⚠️ Cannot build cached model for {name}: {e}")
+                self.fallbacks += 1
+                return self.fallback.build_model(prefix, generation_config)
+            prefix.models[key] = model
+        return model
+
+    async def _refresh_loop(self) -> None:
+        while True:
+            await asyncio.sleep(CONTEXT_CACHE_CHECK_INTERVAL_SECONDS)
+            try:
+                await asyncio.to_thread(self.refresh_due)
+            except Exception as e:
+                print(f"⚠️ Context cache refresher error: {e}")
+
+    def start_refresher(self) -> None:
+        if self._refresher is None or self._refresher.done():
+            self._refresher = asyncio.create_task(self._refresh_loop())
+
+    def close(self) -> None:
+        if self._refresher:
+            self._refresher.cancel()
+        for prefix in self._prefixes.values():
+            try:
+                self._backend_for(prefix).delete(prefix)
+            except Exception as e:
+                print(f"⚠️ Context cache delete failed for {prefix.name}: {e}")
+
+    def stats(self) -> Dict[str, Any]:
+        now = time.time()
+        return {
+            "backend": self.backend.name,
+            "creates": self.creates,
+            "refreshes": self.refreshes,
+            "fallbacks": self.fallbacks,
+            "prefixes": {
+                name: {
+                    "backend": p.backend,
+                    "expires_in": max(0, int(p.expires_at - now)),
+                }
+                for name, p in self._prefixes.items()
+            },
+        }
+
+
+context_cache = ContextCache()
@@ -0,0 +1,227 @@
+# src/services/embedding_cache.py
+"""Content-addressed embedding cache.
+
+Key: (model, task_type, sha256(text)). Two tiers:
+
+- an in-memory LRU (``EMBED_CACHE_MEMORY_ITEMS`` vectors);
+- a local SQLite file (``EMBED_CACHE_PATH``) that survives restarts and is
+  shared by every worker on the machine. Rows carry a ``last_used`` stamp and
+  the oldest are evicted once the table grows past ``EMBED_CACHE_MAX_ROWS``.
+
+Vectors are stored as float32 blobs. SQLite work runs in a thread so lookups
+never block the event loop. If the file cannot be opened (read-only disk) the
+cache keeps working memory-only.
+"""
+import asyncio
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from array import array
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+EMBED_CACHE_ENABLED = os.getenv("EMBED_CACHE_ENABLED", "true").lower() == "true"
+EMBED_CACHE_PATH = os.getenv(
+    "EMBED_CACHE_PATH",
+    str(Path(__file__).resolve().parent.parent.parent / "cache" / "embeddings.sqlite3"),
+)
+EMBED_CACHE_MEMORY_ITEMS = int(os.getenv("EMBED_CACHE_MEMORY_ITEMS", "20000"))
+EMBED_CACHE_MAX_ROWS = int(os.getenv("EMBED_CACHE_MAX_ROWS", "500000"))
+
+CacheKey = Tuple[str, str, str]  # (model, task_type, sha256)
+
+
+def text_hash(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def _pack(vector: Sequence[float]) -> bytes:
+    return array("f", vector).tobytes()
+
+
+def _unpack(blob: bytes) -> List[float]:
+    values = array("f")
+    values.frombytes(blob)
+    return values.tolist()
+
+
+class EmbeddingCache:
+    def __init__(
+        self,
+        path: str = EMBED_CACHE_PATH,
+        memory_items: int = EMBED_CACHE_MEMORY_ITEMS,
+        max_rows: int = EMBED_CACHE_MAX_ROWS,
+    ) -> None:
+        self.path = path
+        self.memory_items = memory_items
+        self.max_rows = max_rows
+        self._memory: "OrderedDict[CacheKey, List[float]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._conn: Optional[sqlite3.Connection] = None
+        self._opened = False
+        self._rows = 0
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.writes = 0
+        self.evictions = 0
+
+    # ----- SQLite tier (chạy trong thread) -----
+
+    def _connect(self) -> Optional[sqlite3.Connection]:
+        if self._opened:
+            return self._conn
+        self._opened = True
+        try:
+            Path(self.path).parent.mkdir(parents=True, exist_ok=True)
+            conn = sqlite3.connect(self.path, check_same_thread=False, timeout=10)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(
+                """CREATE TABLE IF NOT EXISTS embeddings (
+                    model TEXT NOT NULL,
+                    task_type TEXT NOT NULL,
+                    text_hash TEXT NOT NULL,
+                    vector BLOB NOT NULL,
+                    last_used REAL NOT NULL,
+                    PRIMARY KEY (model, task_type, text_hash)
+                )"""
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS embeddings_last_used ON embeddings (last_used)")
+            conn.commit()
+            self._rows = conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+            self._conn = conn
+            print(f"🧮 Embedding cache: {self.path} ({self._rows} vectors)")
+        except sqlite3.Error as e:
+            print(f"⚠️ Không mở được embedding cache {self.path}, chỉ dùng bộ nhớ: {e}")
+            self._conn = None
+        return self._conn
+
+    def _disk_get(self, keys: List[CacheKey]) -> Dict[CacheKey, List[float]]:
+        found: Dict[CacheKey, List[float]] = {}
+        with self._lock:
+            conn = self._connect()
+            if conn is None or not keys:
+                return found
+            now = time.time()
+            try:
+                for model, task_type, digest in keys:
+                    row = conn.execute(
+                        "SELECT vector FROM embeddings WHERE model = ? AND task_type = ? AND text_hash = ?",
+                        (model, task_type, digest),
+                    ).fetchone()
+                    if row:
+                        found[(model, task_type, digest)] = _unpack(row[0])
+                if found:
+                    conn.executemany(
+                        "UPDATE embeddings SET last_used = ? WHERE model = ? AND task_type = ? AND text_hash = ?",
+                        [(now, *key) for key in found],
+                    )
+                    conn.commit()
+            except sqlite3.Error as e:
+                print(f"⚠️ Embedding cache read error: {e}")
+        return found
+
+    def _disk_put(self, items: List[Tuple[CacheKey, List[float]]]) -> None:
+        with self._lock:
+            conn = self._connect()
+            if conn is None or not items:
+                return
+            now = time.time()
+            try:
+                before = conn.total_changes
+                conn.executemany(
+                    "INSERT OR IGNORE INTO embeddings (model, task_type, text_hash, vector, last_used) "
+                    "VALUES (?, ?, ?, ?, ?)",
+                    [(*key, _pack(vector), now) for key, vector in items],
+                )
+                self._rows += conn.total_changes - before
+                self.writes += conn.total_changes - before
+                if self._rows > self.max_rows:
+                    # Xoá ~10% bản ghi ít dùng nhất để không phải dọn mỗi lần ghi
+                    excess = self._rows - int(self.max_rows * 0.9)
+                    conn.execute(
+                        "DELETE FROM embeddings WHERE rowid IN "
+                        "(SELECT rowid FROM embeddings ORDER BY last_used LIMIT ?)",
+                        (excess,),
+                    )
+                    self._rows -= excess
+                    self.evictions += excess
+                conn.commit()
+            except sqlite3.Error as e:
+                print(f"⚠️ Embedding cache write error: {e}")
+
+    # ----- memory tier -----
+
+    def _remember(self, key: CacheKey, vector: List[float]) -> None:
+        self._memory[key] = vector
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_items:
+            self._memory.popitem(last=False)
+
+    # ----- API -----
+
+    async def get_many(self, model: str, task_type: str, texts: List[str]) -> List[Optional[List[float]]]:
+        """Tra cache cho từng text; phần tử None là miss."""
+        keys = [(model, task_type, text_hash(t)) for t in texts]
+        results: List[Optional[List[float]]] = [None] * len(texts)
+        disk_lookup: List[CacheKey] = []
+        for i, key in enumerate(keys):
+            vector = self._memory.get(key)
+            if vector is not None:
+                self._memory.move_to_end(key)
+                results[i] = vector
+                self.memory_hits += 1
+            else:
+                disk_lookup.append(key)
+
+        if disk_lookup:
+            found = await asyncio.to_thread(self._disk_get, list(dict.fromkeys(disk_lookup)))
+            for i, key in enumerate(keys):
+                if results[i] is not None:
+                    continue
+                vector = found.get(key)
+                if vector is not None:
+                    results[i] = vector
+                    self._remember(key, vector)
+                    self.disk_hits += 1
+                else:
+                    self.misses += 1
+        return results
+
+    async def put_many(self, model: str, task_type: str, texts: List[str], vectors: List[List[float]]) -> None:
+        items = []
+        for text, vector in zip(texts, vectors):
+            if not vector:
+                continue
+            key = (model, task_type, text_hash(text))
+            self._remember(key, vector)
+            items.append((key, vector))
+        if items:
+            await asyncio.to_thread(self._disk_put, items)
+
+    def close(self) -> None:
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.memory_hits + self.disk_hits + self.misses
+        return {
+            "enabled": EMBED_CACHE_ENABLED,
+            "memory_items": len(self._memory),
+            "disk_rows": self._rows,
+            "memory_hits": self.memory_hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_ratio": round((self.memory_hits + self.disk_hits) / lookups, 3) if lookups else 0.0,
+            "writes": self.writes,
+            "evictions": self.evictions,
+        }
+
+
+embedding_cache = EmbeddingCache()
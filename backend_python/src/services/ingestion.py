@@ -0,0 +1,152 @@
+# src/services/ingestion.py
+"""Streaming building blocks for document ingestion.
+
+``process_document`` used to hold the whole file, the whole extracted text and
+the whole chunk list in memory before embedding anything. The pipeline here is
+
+    storage --(stream)--> temp file --(page)--> text --> chunks
+        --> batches --(bounded queue)--> embed --> insert
+
+Extraction runs in a worker thread and hands chunk batches to the event loop
+through a queue of ``INGEST_QUEUE_BATCHES``; when embedding / inserting is
+slower, the producer blocks (backpressure), so peak memory is a few batches,
+not the document. Each batch is inserted as soon as it is embedded, so the
+first pages are searchable while the rest is still being processed.
+"""
+import asyncio
+import os
+import tempfile
+import threading
+from typing import Any, Awaitable, Callable, Iterable, Iterator, List, Tuple
+
+import httpx
+
+from src.services.chunker import iter_chunks
+from src.supabase_client import supabase
+from src.utils.file_utils import count_file_units, iter_file_text
+
+STORAGE_BUCKET = "mathmentor-materials"
+INGEST_BATCH_CHUNKS = int(os.getenv("INGEST_BATCH_CHUNKS", "64"))
+INGEST_QUEUE_BATCHES = int(os.getenv("INGEST_QUEUE_BATCHES", "2"))
+INGEST_DOWNLOAD_CHUNK_BYTES = 1024 * 1024
+SIGNED_URL_TTL_SECONDS = 600
+
+_DONE = object()
+
+
+def _signed_url(bucket: str, path: str) -> str:
+    result = supabase.storage.from_(bucket).create_signed_url(path, SIGNED_URL_TTL_SECONDS)
+    url = (result.get("signedURL") or result.get("signedUrl")) if isinstance(result, dict) else None
+    if not url:
+        raise ValueError(f"Không tạo được signed URL cho {path}")
+    return url
+
+
+def download_to_tempfile(bucket: str, path: str, suffix: str = "") -> str:
+    """Stream file từ Storage xuống file tạm (từng MB), trả về đường dẫn file tạm.
+
+    Nếu không tạo được signed URL thì tải cả file như cũ rồi ghi ra đĩa.
+    """
+    fd, tmp_path = tempfile.mkstemp(suffix=suffix, prefix="ingest-")
+    try:
+        with os.fdopen(fd, "wb") as out:
+            try:
+                url = _signed_url(bucket, path)
+            except Exception as e:
+                print(f"⚠️ Signed URL lỗi, tải cả file: {e}")
+                out.write(supabase.storage.from_(bucket).download(path))
+                return tmp_path
+            with httpx.stream("GET", url, timeout=60.0, follow_redirects=True) as response:
+                response.raise_for_status()
+                for block in response.iter_bytes(INGEST_DOWNLOAD_CHUNK_BYTES):
+                    out.write(block)
+        return tmp_path
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+def iter_chunk_batches(pieces: Iterable[str], batch_size: int = INGEST_BATCH_CHUNKS) -> Iterator[List[str]]:
+    batch: List[str] = []
+    for chunk in iter_chunks(pieces):
+        batch.append(chunk)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+class _CountingIterator:
+    """Đếm số mảnh (trang, khối text) đã đọc để báo tiến độ."""
+
+    def __init__(self, pieces: Iterable[str]) -> None:
+        self._pieces = iter(pieces)
+        self.count = 0
+
+    def __iter__(self) -> "_CountingIterator":
+        return self
+
+    def __next__(self) -> str:
+        piece = next(self._pieces)
+        self.count += 1
+        return piece
+
+
+def iter_document_batches(file_path: str, extension: str) -> Iterator[Tuple[List[str], float]]:
+    """file -> từng trang text -> chunk -> batch (đồng bộ, chạy trong thread).
+
+    Mỗi batch kèm tỉ lệ phần file đã đọc (0..1) để báo tiến độ.
+    """
+    try:
+        units_total = count_file_units(file_path, extension)
+    except Exception:
+        units_total = 0
+    pieces = _CountingIterator(iter_file_text(file_path, extension))
+    for batch in iter_chunk_batches(pieces):
+        yield batch, min(1.0, pieces.count / units_total) if units_total else 0.0
+
+
+async def run_pipeline(
+    batches: Iterator[Any],
+    handle: Callable[[Any], Awaitable[Any]],
+    max_pending: int = INGEST_QUEUE_BATCHES,
+) -> None:
+    """Sinh batch trong thread, xử lý tuần tự trên event loop qua hàng đợi có giới hạn."""
+    loop = asyncio.get_running_loop()
+    queue: "asyncio.Queue[Any]" = asyncio.Queue(maxsize=max_pending)
+    stop = threading.Event()
+
+    def put(item: Any) -> None:
+        # Chặn thread sản xuất khi hàng đợi đầy (backpressure)
+        asyncio.run_coroutine_threadsafe(queue.put(item), loop).result()
+
+    def produce() -> None:
+        try:
+            for batch in batches:
+                if stop.is_set():
+                    return
+                put(batch)
+        except Exception as e:
+            put(e)
+        finally:
+            put(_DONE)
+
+    producer = asyncio.ensure_future(asyncio.to_thread(produce))
+    try:
+        while True:
+            item = await queue.get()
+            if item is _DONE:
+                break
+            if isinstance(item, Exception):
+                raise item
+            await handle(item)
+    finally:
+        stop.set()
+        # Xả hàng đợi để thread sản xuất không bị kẹt ở put()
+        while not producer.done():
+            try:
+                queue.get_nowait()
+            except asyncio.QueueEmpty:
+                await asyncio.sleep(0.01)
+        await producer
@@ -0,0 +1,214 @@
+# src/services/ingestion_jobs.py
+"""Durable job queue for document ingestion (table ``ingestion_jobs``).
+
+``/api/process-document`` only enqueues a row and returns its id. Workers in
+this process claim jobs through the ``claim_ingestion_job`` RPC
+(``FOR UPDATE SKIP LOCKED``, safe with several app instances), run
+``rag_service.ingest_document`` and write progress (chunks done, fraction of
+the file read) back to the row. While a job runs, a timer refreshes
+``locked_at`` every ``INGEST_HEARTBEAT_SECONDS`` (independent of batch
+progress, so a slow page range or embedding call does not look like a dead
+worker).
+
+- A failed attempt is re-queued with exponential backoff until
+  ``max_attempts``; then the job and the document are marked failed.
+- A job whose worker died stays ``running`` with a stale ``locked_at``; the
+  claim RPC hands it to another worker after ``INGEST_JOB_STALE_SECONDS``, or
+  marks it failed if that was its last attempt;
+  chunks already saved (every batch is committed as it is written) match by
+  ``content_hash`` and are not embedded again.
+"""
+import asyncio
+import os
+import socket
+import uuid
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, List, Optional
+
+from src.services import rag_service
+from src.supabase_client import supabase
+
+INGEST_WORKERS = int(os.getenv("INGEST_WORKERS", "2"))
+INGEST_JOB_MAX_ATTEMPTS = int(os.getenv("INGEST_JOB_MAX_ATTEMPTS", "3"))
+INGEST_JOB_STALE_SECONDS = int(os.getenv("INGEST_JOB_STALE_SECONDS", "300"))
+INGEST_POLL_SECONDS = float(os.getenv("INGEST_POLL_SECONDS", "5"))
+INGEST_HEARTBEAT_SECONDS = float(os.getenv("INGEST_HEARTBEAT_SECONDS", str(INGEST_JOB_STALE_SECONDS / 5)))
+INGEST_RETRY_BASE_SECONDS = 30
+
+JOBS_TABLE = "ingestion_jobs"
+ACTIVE_STATUSES = ["queued", "running"]
+FINAL_STATUSES = {"completed", "failed"}
+
+
+def _now() -> datetime:
+    return datetime.now(timezone.utc)
+
+
+class IngestionJobQueue:
+    def __init__(self, workers: int = INGEST_WORKERS) -> None:
+        self.workers = workers
+        self.worker_id = f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:6]}"
+        self._tasks: List["asyncio.Task[None]"] = []
+        self._wakeup: Optional[asyncio.Event] = None
+        self.completed = 0
+        self.failed = 0
+        self.retried = 0
+
+    # ----- DB helpers (chạy trong thread) -----
+
+    @staticmethod
+    async def _update(job_id: str, fields: Dict[str, Any]) -> None:
+        await asyncio.to_thread(lambda: supabase.table(JOBS_TABLE).update(fields).eq("id", job_id).execute())
+
+    async def _claim(self) -> Optional[Dict[str, Any]]:
+        response = await asyncio.to_thread(
+            lambda: supabase.rpc(
+                "claim_ingestion_job",
+                {"p_worker": self.worker_id, "p_stale_seconds": INGEST_JOB_STALE_SECONDS},
+            ).execute()
+        )
+        return response.data[0] if response.data else None
+
+    # ----- API -----
+
+    async def enqueue(self, user_id: str, document_id: str, purpose: str = "chat") -> Dict[str, Any]:
+        """Tạo job (hoặc trả về job đang chờ/chạy của cùng tài liệu)."""
+        existing = await asyncio.to_thread(
+            lambda: supabase.table(JOBS_TABLE)
+            .select("*")
+            .eq("document_id", document_id)
+            .in_("status", ACTIVE_STATUSES)
+            .limit(1)
+            .execute()
+        )
+        if existing.data:
+            return existing.data[0]
+
+        response = await asyncio.to_thread(
+            lambda: supabase.table(JOBS_TABLE)
+            .insert({
+                "user_id": user_id,
+                "document_id": document_id,
+                "purpose": purpose,
+                "max_attempts": INGEST_JOB_MAX_ATTEMPTS,
+            })
+            .execute()
+        )
+        await rag_service.mark_document_status(document_id, purpose, "processing")
+        if self._wakeup:
+            self._wakeup.set()
+        return response.data[0]
+
+    async def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        response = await asyncio.to_thread(
+            lambda: supabase.table(JOBS_TABLE).select("*").eq("id", job_id).limit(1).execute()
+        )
+        return response.data[0] if response.data else None
+
+    # ----- worker -----
+
+    async def _heartbeat(self, job_id: str) -> None:
+        """Làm mới locked_at định kỳ trong lúc job chạy (kể cả khi một batch mất nhiều phút)."""
+        while True:
+            await asyncio.sleep(INGEST_HEARTBEAT_SECONDS)
+            try:
+                await asyncio.to_thread(
+                    lambda: supabase.table(JOBS_TABLE)
+                    .update({"locked_at": _now().isoformat()})
+                    .eq("id", job_id)
+                    .eq("locked_by", self.worker_id)
+                    .execute()
+                )
+            except Exception as e:
+                print(f"⚠️ Ingestion job {job_id}: heartbeat lỗi: {e}")
+
+    async def _ingest(self, job: Dict[str, Any], progress: rag_service.ProgressCallback) -> int:
+        heartbeat = asyncio.create_task(self._heartbeat(job["id"]))
+        try:
+            return await rag_service.ingest_document(
+                job["user_id"], job["document_id"], job["purpose"], progress=progress
+            )
+        finally:
+            heartbeat.cancel()
+
+    async def _run(self, job: Dict[str, Any]) -> None:
+        job_id = job["id"]
+        print(f"📥 Ingestion job {job_id} (lần {job['attempts']}/{job['max_attempts']})")
+
+        async def report(chunks_done: int, fraction: float) -> None:
+            await self._update(job_id, {"chunks_done": chunks_done, "progress": round(fraction, 4)})
+
+        try:
+            total = await self._ingest(job, report)
+        except Exception as e:
+            print(f"❌ Ingestion job {job_id} lỗi: {e}")
+            if job["attempts"] >= job["max_attempts"]:
+                self.failed += 1
+                await self._update(job_id, {"status": "failed", "last_error": str(e)[:1000], "locked_by": None})
+                await rag_service.mark_document_status(job["document_id"], job["purpose"], "failed")
+            else:
+                self.retried += 1
+                delay = INGEST_RETRY_BASE_SECONDS * (2 ** (job["attempts"] - 1))
+                await self._update(job_id, {
+                    "status": "queued",
+                    "last_error": str(e)[:1000],
+                    "locked_by": None,
+                    "run_after": (_now() + timedelta(seconds=delay)).isoformat(),
+                })
+            return
+
+        self.completed += 1
+        await self._update(job_id, {
+            "status": "completed",
+            "chunks_done": total,
+            "chunks_total": total,
+            "progress": 1,
+            "last_error": None,
+            "locked_by": None,
+        })
+        print(f"✅ Ingestion job {job_id}: {total} chunks")
+
+    async def _worker(self) -> None:
+        while True:
+            try:
+                job = await self._claim()
+            except Exception as e:
+                print(f"⚠️ Không lấy được ingestion job: {e}")
+                job = None
+            if job is None:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=INGEST_POLL_SECONDS)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            try:
+                await self._run(job)
+            except Exception as e:
+                # Lỗi khi ghi trạng thái: job sẽ được lấy lại khi locked_at quá hạn
+                print(f"⚠️ Ingestion job {job['id']} không cập nhật được trạng thái: {e}")
+
+    def start(self) -> None:
+        if self._tasks:
+            return
+        self._wakeup = asyncio.Event()
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+        print(f"📥 Ingestion workers: {self.workers} ({self.worker_id})")
+
+    async def stop(self) -> None:
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "workers": len(self._tasks),
+            "worker_id": self.worker_id,
+            "completed": self.completed,
+            "failed": self.failed,
+            "retried": self.retried,
+        }
+
+
+ingestion_jobs = IngestionJobQueue()
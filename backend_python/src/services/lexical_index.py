@@ -0,0 +1,174 @@
+# src/services/lexical_index.py
+"""Lexical side of hybrid RAG retrieval (BM25 + vector, fused and reranked).
+
+- ``tokenize`` folds Vietnamese diacritics (students often type without
+  them), adds syllable bigrams (``dao_ham`` for "đạo hàm") and keeps LaTeX
+  commands / powers as their own tokens (``\\int``, ``x^2``), with a few
+  aliases so "tích phân" also matches a chunk that only contains ``\\int``.
+- ``BM25Index`` is an incremental inverted index over chunk content.
+- ``hybrid_rank`` fuses the vector ranking and the BM25 ranking with
+  reciprocal-rank fusion, then reranks by query-term coverage and keeps only
+  chunks close to the best score, so the prompt gets fewer, more relevant
+  chunks instead of always ``limit`` of them.
+"""
+import math
+import os
+import re
+import unicodedata
+from collections import Counter
+from typing import Dict, List, Sequence, Set, Tuple
+
+RAG_HYBRID = os.getenv("RAG_HYBRID", "true").lower() == "true"
+RAG_CANDIDATE_FACTOR = int(os.getenv("RAG_CANDIDATE_FACTOR", "4"))
+RAG_CANDIDATE_THRESHOLD = float(os.getenv("RAG_CANDIDATE_THRESHOLD", "0.3"))
+RAG_RERANK_MIN_RATIO = float(os.getenv("RAG_RERANK_MIN_RATIO", "0.5"))
+
+RRF_K = 60
+BM25_K1 = 1.5
+BM25_B = 0.75
+
+_LATEX_RE = re.compile(r"\\([a-zA-Z]+)")
+_POWER_RE = re.compile(r"([a-z0-9])\s*\^\s*\{?\s*([a-z0-9+\-]+)\s*\}?")
+_WORD_RE = re.compile(r"[a-z0-9]+")
+
+# Lệnh LaTeX -> từ tiếng Việt (đã bỏ dấu) để câu hỏi bằng lời khớp được công thức
+FORMULA_ALIASES = {
+    "int": "tich phan",
+    "iint": "tich phan",
+    "lim": "gioi han",
+    "log": "logarit",
+    "ln": "logarit",
+    "sqrt": "can",
+    "sum": "tong",
+    "vec": "vecto",
+    "overrightarrow": "vecto",
+    "sin": "luong giac",
+    "cos": "luong giac",
+    "tan": "luong giac",
+}
+
+# Hư từ phổ biến (đã bỏ dấu)
+STOPWORDS = {
+    "va", "la", "cua", "cho", "cac", "mot", "nhung", "voi", "trong", "nay", "do", "thi",
+    "duoc", "de", "khi", "neu", "nhu", "tai", "tu", "ra", "vao", "len", "ve", "hay",
+    "em", "toi", "ban", "minh", "giup", "lam", "sao", "gi", "nao", "a", "oi", "nhe",
+}
+
+
+def fold(text: str) -> str:
+    """Chữ thường + bỏ dấu tiếng Việt (đ -> d)."""
+    text = unicodedata.normalize("NFD", (text or "").lower()).replace("đ", "d")
+    return "".join(c for c in text if not unicodedata.combining(c))
+
+
+def tokenize(text: str) -> List[str]:
+    folded = fold(text)
+    tokens: List[str] = []
+    for match in _LATEX_RE.finditer(folded):
+        command = match.group(1)
+        tokens.append("\\" + command)
+        alias = FORMULA_ALIASES.get(command)
+        if alias:
+            words = alias.split()
+            tokens.extend(words)
+            if len(words) > 1:
+                tokens.append("_".join(words))
+    tokens.extend(f"{base}^{exp}" for base, exp in _POWER_RE.findall(folded))
+
+    words = [w for w in _WORD_RE.findall(_LATEX_RE.sub(" ", folded)) if w not in STOPWORDS]
+    tokens.extend(words)
+    # Từ tiếng Việt thường gồm 2 âm tiết: thêm bigram để "dao ham" khớp chặt hơn "dao" + "ham"
+    tokens.extend(f"{a}_{b}" for a, b in zip(words, words[1:]))
+    return tokens
+
+
+def _terms(tokens: Sequence[str]) -> Set[str]:
+    """Thuật ngữ dùng để đo độ phủ: bỏ bigram, giữ từ và token công thức."""
+    return {t for t in tokens if "_" not in t}
+
+
+class BM25Index:
+    def __init__(self) -> None:
+        self._postings: Dict[str, List[Tuple[int, int]]] = {}
+        self._lengths: List[int] = []
+        self._total_length = 0
+
+    def __len__(self) -> int:
+        return len(self._lengths)
+
+    def add(self, texts: Sequence[str]) -> None:
+        for text in texts:
+            doc_id = len(self._lengths)
+            counts = Counter(tokenize(text))
+            for term, tf in counts.items():
+                self._postings.setdefault(term, []).append((doc_id, tf))
+            length = sum(counts.values())
+            self._lengths.append(length)
+            self._total_length += length
+
+    def scores(self, query_tokens: Sequence[str]) -> Dict[int, float]:
+        n = len(self._lengths)
+        if not n:
+            return {}
+        avgdl = self._total_length / n or 1.0
+        scores: Dict[int, float] = {}
+        for term in set(query_tokens):
+            postings = self._postings.get(term)
+            if not postings:
+                continue
+            idf = math.log(1 + (n - len(postings) + 0.5) / (len(postings) + 0.5))
+            for doc_id, tf in postings:
+                norm = tf + BM25_K1 * (1 - BM25_B + BM25_B * self._lengths[doc_id] / avgdl)
+                scores[doc_id] = scores.get(doc_id, 0.0) + idf * tf * (BM25_K1 + 1) / norm
+        return scores
+
+    def search(self, query_tokens: Sequence[str], k: int) -> List[int]:
+        scores = self.scores(query_tokens)
+        return sorted(scores, key=scores.get, reverse=True)[:k]
+
+
+def rrf_fuse(rankings: Sequence[Sequence[int]], k: int = RRF_K) -> Dict[int, float]:
+    fused: Dict[int, float] = {}
+    for ranking in rankings:
+        for rank, doc_id in enumerate(ranking):
+            fused[doc_id] = fused.get(doc_id, 0.0) + 1.0 / (k + rank + 1)
+    return fused
+
+
+def hybrid_rank(
+    query_tokens: Sequence[str],
+    texts: Dict[int, str],
+    vector_ranking: Sequence[int],
+    lexical_ranking: Sequence[int],
+    limit: int,
+    min_ratio: float = RAG_RERANK_MIN_RATIO,
+) -> List[int]:
+    """RRF(vector, BM25) rồi rerank theo độ phủ thuật ngữ câu hỏi; trả về id đã chọn."""
+    fused = rrf_fuse([vector_ranking, lexical_ranking])
+    if not fused:
+        return []
+    best_fused = max(fused.values())
+    query_terms = _terms(query_tokens)
+
+    final: Dict[int, float] = {}
+    for doc_id, score in fused.items():
+        coverage = 0.0
+        if query_terms:
+            coverage = len(query_terms & _terms(tokenize(texts[doc_id]))) / len(query_terms)
+        final[doc_id] = 0.6 * score / best_fused + 0.4 * coverage
+
+    ordered = sorted(final, key=final.get, reverse=True)
+    cutoff = final[ordered[0]] * min_ratio
+    return [doc_id for doc_id in ordered[:limit] if final[doc_id] >= cutoff]
+
+
+def rerank_documents(query: str, docs: List[Dict], limit: int, content_key: str = "content") -> List[Dict]:
+    """Hybrid rerank cho ứng viên đã có sẵn (vd: kết quả RPC theo thứ tự cosine)."""
+    if not docs:
+        return []
+    query_tokens = tokenize(query)
+    texts = {i: doc.get(content_key) or "" for i, doc in enumerate(docs)}
+    lexical = BM25Index()
+    lexical.add([texts[i] for i in range(len(docs))])
+    chosen = hybrid_rank(query_tokens, texts, list(range(len(docs))), lexical.search(query_tokens, len(docs)), limit)
+    return [docs[i] for i in chosen]
@@ -0,0 +1,324 @@
+# src/services/llm_gateway.py
+"""Single entry point for every Gemini call.
+
+- ``generate`` awaits ``model.generate_content_async`` (native asyncio), so a
+  slow generation never holds the event loop.
+- ``run_blocking`` is for SDK calls that only exist in a sync form
+  (``upload_file``, ``embed_content``, ``File.delete``). They run on a
+  dedicated executor bounded by ``LLM_EXECUTOR_WORKERS``, separate from the
+  default executor used by ``asyncio.to_thread`` for file I/O, so a burst of
+  uploads cannot starve the rest of the app.
+- ``call`` wraps any other awaitable (chat sessions, genkit prompts).
+
+Every call is admitted by ``rate_limiter`` first (token bucket shared with
+the rest of the process, priority class per call site) and retried there on
+upstream 429s. On top of that the gateway adds:
+
+- a deadline per upstream attempt (``LLM_TIMEOUT_SECONDS`` or a per-endpoint
+  default), started once the limiter admits the call, so queueing and 429
+  backoff do not eat into it; expiry raises ``LLMTimeout`` (HTTP 504). A sync
+  call that times out keeps its executor thread until the SDK returns, only
+  the caller stops waiting. Giving up in the local queue (``QueueTimeout``)
+  is counted separately and never trips the breaker.
+- a circuit breaker per endpoint (embeddings: ``embed-ingest`` for background
+  ingestion and ``embed-query`` for searches, so a failing ingestion burst
+  does not block queries): after ``LLM_BREAKER_FAILURES`` consecutive
+  upstream failures the endpoint fails fast with ``LLMUnavailable`` (HTTP 503)
+  for ``LLM_BREAKER_COOLDOWN_SECONDS``, then lets one probe through.
+- optional hedging for cheap idempotent calls: if the first attempt is slower
+  than the endpoint's recent p95, a duplicate is started and the first result
+  wins.
+
+Per-endpoint counters (calls, errors, timeouts, queue timeouts, hedges,
+in-flight, latency)
+are exposed through ``/api/metrics``.
+"""
+import asyncio
+import functools
+import math
+import os
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import Any, Awaitable, Callable, Deque, Dict, Optional
+
+from fastapi import HTTPException
+
+from src.services.rate_limiter import GENERATION, QueueTimeout, UpstreamRateLimited, rate_limiter
+
+LLM_EXECUTOR_WORKERS = int(os.getenv("LLM_EXECUTOR_WORKERS", "8"))
+LLM_TIMEOUT_SECONDS = float(os.getenv("LLM_TIMEOUT_SECONDS", "90"))
+LLM_BREAKER_FAILURES = int(os.getenv("LLM_BREAKER_FAILURES", "5"))
+LLM_BREAKER_COOLDOWN_SECONDS = float(os.getenv("LLM_BREAKER_COOLDOWN_SECONDS", "30"))
+LLM_HEDGE_DELAY_SECONDS = float(os.getenv("LLM_HEDGE_DELAY_SECONDS", "1.5"))
+
+# Deadline mặc định theo endpoint (giây); endpoint khác dùng LLM_TIMEOUT_SECONDS
+ENDPOINT_TIMEOUTS = {
+    "embed-ingest": 15.0,
+    "embed-query": 15.0,
+    "chat": 60.0,
+    "chat-stream": 30.0,  # chỉ tính tới lúc stream mở
+    "chat-summary": 30.0,
+    "media-upload": 60.0,
+    "audio-upload": 60.0,
+    "audio-delete": 15.0,
+    "generate-test": 180.0,
+    "generate-adaptive-test": 180.0,
+}
+
+_LATENCY_WINDOW = 200
+_HEDGE_MIN_SAMPLES = 20
+
+
+class LLMTimeout(HTTPException):
+    def __init__(self, endpoint: str, timeout: float) -> None:
+        super().__init__(status_code=504, detail=f"Gemini ({endpoint}) không phản hồi sau {timeout:.0f}s")
+
+
+class LLMUnavailable(HTTPException):
+    def __init__(self, endpoint: str, retry_after: float) -> None:
+        retry_after = max(1, math.ceil(retry_after))
+        super().__init__(
+            status_code=503,
+            detail=f"Gemini ({endpoint}) đang gặp sự cố, vui lòng thử lại sau.",
+            headers={"Retry-After": str(retry_after)},
+        )
+
+
+def _is_upstream_failure(exc: BaseException) -> bool:
+    """Lỗi nào làm breaker đếm: timeout/5xx/mạng. Lỗi 4xx (prompt sai, 429) thì không."""
+    if isinstance(exc, LLMTimeout):
+        return True
+    if isinstance(exc, (UpstreamRateLimited, ValueError, TypeError)):
+        return False
+    code = getattr(exc, "code", None)
+    if isinstance(code, int) and 400 <= code < 500:
+        return False
+    return True
+
+
+@dataclass
+class _EndpointStats:
+    calls: int = 0
+    errors: int = 0
+    timeouts: int = 0
+    queue_timeouts: int = 0
+    rejected: int = 0
+    hedges: int = 0
+    hedge_wins: int = 0
+    inflight: int = 0
+    total_ms: float = 0.0
+    max_ms: float = 0.0
+    recent_ms: Deque[float] = field(default_factory=lambda: deque(maxlen=_LATENCY_WINDOW))
+
+    def percentile(self, q: float) -> Optional[float]:
+        if not self.recent_ms:
+            return None
+        ordered = sorted(self.recent_ms)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+@dataclass
+class _Breaker:
+    failures: int = 0
+    opened_until: float = 0.0
+    probing: bool = False
+    trips: int = 0
+
+    def state(self, now: float) -> str:
+        if self.opened_until == 0.0:
+            return "closed"
+        return "open" if now < self.opened_until else "half-open"
+
+
+class LLMGateway:
+    def __init__(self, workers: int = LLM_EXECUTOR_WORKERS) -> None:
+        self.workers = workers
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="llm")
+        self._stats: Dict[str, _EndpointStats] = {}
+        self._breakers: Dict[str, _Breaker] = {}
+
+    # ----- circuit breaker -----
+
+    def _admit(self, endpoint: str, stats: _EndpointStats) -> _Breaker:
+        breaker = self._breakers.setdefault(endpoint, _Breaker())
+        now = time.monotonic()
+        state = breaker.state(now)
+        if state == "open" or (state == "half-open" and breaker.probing):
+            stats.rejected += 1
+            raise LLMUnavailable(endpoint, breaker.opened_until - now)
+        if state == "half-open":
+            breaker.probing = True  # chỉ cho một request thử
+        return breaker
+
+    def _record(self, endpoint: str, breaker: _Breaker, exc: Optional[BaseException]) -> None:
+        breaker.probing = False
+        if exc is None or not _is_upstream_failure(exc):
+            breaker.failures = 0
+            breaker.opened_until = 0.0
+            return
+        breaker.failures += 1
+        if breaker.opened_until or breaker.failures >= LLM_BREAKER_FAILURES:
+            breaker.opened_until = time.monotonic() + LLM_BREAKER_COOLDOWN_SECONDS
+            breaker.trips += 1
+            print(f"🔌 Circuit breaker mở cho '{endpoint}' trong {LLM_BREAKER_COOLDOWN_SECONDS:.0f}s")
+
+    # ----- hedging -----
+
+    async def _hedged(self, stats: _EndpointStats, attempt: Callable[[], Awaitable[Any]]) -> Any:
+        """Chạy ``attempt``; nếu chậm hơn p95 gần đây thì chạy thêm một bản, lấy kết quả về trước."""
+        p95 = stats.percentile(0.95) if len(stats.recent_ms) >= _HEDGE_MIN_SAMPLES else None
+        delay = p95 / 1000 if p95 is not None else LLM_HEDGE_DELAY_SECONDS
+        first = asyncio.ensure_future(attempt())
+        pending = {first}
+        try:
+            done, _ = await asyncio.wait(pending, timeout=delay)
+            if done:
+                return first.result()
+
+            stats.hedges += 1
+            second = asyncio.ensure_future(attempt())
+            pending.add(second)
+            error: Optional[BaseException] = None
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if task is second:
+                            stats.hedge_wins += 1
+                        return task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            for task in pending:
+                task.cancel()
+
+    # ----- entry points -----
+
+    async def call(
+        self,
+        fn: Callable[[], Awaitable[Any]],
+        endpoint: str = "default",
+        priority: int = GENERATION,
+        timeout: Optional[float] = None,
+        hedge: bool = False,
+    ) -> Any:
+        """Chạy ``fn()`` (coroutine factory gọi Gemini) qua rate limiter, deadline và breaker."""
+        stats = self._stats.setdefault(endpoint, _EndpointStats())
+        breaker = self._admit(endpoint, stats)
+        timeout = timeout or ENDPOINT_TIMEOUTS.get(endpoint, LLM_TIMEOUT_SECONDS)
+
+        async def upstream() -> Any:
+            # Deadline chỉ tính từ lúc limiter cấp token (không gồm thời gian xếp hàng / backoff 429)
+            sent = time.perf_counter()
+            try:
+                result = await asyncio.wait_for(fn(), timeout=timeout)
+            except asyncio.TimeoutError:
+                raise LLMTimeout(endpoint, timeout) from None
+            stats.recent_ms.append((time.perf_counter() - sent) * 1000)
+            return result
+
+        async def attempt() -> Any:
+            return await rate_limiter.call(priority, upstream)
+
+        stats.calls += 1
+        stats.inflight += 1
+        started = time.perf_counter()
+        try:
+            result = await (self._hedged(stats, attempt) if hedge else attempt())
+        except QueueTimeout:
+            # Hết thời gian chờ ở hàng đợi cục bộ: upstream không lỗi, breaker giữ nguyên
+            stats.queue_timeouts += 1
+            breaker.probing = False
+            raise
+        except LLMTimeout as e:
+            stats.timeouts += 1
+            stats.errors += 1
+            self._record(endpoint, breaker, e)
+            raise
+        except asyncio.CancelledError:
+            # Caller huỷ (client ngắt kết nối): không tính là lỗi upstream
+            breaker.probing = False
+            raise
+        except Exception as e:
+            stats.errors += 1
+            self._record(endpoint, breaker, e)
+            raise
+        else:
+            self._record(endpoint, breaker, None)
+            return result
+        finally:
+            stats.inflight -= 1
+            elapsed = (time.perf_counter() - started) * 1000
+            stats.total_ms += elapsed
+            stats.max_ms = max(stats.max_ms, elapsed)
+
+    async def generate(
+        self,
+        model,
+        contents,
+        endpoint: str = "default",
+        priority: int = GENERATION,
+        timeout: Optional[float] = None,
+        hedge: bool = False,
+        **kwargs,
+    ) -> Any:
+        """``model.generate_content`` nhưng không chặn event loop."""
+        return await self.call(
+            lambda: model.generate_content_async(contents, **kwargs),
+            endpoint=endpoint,
+            priority=priority,
+            timeout=timeout,
+            hedge=hedge,
+        )
+
+    async def run_blocking(
+        self,
+        fn: Callable[..., Any],
+        *args,
+        endpoint: str = "blocking",
+        priority: int = GENERATION,
+        timeout: Optional[float] = None,
+        hedge: bool = False,
+        **kwargs,
+    ) -> Any:
+        """Chạy một hàm SDK đồng bộ trên executor riêng của gateway."""
+        loop = asyncio.get_running_loop()
+        return await self.call(
+            lambda: loop.run_in_executor(self._executor, functools.partial(fn, *args, **kwargs)),
+            endpoint=endpoint,
+            priority=priority,
+            timeout=timeout,
+            hedge=hedge,
+        )
+
+    def shutdown(self) -> None:
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+    def stats(self) -> Dict[str, Any]:
+        now = time.monotonic()
+        endpoints = {}
+        for name, s in self._stats.items():
+            breaker = self._breakers.get(name, _Breaker())
+            p50, p95 = s.percentile(0.5), s.percentile(0.95)
+            endpoints[name] = {
+                "calls": s.calls,
+                "errors": s.errors,
+                "timeouts": s.timeouts,
+                "queue_timeouts": s.queue_timeouts,
+                "rejected": s.rejected,
+                "hedges": s.hedges,
+                "hedge_wins": s.hedge_wins,
+                "inflight": s.inflight,
+                "avg_ms": round(s.total_ms / s.calls, 1) if s.calls else 0.0,
+                "p50_ms": round(p50, 1) if p50 is not None else None,
+                "p95_ms": round(p95, 1) if p95 is not None else None,
+                "max_ms": round(s.max_ms, 1),
+                "breaker": breaker.state(now),
+                "breaker_trips": breaker.trips,
+            }
+        return {"executor_workers": self.workers, "endpoints": endpoints}
+
+
+llm_gateway = LLMGateway()
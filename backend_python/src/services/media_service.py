@@ -0,0 +1,273 @@
+# src/services/media_service.py
+"""Media pipeline for chat images.
+
+Each image sent by the frontend (base64 data URL) is:
+1. decoded chunk by chunk with a per-image size cap,
+2. content-hashed (sha256 of the original bytes),
+3. downscaled and re-encoded when larger than ``MEDIA_MAX_DIMENSION``
+   (needs Pillow; without it the original bytes are used),
+4. uploaded once through the Gemini File API.
+
+Later turns may send ``media:<sha256>`` instead of the data URL; the same
+photo sent again as a data URL also resolves to the existing upload by hash.
+If an upload fails the image is sent as ``inline_data`` for that turn.
+"""
+import asyncio
+import base64
+import binascii
+import hashlib
+import io
+import os
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional, Tuple
+
+from src.ai_config import genai
+from src.services.llm_gateway import llm_gateway
+from src.services.rate_limiter import INTERACTIVE
+
+try:
+    from PIL import Image
+except ImportError:  # Pillow là tuỳ chọn: không có thì gửi ảnh gốc
+    Image = None
+
+MEDIA_REF_PREFIX = "media:"
+MEDIA_MAX_IMAGE_BYTES = int(os.getenv("MEDIA_MAX_IMAGE_MB", "10")) * 1024 * 1024
+MEDIA_MAX_DIMENSION = int(os.getenv("MEDIA_MAX_DIMENSION", "1536"))
+MEDIA_JPEG_QUALITY = int(os.getenv("MEDIA_JPEG_QUALITY", "85"))
+MEDIA_UPLOAD_ENABLED = os.getenv("MEDIA_UPLOAD_ENABLED", "1") == "1"
+MEDIA_MAX_HANDLES = int(os.getenv("MEDIA_MAX_HANDLES", "5000"))
+# File API giữ file 48h; coi handle hết hạn sớm hơn một chút
+MEDIA_HANDLE_TTL_SECONDS = int(os.getenv("MEDIA_HANDLE_TTL_SECONDS", str(47 * 3600)))
+
+# Giải mã theo từng đoạn base64 (bội số của 4 ký tự)
+_DECODE_CHUNK_CHARS = 64 * 1024
+
+
+class MediaError(ValueError):
+    """Ảnh không hợp lệ."""
+
+    status_code = 400
+
+
+class MediaTooLarge(MediaError):
+    status_code = 413
+
+
+class MediaExpired(MediaError):
+    """``media:<hash>`` không còn trong cache (hết hạn / process khởi động lại): client gửi lại data URL."""
+
+    status_code = 410
+
+
+@dataclass
+class MediaHandle:
+    digest: str
+    mime_type: str
+    data: Optional[bytes] = None  # bytes đã xử lý, giữ lại khi upload thất bại
+    file_uri: Optional[str] = None
+    file_name: Optional[str] = None
+    original_bytes: int = 0
+    processed_bytes: int = 0
+    created_at: float = field(default_factory=time.time)
+
+    @property
+    def ref(self) -> str:
+        return f"{MEDIA_REF_PREFIX}{self.digest}"
+
+    def expired(self, ttl: int) -> bool:
+        return time.time() - self.created_at > ttl
+
+    def to_part(self) -> Dict[str, Any]:
+        if self.file_uri:
+            return {"file_data": {"mime_type": self.mime_type, "file_uri": self.file_uri}}
+        return {
+            "inline_data": {
+                "mime_type": self.mime_type,
+                "data": base64.b64encode(self.data or b"").decode("ascii"),
+            }
+        }
+
+
+def decode_data_url(url: str, max_bytes: int = MEDIA_MAX_IMAGE_BYTES) -> Tuple[str, bytes]:
+    """Giải mã data URL base64 theo từng đoạn, dừng sớm nếu vượt ``max_bytes``."""
+    comma = url.find(",")
+    if not url.startswith("data:") or comma < 0:
+        raise MediaError("Not a data URL")
+    header = url[5:comma]
+    if ";base64" not in header:
+        raise MediaError("Only base64 data URLs are supported")
+    mime_type = header.split(";", 1)[0] or "application/octet-stream"
+
+    # Ước lượng trước khi giải mã để từ chối sớm
+    if (len(url) - comma - 1) * 3 // 4 > max_bytes + 3:
+        raise MediaTooLarge(f"Image exceeds {max_bytes // (1024 * 1024)}MB")
+
+    out = io.BytesIO()
+    pending = ""
+    pos = comma + 1
+    while pos < len(url):
+        piece = pending + "".join(url[pos:pos + _DECODE_CHUNK_CHARS].split())
+        pos += _DECODE_CHUNK_CHARS
+        usable = len(piece) - len(piece) % 4
+        pending = piece[usable:]
+        try:
+            out.write(base64.b64decode(piece[:usable], validate=True))
+        except binascii.Error as e:
+            raise MediaError(f"Invalid base64 data: {e}")
+        if out.tell() > max_bytes:
+            raise MediaTooLarge(f"Image exceeds {max_bytes // (1024 * 1024)}MB")
+    if pending:
+        raise MediaError("Truncated base64 data")
+    return mime_type, out.getvalue()
+
+
+def downscale_image(data: bytes, mime_type: str) -> Tuple[bytes, str]:
+    """Thu nhỏ ảnh có cạnh dài > MEDIA_MAX_DIMENSION và nén lại dạng JPEG."""
+    if Image is None or not mime_type.startswith("image/"):
+        return data, mime_type
+    try:
+        with Image.open(io.BytesIO(data)) as img:
+            if max(img.size) <= MEDIA_MAX_DIMENSION:
+                return data, mime_type
+            img.thumbnail((MEDIA_MAX_DIMENSION, MEDIA_MAX_DIMENSION), Image.LANCZOS)
+            if img.mode in ("RGBA", "LA", "P"):
+                # Ảnh chụp bài tập/hình vẽ nền trong suốt -> nền trắng
+                rgba = img.convert("RGBA")
+                background = Image.new("RGB", rgba.size, (255, 255, 255))
+                background.paste(rgba, mask=rgba.split()[-1])
+                img = background
+            elif img.mode != "RGB":
+                img = img.convert("RGB")
+            buf = io.BytesIO()
+            img.save(buf, format="JPEG", quality=MEDIA_JPEG_QUALITY, optimize=True)
+    except Exception as e:
+        print(f"⚠️ Cannot downscale image, using original: {e}")
+        return data, mime_type
+    resized = buf.getvalue()
+    return (resized, "image/jpeg") if len(resized) < len(data) else (data, mime_type)
+
+
+class MediaService:
+    def __init__(self, max_handles: int = MEDIA_MAX_HANDLES, ttl_seconds: int = MEDIA_HANDLE_TTL_SECONDS) -> None:
+        self.max_handles = max_handles
+        self.ttl_seconds = ttl_seconds
+        self._handles: "OrderedDict[str, MediaHandle]" = OrderedDict()
+        self._pending: Dict[str, asyncio.Task] = {}
+        self.uploads = 0
+        self.upload_failures = 0
+        self.reuses = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    def _get(self, digest: str) -> Optional[MediaHandle]:
+        handle = self._handles.get(digest)
+        if handle is None:
+            return None
+        if handle.expired(self.ttl_seconds):
+            del self._handles[digest]
+            return None
+        self._handles.move_to_end(digest)
+        return handle
+
+    def _put(self, handle: MediaHandle) -> None:
+        self._handles[handle.digest] = handle
+        self._handles.move_to_end(handle.digest)
+        while len(self._handles) > self.max_handles:
+            self._handles.popitem(last=False)
+
+    async def _ingest(self, digest: str, mime_type: str, data: bytes) -> MediaHandle:
+        processed, processed_mime = await asyncio.to_thread(downscale_image, data, mime_type)
+        handle = MediaHandle(
+            digest=digest,
+            mime_type=processed_mime,
+            original_bytes=len(data),
+            processed_bytes=len(processed),
+        )
+        self.bytes_in += len(data)
+        self.bytes_out += len(processed)
+        if MEDIA_UPLOAD_ENABLED:
+            try:
+                uploaded = await llm_gateway.run_blocking(
+                    genai.upload_file,
+                    io.BytesIO(processed),
+                    mime_type=processed_mime,
+                    display_name=f"chat-{digest[:16]}",
+                    endpoint="media-upload",
+                    priority=INTERACTIVE,
+                )
+                handle.file_uri = uploaded.uri
+                handle.file_name = uploaded.name
+                self.uploads += 1
+            except Exception as e:
+                print(f"⚠️ Media upload failed, sending inline: {e}")
+                self.upload_failures += 1
+        if not handle.file_uri:
+            handle.data = processed
+        else:
+            self._put(handle)
+        return handle
+
+    async def ingest_data_url(self, url: str) -> MediaHandle:
+        mime_type, data = await asyncio.to_thread(decode_data_url, url)
+        digest = hashlib.sha256(data).hexdigest()
+        handle = self._get(digest)
+        if handle is not None:
+            self.reuses += 1
+            return handle
+        # Cùng một ảnh gửi song song chỉ upload một lần
+        task = self._pending.get(digest)
+        if task is None:
+            task = asyncio.ensure_future(self._ingest(digest, mime_type, data))
+            self._pending[digest] = task
+            task.add_done_callback(lambda _: self._pending.pop(digest, None))
+        else:
+            self.reuses += 1
+        return await asyncio.shield(task)
+
+    async def resolve(self, url: str) -> Optional[MediaHandle]:
+        """Data URL -> handle (upload nếu ảnh mới); ``media:<hash>`` -> handle đã có."""
+        if url.startswith(MEDIA_REF_PREFIX):
+            handle = self._get(url[len(MEDIA_REF_PREFIX):])
+            if handle is None:
+                # Không bỏ ảnh âm thầm (model sẽ trả lời như thể không có ảnh)
+                raise MediaExpired(f"Media ref expired, resend the data URL: {url[:24]}...")
+            self.reuses += 1
+            return handle
+        if url.startswith("data:"):
+            return await self.ingest_data_url(url)
+        print(f"⚠️ URL không phải định dạng base64: {url[:30]}...")
+        return None
+
+    async def build_parts(self, urls: List[str]) -> Tuple[List[Dict[str, Any]], List[str]]:
+        """Trả (parts cho Gemini, media refs để client gửi lại ở lượt sau)."""
+        parts: List[Dict[str, Any]] = []
+        refs: List[str] = []
+        results = await asyncio.gather(*(self.resolve(u) for u in urls), return_exceptions=True)
+        for result in results:
+            if isinstance(result, MediaError):
+                raise result
+            if isinstance(result, Exception):
+                print(f"❌ Lỗi xử lý ảnh: {result}")
+                continue
+            if result is None:
+                continue
+            parts.append(result.to_part())
+            if result.file_uri:
+                refs.append(result.ref)
+        return parts, refs
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "handles": len(self._handles),
+            "uploads": self.uploads,
+            "upload_failures": self.upload_failures,
+            "reuses": self.reuses,
+            "bytes_in": self.bytes_in,
+            "bytes_out": self.bytes_out,
+            "downscaling": Image is not None,
+        }
+
+
+media_service = MediaService()
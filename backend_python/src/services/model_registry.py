@@ -0,0 +1,93 @@
+# src/services/model_registry.py
+"""Process-wide registry of shared ``genai.GenerativeModel`` instances.
+
+Models are keyed by (model name, generation config, system instruction) so
+every endpoint with the same configuration reuses one instance instead of
+building a new one (and re-sending its multi-KB system instruction setup) per
+request.
+"""
+import hashlib
+import json
+import threading
+from typing import Any, Dict, Iterable, Optional, Tuple
+
+from src.ai_config import genai
+
+ModelKey = Tuple[str, str, str]
+
+
+def _config_key(generation_config: Optional[Dict[str, Any]]) -> str:
+    return json.dumps(generation_config or {}, sort_keys=True, ensure_ascii=False)
+
+
+def _instruction_key(system_instruction: Optional[str]) -> str:
+    if not system_instruction:
+        return ""
+    return hashlib.sha256(system_instruction.encode("utf-8")).hexdigest()
+
+
+class ModelRegistry:
+    def __init__(self) -> None:
+        self._models: Dict[ModelKey, Any] = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get_model(
+        self,
+        model_name: str,
+        generation_config: Optional[Dict[str, Any]] = None,
+        system_instruction: Optional[str] = None,
+    ):
+        """Return the shared model for this configuration, building it on first use."""
+        key = (model_name, _config_key(generation_config), _instruction_key(system_instruction))
+        model = self._models.get(key)
+        if model is not None:
+            self.hits += 1
+            return model
+
+        with self._lock:
+            model = self._models.get(key)
+            if model is not None:
+                self.hits += 1
+                return model
+            kwargs: Dict[str, Any] = {}
+            if generation_config:
+                kwargs["generation_config"] = generation_config
+            if system_instruction:
+                kwargs["system_instruction"] = system_instruction
+            model = genai.GenerativeModel(model_name, **kwargs)
+            self._models[key] = model
+            self.misses += 1
+            return model
+
+    def warm_up(self, specs: Iterable[Tuple[str, Optional[Dict[str, Any]], Optional[str]]]) -> int:
+        """Pre-build models at startup so the first requests only see hits."""
+        built = 0
+        for model_name, generation_config, system_instruction in specs:
+            before = self.misses
+            self.get_model(model_name, generation_config, system_instruction)
+            built += self.misses - before
+        # Warm-up builds should not count as request-path misses.
+        self.misses -= built
+        return built
+
+    def stats(self) -> Dict[str, Any]:
+        total = self.hits + self.misses
+        return {
+            "models": len(self._models),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / total, 4) if total else 0.0,
+        }
+
+
+registry = ModelRegistry()
+
+
+def get_model(
+    model_name: str,
+    generation_config: Optional[Dict[str, Any]] = None,
+    system_instruction: Optional[str] = None,
+):
+    return registry.get_model(model_name, generation_config, system_instruction)
@@ -0,0 +1,177 @@
+# src/services/prompt_assembler.py
+"""Token-budgeted prompt assembly.
+
+Each generation request gets a ``PromptPlan`` with a budget per section
+(system, rag, history, media). Content is fitted section by section in
+priority order and trimmed deterministically:
+
+- rag: entries are kept in rank order; the first entry that does not fit is
+  truncated if a useful amount of budget remains, everything after is dropped.
+- history: newest turns are kept, oldest are dropped.
+- media: parts are kept in order until the budget runs out.
+
+Tokens are counted locally (no API round trip) and the final breakdown is
+reported to the client in the ``X-Prompt-Tokens`` header.
+"""
+import math
+import os
+import re
+from typing import Any, Dict, List, Optional
+
+PROMPT_TOKENS_HEADER = "X-Prompt-Tokens"
+
+DEFAULT_BUDGETS = {
+    "system": int(os.getenv("PROMPT_BUDGET_SYSTEM", "6000")),
+    "rag": int(os.getenv("PROMPT_BUDGET_RAG", "2500")),
+    "history": int(os.getenv("PROMPT_BUDGET_HISTORY", "4000")),
+    "media": int(os.getenv("PROMPT_BUDGET_MEDIA", "1600")),
+}
+
+# Gemini tính mỗi ảnh (<= 384px mỗi chiều) ~258 token; ảnh lớn hơn được chia ô.
+IMAGE_TOKENS = 258
+# Không cắt một đoạn RAG nếu phần còn lại của ngân sách nhỏ hơn mức này
+MIN_TRUNCATED_TOKENS = 64
+
+_TOKEN_RE = re.compile(r"\w+|[^\w\s]", re.UNICODE)
+
+
+def count_tokens(text: str) -> int:
+    """Ước lượng số token cục bộ: mỗi từ ~ 1 token/4 ký tự, mỗi dấu câu 1 token."""
+    if not text:
+        return 0
+    return sum(math.ceil(len(tok) / 4) for tok in _TOKEN_RE.findall(text))
+
+
+def truncate_to_tokens(text: str, max_tokens: int) -> str:
+    """Cắt text để không vượt quá ``max_tokens`` (cắt ở ranh giới token)."""
+    if max_tokens <= 0:
+        return ""
+    used = 0
+    for match in _TOKEN_RE.finditer(text):
+        used += math.ceil(len(match.group(0)) / 4)
+        if used > max_tokens:
+            return text[:match.start()].rstrip()
+    return text
+
+
+def _part_tokens(part: Any) -> int:
+    if isinstance(part, str):
+        return count_tokens(part)
+    if isinstance(part, dict):
+        if "text" in part:
+            return count_tokens(part["text"])
+        return IMAGE_TOKENS
+    return IMAGE_TOKENS
+
+
+def _turn_tokens(turn: Dict[str, Any]) -> int:
+    return sum(_part_tokens(p) for p in turn.get("parts", []))
+
+
+class PromptPlan:
+    def __init__(self, budgets: Dict[str, int]) -> None:
+        self.budgets = dict(budgets)
+        self.used: Dict[str, int] = {name: 0 for name in budgets}
+        self.used["prompt"] = 0
+        self.dropped: Dict[str, int] = {}
+
+    def remaining(self, section: str) -> int:
+        return max(0, self.budgets.get(section, 0) - self.used.get(section, 0))
+
+    def _drop(self, section: str, count: int = 1) -> None:
+        self.dropped[section] = self.dropped.get(section, 0) + count
+
+    def add(self, section: str, text: str) -> None:
+        """Ghi nhận phần không cắt được (system instruction, prompt cố định)."""
+        self.add_tokens(section, count_tokens(text))
+
+    def add_tokens(self, section: str, tokens: int) -> None:
+        self.used[section] = self.used.get(section, 0) + tokens
+
+    def count_prompt(self, final_prompt: str) -> None:
+        """Đếm phần prompt còn lại sau khi đã chèn các đoạn RAG được giữ."""
+        self.used["prompt"] += max(0, count_tokens(final_prompt) - self.used.get("rag", 0))
+
+    def fit(self, section: str, entries: List[str]) -> List[str]:
+        """Giữ các entry theo thứ tự xếp hạng cho tới khi hết ngân sách."""
+        kept: List[str] = []
+        for idx, entry in enumerate(entries):
+            tokens = count_tokens(entry)
+            left = self.remaining(section)
+            if tokens <= left:
+                kept.append(entry)
+                self.used[section] += tokens
+                continue
+            if left >= MIN_TRUNCATED_TOKENS:
+                cut = truncate_to_tokens(entry, left)
+                kept.append(cut)
+                self.used[section] += count_tokens(cut)
+                self._drop(section, len(entries) - idx - 1)
+            else:
+                self._drop(section, len(entries) - idx)
+            break
+        return kept
+
+    def fit_text(self, section: str, text: str) -> str:
+        if not text:
+            return ""
+        kept = self.fit(section, [text])
+        return kept[0] if kept else ""
+
+    def fit_history(self, history: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """Giữ các lượt mới nhất; bỏ lượt cũ (theo cặp để history vẫn bắt đầu bằng user)."""
+        kept: List[Dict[str, Any]] = []
+        for turn in reversed(history):
+            tokens = _turn_tokens(turn)
+            if tokens > self.remaining("history"):
+                break
+            kept.append(turn)
+            self.used["history"] += tokens
+        kept.reverse()
+        while kept and kept[0].get("role") != "user":
+            self.used["history"] -= _turn_tokens(kept.pop(0))
+        if len(kept) < len(history):
+            self._drop("history", len(history) - len(kept))
+        return kept
+
+    def fit_media(self, parts: List[Any]) -> List[Any]:
+        kept: List[Any] = []
+        for part in parts:
+            tokens = _part_tokens(part)
+            if tokens > self.remaining("media"):
+                self._drop("media", len(parts) - len(kept))
+                break
+            kept.append(part)
+            self.used["media"] += tokens
+        return kept
+
+    @property
+    def total(self) -> int:
+        return sum(self.used.values())
+
+    def breakdown(self) -> Dict[str, Any]:
+        data: Dict[str, Any] = dict(self.used)
+        data["total"] = self.total
+        if self.dropped:
+            data["dropped"] = dict(self.dropped)
+        return data
+
+    def header_value(self) -> str:
+        """Vd: ``system=5120; rag=812; history=0; media=258; prompt=96; total=6286``."""
+        parts = [f"{name}={tokens}" for name, tokens in self.used.items()]
+        parts.append(f"total={self.total}")
+        return "; ".join(parts)
+
+
+class PromptAssembler:
+    def __init__(self, budgets: Optional[Dict[str, int]] = None) -> None:
+        self.budgets = dict(budgets or DEFAULT_BUDGETS)
+
+    def plan(self, **overrides: int) -> PromptPlan:
+        """Tạo plan mới; có thể ghi đè ngân sách từng phần cho một endpoint."""
+        budgets = dict(self.budgets)
+        budgets.update(overrides)
+        return PromptPlan(budgets)
+
+
+prompt_assembler = PromptAssembler()
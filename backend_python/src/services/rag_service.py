@@ -1,175 +1,342 @@
 import os
-import io
 import asyncio
+import json
+import time
 import google.generativeai as genai
+from dataclasses import dataclass
 from pathlib import Path
-from typing import List, Dict, Any, Optional
-import PyPDF2
-from docx import Document
+from typing import Awaitable, Callable, List, Dict, Any, Optional
 from src.supabase_client import supabase
 from src.ai_config import genai
+from src.services.chunk_writer import open_chunk_writer
+from src.services.chunker import split_into_chunks
+from src.services.embedding_cache import EMBED_CACHE_ENABLED, embedding_cache, text_hash
+from src.services.ingestion import STORAGE_BUCKET, download_to_tempfile, iter_document_batches, run_pipeline
+from src.services.lexical_index import (
+    RAG_CANDIDATE_FACTOR,
+    RAG_CANDIDATE_THRESHOLD,
+    RAG_HYBRID,
+    rerank_documents,
+)
+from src.services.llm_gateway import llm_gateway
+from src.services.rate_limiter import BACKGROUND, INTERACTIVE
+from src.services.vector_index import vector_index
 
 # Configure embedding model
 EMBEDDING_MODEL = "models/text-embedding-004"
 
-def extract_text_from_pdf(file_content: bytes) -> str:
-    """Extract text from a PDF file content (bytes)"""
-    try:
-        pdf_reader = PyPDF2.PdfReader(io.BytesIO(file_content))
-        text = ""
-        for page in pdf_reader.pages:
-            text += page.extract_text() + "\n"
-        return text
-    except Exception as e:
-        print(f"Error reading PDF: {e}")
-        return ""
+def chunk_text(text: str) -> List[str]:
+    """Split text into structure-aware chunks (see src/services/chunker.py)"""
+    return split_into_chunks(text)
 
-def extract_text_from_word(file_content: bytes) -> str:
-    """Extract text from a Word (.docx) file content (bytes)"""
-    try:
-        doc = Document(io.BytesIO(file_content))
-        text = ""
-        for paragraph in doc.paragraphs:
-            text += paragraph.text + "\n"
-        return text
-    except Exception as e:
-        print(f"Error reading Word file: {e}")
-        return ""
+EMBED_BATCH_SIZE = int(os.getenv("EMBED_BATCH_SIZE", "100"))  # tối đa của batchEmbedContents
+EMBED_MAX_CONCURRENCY = int(os.getenv("EMBED_MAX_CONCURRENCY", "4"))
+
+_embed_semaphore: Optional[asyncio.Semaphore] = None
+
+
+def _get_embed_semaphore() -> asyncio.Semaphore:
+    global _embed_semaphore
+    if _embed_semaphore is None:
+        _embed_semaphore = asyncio.Semaphore(EMBED_MAX_CONCURRENCY)
+    return _embed_semaphore
+
+
+async def _embed_batch(
+    batch: List[str], task_type: str, priority: int, hedge: bool
+) -> List[List[float]]:
+    """Một request embed_content cho cả batch.
 
-def chunk_text(text: str, chunk_size: int = 1000, overlap: int = 200) -> List[str]:
-    """Split text into chunks with overlap"""
-    if not text:
+    Lỗi ở đường query (INTERACTIVE) thì trả [] cho từng phần tử để search vẫn chạy
+    bằng BM25; ở đường ingestion thì raise để job retry / backoff xử lý.
+    """
+    async with _get_embed_semaphore():
+        try:
+            # embed_content là hàm đồng bộ: chạy trên executor của gateway để không chặn event loop
+            result = await llm_gateway.run_blocking(
+                genai.embed_content,
+                model=EMBEDDING_MODEL,
+                content=batch,
+                task_type=task_type,
+                endpoint="embed-query" if priority == INTERACTIVE else "embed-ingest",
+                priority=priority,
+                hedge=hedge,
+            )
+            embeddings = result["embedding"]
+            if len(embeddings) != len(batch):
+                raise ValueError(f"expected {len(batch)} embeddings, got {len(embeddings)}")
+            return embeddings
+        except Exception as e:
+            print(f"Error generating embeddings for batch of {len(batch)}: {e}")
+            if priority != INTERACTIVE:
+                raise
+            return [[] for _ in batch]
+
+
+async def embed_texts(
+    texts: List[str],
+    task_type: str = "retrieval_document",
+    priority: int = BACKGROUND,
+    hedge: bool = False,
+) -> List[List[float]]:
+    """Embed nhiều đoạn text: gom EMBED_BATCH_SIZE đoạn mỗi request, tối đa
+    EMBED_MAX_CONCURRENCY batch chạy song song. Đoạn đã embed trước đó lấy từ
+    embedding_cache. Kết quả giữ đúng thứ tự đầu vào. Với priority INTERACTIVE đoạn lỗi
+    nhận []; priority khác thì raise lỗi đầu tiên (các batch thành công vẫn được cache)."""
+    if not texts:
         return []
-    
-    chunks = []
-    start = 0
-    text_len = len(text)
-    
-    while start < text_len:
-        end = start + chunk_size
-        chunk = text[start:end]
-        chunks.append(chunk)
-        start += chunk_size - overlap
-        
-    return chunks
+    if EMBED_CACHE_ENABLED:
+        embeddings = await embedding_cache.get_many(EMBEDDING_MODEL, task_type, texts)
+    else:
+        embeddings = [None] * len(texts)
+
+    # Chỉ embed các đoạn chưa có trong cache, mỗi nội dung một lần
+    missing = list(dict.fromkeys(t for t, e in zip(texts, embeddings) if e is None))
+    if missing:
+        batches = [missing[i:i + EMBED_BATCH_SIZE] for i in range(0, len(missing), EMBED_BATCH_SIZE)]
+        results = await asyncio.gather(
+            *(_embed_batch(b, task_type, priority, hedge) for b in batches), return_exceptions=True
+        )
+        errors = [r for r in results if isinstance(r, BaseException)]
+        fresh = [
+            embedding
+            for b, r in zip(batches, results)
+            for embedding in ([[] for _ in b] if isinstance(r, BaseException) else r)
+        ]
+        if EMBED_CACHE_ENABLED:
+            await embedding_cache.put_many(EMBEDDING_MODEL, task_type, missing, fresh)
+        if errors:
+            raise errors[0]
+        by_text = dict(zip(missing, fresh))
+        embeddings = [e if e is not None else by_text[t] for t, e in zip(texts, embeddings)]
+    return embeddings
+
 
-async def generate_embedding(text: str) -> List[float]:
+async def generate_embedding(text: str, priority: int = BACKGROUND, hedge: bool = False) -> List[float]:
     """Generate embedding for a text string using Google GenAI"""
+    embeddings = await embed_texts([text], priority=priority, hedge=hedge)
+    return embeddings[0]
+
+# purpose -> (bảng metadata, bảng chunk, cột khoá ngoại)
+DOCUMENT_TABLES = {
+    "chat": ("user_documents", "document_chunks", "document_id"),
+}
+DEFAULT_DOCUMENT_TABLES = ("test_materials", "test_material_chunks", "material_id")
+
+ProgressCallback = Callable[[int, float], Awaitable[None]]
+
+
+def document_tables(purpose: str):
+    return DOCUMENT_TABLES.get(purpose, DEFAULT_DOCUMENT_TABLES)
+
+
+async def mark_document_status(document_id: str, purpose: str, status: str, **fields) -> None:
+    meta_table, _, _ = document_tables(purpose)
+    await asyncio.to_thread(
+        lambda: supabase.table(meta_table).update({"rag_status": status, **fields}).eq("id", document_id).execute()
+    )
+
+
+@dataclass
+class StoredChunk:
+    id: str
+    content_hash: str
+
+
+async def load_chunk_fingerprints(document_id: str, purpose: str) -> Dict[int, StoredChunk]:
+    """chunk_index -> (id, content_hash) của các chunk đã lưu (không tải embedding / nội dung).
+
+    Dòng cũ chưa có content_hash thì tính từ nội dung (chỉ tải nội dung của các dòng đó).
+    """
+    _, chunk_table, fk_col = document_tables(purpose)
+
+    def fetch(columns: str, missing_hash: bool) -> List[Dict[str, Any]]:
+        rows: List[Dict[str, Any]] = []
+        start = 0
+        while True:
+            query = supabase.table(chunk_table).select(columns).eq(fk_col, document_id)
+            if missing_hash:
+                query = query.is_("content_hash", "null")
+            page = query.order("chunk_index").range(start, start + 999).execute().data or []
+            rows.extend(page)
+            if len(page) < 1000:
+                return rows
+            start += 1000
+
+    rows = await asyncio.to_thread(fetch, "id, chunk_index, content_hash", False)
+    stored = {r["chunk_index"]: StoredChunk(r["id"], r["content_hash"]) for r in rows}
+    if any(not c.content_hash for c in stored.values()):
+        for r in await asyncio.to_thread(fetch, "id, chunk_index, content", True):
+            stored[r["chunk_index"]] = StoredChunk(r["id"], text_hash(r["content"] or ""))
+    return stored
+
+
+async def load_stored_embeddings(purpose: str, ids: List[str]) -> Dict[str, List[float]]:
+    """Embedding đã lưu của các chunk (theo id), dùng lại khi chunk chỉ đổi vị trí."""
+    if not ids:
+        return {}
+    _, chunk_table, _ = document_tables(purpose)
+    response = await asyncio.to_thread(
+        lambda: supabase.table(chunk_table).select("id, embedding").in_("id", ids).execute()
+    )
+    found = {}
+    for row in response.data or []:
+        embedding = row.get("embedding")
+        if isinstance(embedding, str):
+            embedding = json.loads(embedding)
+        if embedding:
+            found[row["id"]] = embedding
+    return found
+
+
+async def ingest_document(
+    user_id: str,
+    document_id: str,
+    purpose: str = "chat",
+    progress: Optional[ProgressCallback] = None,
+) -> int:
+    """
+    Streaming pipeline: Download (temp file) -> Extract (page by page) -> Chunk -> Diff -> Embed -> Save
+    Mỗi batch được ghi và commit ngay khi embed xong (COPY + merge, hoặc upsert PostgREST);
+    bộ nhớ giới hạn theo batch, không theo kích thước file.
+
+    Versioned: mỗi chunk có content_hash; so với các dòng đã lưu của tài liệu
+    - cùng chunk_index, cùng hash: giữ nguyên (tải lại bản đã sửa, hoặc chạy tiếp sau khi crash);
+    - hash đã có ở vị trí khác: dùng lại embedding đã lưu, không gọi API;
+    - còn lại mới embed. Các chunk thừa ở cuối bị xoá một lần.
+    Chi phí tải lại bản đã sửa ~ kích thước phần sửa. Lỗi thì raise.
+    """
+    # 1. Determine tables based on purpose
+    meta_table, chunk_table, fk_col = document_tables(purpose)
+
+    # 2. Get document metadata
+    response = await asyncio.to_thread(
+        lambda: supabase.table(meta_table).select("*").eq("id", document_id).single().execute()
+    )
+    if not response.data:
+        raise ValueError(f"Document {document_id} not found in {meta_table}")
+
+    doc_record = response.data
+    source_path = doc_record["source_path"]
+    file_name = doc_record["file_name"]
+    ext = Path(file_name).suffix.lower()
+    stored = await load_chunk_fingerprints(document_id, purpose)
+    stored_by_hash = {c.content_hash: c.id for c in stored.values()}
+
+    print(f"Processing {file_name} ({purpose}), {len(stored)} chunks đã lưu...")
+
+    # 3. Stream file from Storage xuống file tạm
+    tmp_path = await asyncio.to_thread(download_to_tempfile, STORAGE_BUCKET, source_path, ext)
+    total = 0
+    counts = {"unchanged": 0, "reused": 0, "embedded": 0}
+
+    async def save_batch(item) -> None:
+        nonlocal total
+        chunks, fraction = item
+        start = total
+        total += len(chunks)
+
+        # Diff theo content_hash
+        changed = []
+        for k, content in enumerate(chunks):
+            chunk_index, digest = start + k, text_hash(content)
+            current = stored.get(chunk_index)
+            if current and current.content_hash == digest:
+                counts["unchanged"] += 1
+            else:
+                changed.append((chunk_index, content, digest))
+
+        if changed:
+            # 4. Embedding: lấy lại bản đã lưu nếu chunk chỉ đổi vị trí, còn lại embed mới
+            reusable = await load_stored_embeddings(
+                purpose, [stored_by_hash[d] for _, _, d in changed if d in stored_by_hash]
+            )
+            embeddings = {d: reusable[stored_by_hash[d]] for _, _, d in changed if stored_by_hash.get(d) in reusable}
+            counts["reused"] += sum(1 for _, _, d in changed if d in embeddings)
+            to_embed = [(c, d) for _, c, d in changed if d not in embeddings]
+            if to_embed:
+                fresh = await embed_texts([c for c, _ in to_embed])
+                embeddings.update({d: e for (_, d), e in zip(to_embed, fresh) if e})
+                missing = sum(1 for _, d in to_embed if d not in embeddings)
+                if missing:
+                    # Không ghi batch thiếu embedding (tài liệu sẽ thiếu chunk mà vẫn "ready"): để job thử lại
+                    raise RuntimeError(f"Thiếu embedding cho {missing}/{len(to_embed)} chunk ({start}..{total - 1})")
+                counts["embedded"] += len(to_embed)
+
+            rows_to_upsert = [
+                {
+                    "user_id": user_id,
+                    fk_col: document_id,
+                    "chunk_index": chunk_index,
+                    "content": content,
+                    "content_length": len(content),
+                    "content_hash": digest,
+                    "source_path": source_path,
+                    "embedding_status": "completed",
+                    "embedding": embeddings[digest],
+                    "visibility": doc_record.get("visibility", "private"),
+                }
+                for chunk_index, content, digest in changed
+            ]
+            if rows_to_upsert:
+                # Unique (fk, chunk_index): ghi đè đúng vị trí đã đổi nội dung
+                await writer.write(rows_to_upsert)
+                # Dòng ở các vị trí này giờ mang nội dung mới: embedding cũ của chúng không còn dùng lại được
+                for chunk_index, _, _ in changed:
+                    previous = stored.get(chunk_index)
+                    if previous and stored_by_hash.get(previous.content_hash) == previous.id:
+                        del stored_by_hash[previous.content_hash]
+                if not stored:
+                    vector_index.add_chunks(user_id, purpose, file_name, rows_to_upsert)
+                print(
+                    f"Saved chunks {rows_to_upsert[0]['chunk_index']}..{rows_to_upsert[-1]['chunk_index']} ({writer.kind})"
+                )
+        if progress:
+            await progress(total, fraction)
+
+    # Mỗi batch commit riêng: COPY + merge (src/db.py) hoặc upsert PostgREST
+    writer = open_chunk_writer(chunk_table, fk_col, document_id)
     try:
-        result = genai.embed_content(
-            model=EMBEDDING_MODEL,
-            content=text,
-            task_type="retrieval_document"
-        )
-        return result['embedding']
-    except Exception as e:
-        print(f"Error generating embedding: {e}")
-        return []
+        await run_pipeline(iter_document_batches(tmp_path, ext), save_batch)
+        if not total:
+            raise ValueError("No text extracted")
+        stale = sum(1 for index in stored if index >= total)
+        # Các chunk thừa ở cuối bị xoá cùng lúc với lần ghi cuối
+        await writer.finish(delete_from=total if stale else None)
+    except BaseException:
+        await writer.abort()
+        raise
+    finally:
+        os.unlink(tmp_path)
+
+    if stored:
+        # Index cục bộ có thể giữ nội dung cũ ở các vị trí đã đổi: nạp lại ở lần search sau
+        vector_index.invalidate(user_id, purpose)
+
+    # 5. Update document status
+    await mark_document_status(document_id, purpose, "ready", chunk_count=total)
+    print(
+        f"Successfully processed {file_name}: {total} chunks "
+        f"({counts['unchanged']} giữ nguyên, {counts['reused']} dùng lại embedding, "
+        f"{counts['embedded']} embed mới, {stale} xoá)"
+    )
+    return total
+
 
 async def process_document(user_id: str, document_id: str, purpose: str = "chat"):
     """
-    Full pipeline: Download -> Extract -> Chunk -> Embed -> Save
+    Full pipeline trong một lần gọi (đồng bộ với request). Endpoint dùng hàng đợi
+    ingestion_jobs; hàm này giữ lại cho các caller cũ.
     purpose: 'chat' (user_documents) or 'test' (test_materials)
     """
     try:
-        # 1. Determine tables based on purpose
-        if purpose == "chat":
-            meta_table = "user_documents"
-            chunk_table = "document_chunks"
-            fk_col = "document_id"
-        else:
-            meta_table = "test_materials"
-            chunk_table = "test_material_chunks"
-            fk_col = "material_id"
-
-        # 2. Get document metadata
-        response = supabase.table(meta_table).select("*").eq("id", document_id).single().execute()
-        if not response.data:
-            raise ValueError(f"Document {document_id} not found in {meta_table}")
-        
-        doc_record = response.data
-        source_path = doc_record["source_path"]
-        file_name = doc_record["file_name"]
-        
-        print(f"Processing {file_name} ({purpose})...")
-        
-        # 3. Download file from Storage
-        # Assuming bucket is 'mathmentor-materials' as seen in frontend
-        bucket_name = "mathmentor-materials"
-        file_data = supabase.storage.from_(bucket_name).download(source_path)
-        
-        # 4. Extract text
-        ext = Path(file_name).suffix.lower()
-        text = ""
-        if ext == ".pdf":
-            text = extract_text_from_pdf(file_data)
-        elif ext in [".docx", ".doc"]:
-            text = extract_text_from_word(file_data)
-        else:
-            # Try plain text
-            try:
-                text = file_data.decode('utf-8')
-            except:
-                print(f"Unsupported format: {ext}")
-                return
-
-        if not text:
-            print("No text extracted")
-            # Update status to failed
-            supabase.table(meta_table).update({"rag_status": "failed"}).eq("id", document_id).execute()
-            return
-
-        # 5. Chunk text
-        chunks = chunk_text(text)
-        print(f"Generated {len(chunks)} chunks")
-        
-        # 6. Embed and Save Chunks
-        # We'll do this in batches to avoid hitting rate limits or timeouts
-        batch_size = 10
-        
-        for i in range(0, len(chunks), batch_size):
-            batch = chunks[i:i+batch_size]
-            rows_to_insert = []
-            
-            # Create tasks for parallel embedding generation
-            tasks = [generate_embedding(chunk) for chunk in batch]
-            embeddings = await asyncio.gather(*tasks)
-            
-            for idx, chunk_content in enumerate(batch):
-                real_index = i + idx
-                embedding = embeddings[idx]
-                
-                if embedding:
-                    rows_to_insert.append({
-                        "user_id": user_id,
-                        fk_col: document_id,
-                        "chunk_index": real_index,
-                        "content": chunk_content,
-                        "content_length": len(chunk_content),
-                        "source_path": source_path,
-                        "embedding_status": "completed",
-                        "embedding": embedding,
-                        "visibility": doc_record.get("visibility", "private")
-                    })
-            
-            if rows_to_insert:
-                supabase.table(chunk_table).insert(rows_to_insert).execute()
-                print(f"Saved batch {i//batch_size + 1}")
-
-        # 7. Update document status
-        supabase.table(meta_table).update({
-            "rag_status": "ready",
-            "chunk_count": len(chunks)
-        }).eq("id", document_id).execute()
-        
-        print(f"Successfully processed {file_name}")
+        await ingest_document(user_id, document_id, purpose)
         return True
-
     except Exception as e:
         print(f"Error processing document: {e}")
         # Update status to failed
         try:
-            supabase.table(meta_table).update({"rag_status": "failed"}).eq("id", document_id).execute()
+            await mark_document_status(document_id, purpose, "failed")
         except:
             pass
         return False
@@ -180,22 +347,44 @@ async def search_similar_documents(query: str, user_id: str, purpose: str = "cha
     """
     try:
         # 1. Generate query embedding
-        query_embedding = await generate_embedding(query)
+        # Embed câu hỏi rẻ và idempotent: hedge để cắt đuôi p99
+        [query_embedding] = await embed_texts([query], priority=INTERACTIVE, hedge=True)
         if not query_embedding:
-            return []
+            # Embedding lỗi: vẫn trả ngữ cảnh bằng BM25 trên các chunk của user
+            if not vector_index.supports_lexical(purpose):
+                return []
+            print("⚠️ Không embed được câu hỏi, tìm bằng BM25")
+            return await vector_index.search(user_id, purpose, None, limit, 0.0, query_text=query)
         
-        # 2. Call RPC function
+        match_threshold = 0.5  # Adjust threshold as needed
+
+        # 2. Index trong process (RAG_LOCAL_INDEX): không tốn round trip tới DB
+        if vector_index.supports(purpose):
+            try:
+                return await vector_index.search(
+                    user_id, purpose, query_embedding, limit, match_threshold, query_text=query
+                )
+            except Exception as e:
+                print(f"⚠️ Local vector index lỗi, dùng RPC: {e}")
+
+        # 3. Call RPC function
         rpc_name = "match_documents" if purpose == "chat" else "match_test_materials"
         
+        # Hybrid: lấy nhiều ứng viên hơn (ngưỡng thấp hơn), rerank BM25 + RRF tại chỗ
         params = {
             "query_embedding": query_embedding,
-            "match_threshold": 0.5, # Adjust threshold as needed
-            "match_count": limit,
+            "match_threshold": RAG_CANDIDATE_THRESHOLD if RAG_HYBRID else match_threshold,
+            "match_count": limit * RAG_CANDIDATE_FACTOR if RAG_HYBRID else limit,
             "p_user_id": user_id
         }
         
-        response = supabase.rpc(rpc_name, params).execute()
-        return response.data if response.data else []
+        started = time.perf_counter()
+        response = await asyncio.to_thread(lambda: supabase.rpc(rpc_name, params).execute())
+        vector_index.record_remote_search((time.perf_counter() - started) * 1000)
+        docs = response.data if response.data else []
+        if RAG_HYBRID:
+            docs = rerank_documents(query, docs, limit)
+        return docs
         
     except Exception as e:
         print(f"Error searching documents: {e}")
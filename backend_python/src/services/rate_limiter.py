@@ -0,0 +1,243 @@
+# src/services/rate_limiter.py
+"""Process-wide admission control in front of every Gemini call.
+
+A token bucket (``GEMINI_RPM`` requests per minute, ``GEMINI_BURST`` burst)
+is shared by three priority classes:
+
+- ``INTERACTIVE``: chat turns, the student is waiting on the screen.
+- ``GENERATION``: test / exercise / summary generation.
+- ``BACKGROUND``: document ingestion and embeddings.
+
+Waiters are served strictly by priority. Lower classes must also leave a
+reserve of tokens in the bucket, so a batch job never drains the quota that
+the next chat turn needs. Upstream 429s pause the whole bucket for the
+advertised delay (or a jittered exponential backoff) and the call is retried;
+when a class runs out of retries or its wait budget, ``UpstreamRateLimited``
+(``QueueTimeout`` for the local wait budget) turns into HTTP 429 with an
+accurate ``Retry-After``.
+"""
+import asyncio
+import heapq
+import itertools
+import math
+import os
+import random
+import re
+import time
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional, Tuple
+
+from fastapi import HTTPException
+
+INTERACTIVE = 0
+GENERATION = 1
+BACKGROUND = 2
+
+PRIORITY_NAMES = {INTERACTIVE: "interactive", GENERATION: "generation", BACKGROUND: "background"}
+
+GEMINI_RPM = float(os.getenv("GEMINI_RPM", "300"))
+GEMINI_BURST = float(os.getenv("GEMINI_BURST", "20"))
+RATE_LIMIT_BACKOFF_BASE_SECONDS = float(os.getenv("RATE_LIMIT_BACKOFF_BASE_SECONDS", "1"))
+RATE_LIMIT_BACKOFF_MAX_SECONDS = float(os.getenv("RATE_LIMIT_BACKOFF_MAX_SECONDS", "60"))
+
+
+@dataclass(frozen=True)
+class PriorityPolicy:
+    reserve_fraction: float  # phần bucket phải để lại cho lớp ưu tiên cao hơn
+    max_wait: float  # chờ lâu hơn thì trả 429 thay vì treo request
+    max_retries: int  # số lần thử lại khi upstream trả 429
+
+
+POLICIES = {
+    INTERACTIVE: PriorityPolicy(reserve_fraction=0.0, max_wait=15.0, max_retries=2),
+    GENERATION: PriorityPolicy(reserve_fraction=0.2, max_wait=60.0, max_retries=4),
+    BACKGROUND: PriorityPolicy(reserve_fraction=0.5, max_wait=600.0, max_retries=8),
+}
+
+
+class UpstreamRateLimited(HTTPException):
+    """Hết quota Gemini (hoặc chờ quá lâu): trả 429 kèm Retry-After."""
+
+    def __init__(self, retry_after: float, detail: str = "API Google đang quá tải. Vui lòng thử lại sau.") -> None:
+        self.retry_after = max(1, math.ceil(retry_after))
+        super().__init__(status_code=429, detail=detail, headers={"Retry-After": str(self.retry_after)})
+
+
+class QueueTimeout(UpstreamRateLimited):
+    """Chờ token quá ``max_wait`` ở hàng đợi cục bộ (upstream không hề được gọi)."""
+
+
+_RETRY_DELAY_RE = re.compile(r"retry[_ ]delay\D*?(\d+(?:\.\d+)?)", re.IGNORECASE)
+
+
+def is_rate_limit_error(exc: BaseException) -> bool:
+    if isinstance(exc, UpstreamRateLimited):
+        return False
+    if getattr(exc, "code", None) == 429 or type(exc).__name__ == "ResourceExhausted":
+        return True
+    return "RESOURCE_EXHAUSTED" in str(exc)
+
+
+def retry_after_from(exc: BaseException) -> Optional[float]:
+    """Đọc thời gian chờ upstream gợi ý (RetryInfo.retry_delay) nếu có."""
+    match = _RETRY_DELAY_RE.search(str(exc))
+    return float(match.group(1)) if match else None
+
+
+class TokenBucketLimiter:
+    def __init__(self, rpm: float = GEMINI_RPM, burst: float = GEMINI_BURST) -> None:
+        self.rate = rpm / 60.0
+        self.capacity = max(1.0, burst)
+        self.tokens = self.capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._waiters: List[Tuple[int, int, asyncio.Future]] = []
+        self._seq = itertools.count()
+        self._wakeup: Optional[asyncio.TimerHandle] = None
+        self._stats: Dict[int, Dict[str, float]] = {
+            p: {"admitted": 0, "rejected": 0, "upstream_429": 0, "retries": 0, "wait_ms_total": 0.0}
+            for p in PRIORITY_NAMES
+        }
+
+    # ----- bucket -----
+
+    def _refill(self, now: float) -> None:
+        if now < self._paused_until:
+            self._updated = now
+            return
+        start = max(self._updated, self._paused_until)
+        self.tokens = min(self.capacity, self.tokens + (now - start) * self.rate)
+        self._updated = now
+
+    def _floor(self, priority: int) -> float:
+        return self.capacity * POLICIES[priority].reserve_fraction
+
+    def _eta(self, priority: int, now: float) -> float:
+        """Ước lượng thời gian tới khi lớp này lấy được token (không tính hàng đợi)."""
+        need = self._floor(priority) + 1 - self.tokens
+        delay = max(0.0, self._paused_until - now)
+        if need > 0:
+            delay += need / self.rate
+        return delay
+
+    def _queued_ahead(self, priority: int) -> int:
+        return sum(1 for p, _, fut in self._waiters if p <= priority and not fut.done())
+
+    def _dispatch(self) -> None:
+        """Cấp token cho các waiter theo thứ tự ưu tiên; hẹn giờ gọi lại nếu còn người chờ."""
+        self._wakeup = None
+        now = time.monotonic()
+        self._refill(now)
+        while self._waiters:
+            priority, _, fut = self._waiters[0]
+            if fut.done():
+                heapq.heappop(self._waiters)
+                continue
+            if now < self._paused_until or self.tokens < self._floor(priority) + 1:
+                break
+            heapq.heappop(self._waiters)
+            self.tokens -= 1
+            fut.set_result(None)
+        if self._waiters:
+            priority = self._waiters[0][0]
+            delay = max(0.01, self._eta(priority, now))
+            self._wakeup = asyncio.get_running_loop().call_later(delay, self._dispatch)
+
+    async def acquire(self, priority: int = GENERATION) -> None:
+        policy = POLICIES[priority]
+        stats = self._stats[priority]
+        now = time.monotonic()
+        self._refill(now)
+
+        # Lớp thấp hơn đang xếp hàng (vì reserve) không chặn lớp cao hơn
+        ahead = self._queued_ahead(priority)
+        if not ahead and now >= self._paused_until and self.tokens >= self._floor(priority) + 1:
+            self.tokens -= 1
+            stats["admitted"] += 1
+            return
+
+        # Ước lượng chờ: thời gian hồi token + số người ưu tiên bằng/cao hơn đang xếp hàng
+        estimate = self._eta(priority, now) + ahead / self.rate
+        if estimate > policy.max_wait:
+            stats["rejected"] += 1
+            raise QueueTimeout(estimate)
+
+        fut = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._seq), fut))
+        if self._wakeup is not None:
+            self._wakeup.cancel()
+        self._dispatch()
+        try:
+            await asyncio.wait_for(asyncio.shield(fut), timeout=policy.max_wait)
+        except asyncio.TimeoutError:
+            fut.cancel()
+            stats["rejected"] += 1
+            raise QueueTimeout(self._eta(priority, time.monotonic()))
+        except asyncio.CancelledError:
+            if fut.done() and not fut.cancelled():
+                # Đã được cấp token nhưng caller huỷ: trả lại token
+                self.tokens = min(self.capacity, self.tokens + 1)
+            fut.cancel()
+            raise
+        stats["admitted"] += 1
+        stats["wait_ms_total"] += (time.monotonic() - now) * 1000
+
+    def penalize(self, delay: float) -> None:
+        """Upstream trả 429: dừng cấp token cho mọi lớp trong ``delay`` giây."""
+        now = time.monotonic()
+        self._refill(now)
+        self.tokens = 0.0
+        self._paused_until = max(self._paused_until, now + delay)
+
+    def backoff_delay(self, attempt: int, hinted: Optional[float]) -> float:
+        """Exponential backoff có jitter (full jitter), tôn trọng thời gian upstream gợi ý."""
+        cap = min(RATE_LIMIT_BACKOFF_MAX_SECONDS, RATE_LIMIT_BACKOFF_BASE_SECONDS * (2 ** attempt))
+        delay = random.uniform(cap / 2, cap)
+        return max(delay, hinted or 0.0)
+
+    async def call(self, priority: int, fn) -> Any:
+        """Chạy ``fn()`` (coroutine factory) sau khi được cấp token; thử lại khi gặp 429."""
+        policy = POLICIES[priority]
+        stats = self._stats[priority]
+        attempt = 0
+        while True:
+            await self.acquire(priority)
+            try:
+                return await fn()
+            except Exception as e:
+                if not is_rate_limit_error(e):
+                    raise
+                stats["upstream_429"] += 1
+                delay = self.backoff_delay(attempt, retry_after_from(e))
+                self.penalize(delay)
+                if attempt >= policy.max_retries:
+                    raise UpstreamRateLimited(delay) from e
+                attempt += 1
+                stats["retries"] += 1
+                print(f"⏳ Gemini 429 ({PRIORITY_NAMES[priority]}), thử lại lần {attempt} sau {delay:.1f}s")
+
+    def stats(self) -> Dict[str, Any]:
+        now = time.monotonic()
+        self._refill(now)
+        return {
+            "rpm": round(self.rate * 60, 1),
+            "tokens": round(self.tokens, 2),
+            "paused_for": round(max(0.0, self._paused_until - now), 1),
+            "waiting": {
+                PRIORITY_NAMES[p]: sum(1 for q, _, f in self._waiters if q == p and not f.done())
+                for p in PRIORITY_NAMES
+            },
+            "classes": {
+                PRIORITY_NAMES[p]: {
+                    "admitted": int(s["admitted"]),
+                    "rejected": int(s["rejected"]),
+                    "upstream_429": int(s["upstream_429"]),
+                    "retries": int(s["retries"]),
+                    "avg_wait_ms": round(s["wait_ms_total"] / s["admitted"], 1) if s["admitted"] else 0.0,
+                }
+                for p, s in self._stats.items()
+            },
+        }
+
+
+rate_limiter = TokenBucketLimiter()
@@ -0,0 +1,247 @@
+# src/services/reference_corpus.py
+"""Extracted-text cache for the ``reference_materials`` folders.
+
+``/api/generate-exercises`` and ``/api/generate-test`` used to re-open and
+re-parse the same PDF/DOCX files on every request. Here each file's text is
+keyed by (path, mtime, size):
+
+- in memory for the request path, which only concatenates cached text and
+  never opens a source file;
+- on disk (``REFERENCE_CACHE_DIR``, one JSON per source file) so a restart
+  does not re-parse unchanged files;
+- folders are scanned at startup (``start``) and then watched: with
+  ``watchfiles`` (installed with ``uvicorn[standard]``) changes are picked up
+  as they happen, otherwise the folders are polled every
+  ``REFERENCE_WATCH_SECONDS``. Changed files are re-extracted in a thread,
+  deleted ones are dropped.
+"""
+import asyncio
+import hashlib
+import json
+import os
+import threading
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Sequence, Tuple
+
+from src.utils.file_utils import extract_text_from_file
+
+try:
+    from watchfiles import awatch
+except ImportError:  # pragma: no cover - chỉ còn polling
+    awatch = None
+
+REFERENCE_CACHE_DIR = os.getenv(
+    "REFERENCE_CACHE_DIR",
+    str(Path(__file__).resolve().parent.parent.parent / "cache" / "reference_text"),
+)
+REFERENCE_WATCH_SECONDS = float(os.getenv("REFERENCE_WATCH_SECONDS", "10"))
+REFERENCE_EXTENSIONS = (".pdf", ".docx", ".doc")
+
+
+@dataclass
+class CorpusFile:
+    path: str
+    mtime_ns: int
+    size: int
+    text: str
+
+
+class ReferenceCorpus:
+    def __init__(self, cache_dir: str = REFERENCE_CACHE_DIR) -> None:
+        self.cache_dir = Path(cache_dir)
+        self._files: Dict[str, CorpusFile] = {}
+        self._folders: Dict[str, List[str]] = {}  # thư mục -> file theo thứ tự (pdf, docx, doc)
+        self._combined: Dict[Tuple[str, int], str] = {}
+        self._version = 0  # tăng mỗi khi cache thay đổi: bản ghép cũ không được lưu lại
+        self._scan_lock = threading.Lock()
+        self._folders_watched: List[Path] = []
+        self._warmed: Optional[asyncio.Event] = None
+        self._task: Optional["asyncio.Task[None]"] = None
+        self._listeners: List[Callable[[Path], Awaitable[None]]] = []
+        self.extractions = 0
+        self.disk_loads = 0
+        self.hits = 0
+        self.builds = 0
+        self.scans = 0
+
+    # ----- đĩa -----
+
+    def _disk_path(self, path: str) -> Path:
+        return self.cache_dir / f"{hashlib.sha256(path.encode('utf-8')).hexdigest()}.json"
+
+    def _read_disk(self, path: str, mtime_ns: int, size: int) -> Optional[CorpusFile]:
+        try:
+            data = json.loads(self._disk_path(path).read_text(encoding="utf-8"))
+        except (OSError, ValueError):
+            return None
+        if (data.get("path"), data.get("mtime_ns"), data.get("size")) != (path, mtime_ns, size):
+            return None
+        return CorpusFile(path, mtime_ns, size, data.get("text") or "")
+
+    def _write_disk(self, entry: CorpusFile) -> None:
+        target = self._disk_path(entry.path)
+        try:
+            target.parent.mkdir(parents=True, exist_ok=True)
+            tmp = target.with_suffix(".tmp")
+            tmp.write_text(json.dumps(entry.__dict__, ensure_ascii=False), encoding="utf-8")
+            os.replace(tmp, target)
+        except OSError as e:
+            print(f"⚠️ Không ghi được cache tài liệu mẫu {target}: {e}")
+
+    # ----- quét (chạy trong thread) -----
+
+    @staticmethod
+    def _list(folder: Path) -> List[Path]:
+        files: List[Path] = []
+        for extension in REFERENCE_EXTENSIONS:
+            files.extend(sorted(folder.glob(f"*{extension}")))
+        return files
+
+    def _load(self, file: Path) -> Optional[CorpusFile]:
+        """Text của file theo (path, mtime, size): bộ nhớ -> đĩa -> trích xuất."""
+        try:
+            st = file.stat()
+        except OSError:
+            return None
+        path = str(file)
+        entry = self._files.get(path)
+        if entry is not None and (entry.mtime_ns, entry.size) == (st.st_mtime_ns, st.st_size):
+            return entry
+        entry = self._read_disk(path, st.st_mtime_ns, st.st_size)
+        if entry is not None:
+            self.disk_loads += 1
+        else:
+            print(f"📄 Loading: {file.name}")
+            entry = CorpusFile(path, st.st_mtime_ns, st.st_size, extract_text_from_file(path))
+            self.extractions += 1
+            self._write_disk(entry)
+        return entry
+
+    def scan(self, folder: Path) -> bool:
+        """Đồng bộ cache với thư mục; True nếu có thay đổi."""
+        with self._scan_lock:
+            self.scans += 1
+            key = str(folder)
+            files = self._list(folder) if folder.exists() else []
+            paths = [str(f) for f in files]
+            changed = paths != self._folders.get(key)
+            for file in files:
+                entry = self._load(file)
+                if entry is None:
+                    paths.remove(str(file))
+                    changed = True
+                elif self._files.get(entry.path) is not entry:
+                    self._files[entry.path] = entry
+                    changed = True
+            for path in set(self._folders.get(key, [])) - set(paths):
+                self._files.pop(path, None)
+                self._disk_path(path).unlink(missing_ok=True)
+            if changed:
+                self._folders[key] = paths
+                self._version += 1
+                self._combined = {k: v for k, v in self._combined.items() if k[0] != key}
+            return changed
+
+    async def _scan_all(self) -> List[Path]:
+        """Quét mọi thư mục theo dõi; trả về các thư mục đã thay đổi."""
+        changed: List[Path] = []
+        for folder in self._folders_watched:
+            try:
+                if await asyncio.to_thread(self.scan, folder):
+                    print(f"📚 Tài liệu mẫu {folder.name}: {len(self._folders[str(folder)])} file")
+                    changed.append(folder)
+            except Exception as e:
+                print(f"⚠️ Không quét được {folder}: {e}")
+        return changed
+
+    async def _notify(self, folders: List[Path]) -> None:
+        for folder in folders:
+            for listener in self._listeners:
+                try:
+                    await listener(folder)
+                except Exception as e:
+                    print(f"⚠️ Cập nhật theo tài liệu mẫu {folder.name} lỗi: {e}")
+
+    async def _watch(self) -> None:
+        await self._scan_all()
+        self._warmed.set()
+        await self._notify(self._folders_watched)
+        if awatch is not None:
+            try:
+                async for _ in awatch(*self._folders_watched):
+                    await self._notify(await self._scan_all())
+            except Exception as e:
+                print(f"⚠️ watchfiles lỗi, chuyển sang polling: {e}")
+        while True:
+            await asyncio.sleep(REFERENCE_WATCH_SECONDS)
+            await self._notify(await self._scan_all())
+
+    # ----- API -----
+
+    def subscribe(self, listener: Callable[[Path], Awaitable[None]]) -> None:
+        """Gọi ``listener(folder)`` sau lần quét đầu và mỗi khi thư mục thay đổi."""
+        self._listeners.append(listener)
+
+    def files(self, folder: Path) -> List[CorpusFile]:
+        """Các file đã trích xuất của thư mục, theo thứ tự quét."""
+        entries = (self._files.get(path) for path in self._folders.get(str(folder), []))
+        return [entry for entry in entries if entry is not None]
+
+    def start(self, folders: Sequence[Path]) -> None:
+        """Warm cache (nền) rồi theo dõi thay đổi trong các thư mục."""
+        if self._task is not None:
+            return
+        self._folders_watched = [Path(f) for f in folders]
+        self._warmed = asyncio.Event()
+        self._task = asyncio.create_task(self._watch())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def text(self, folder: Path, max_files: int = 5) -> str:
+        """Tài liệu mẫu đã ghép của thư mục, chỉ từ cache (request không đọc file nguồn).
+
+        Request đến trước khi warm xong thì chờ lần quét đầu (PrepStep giới hạn thời gian chờ).
+        """
+        key = (str(folder), max_files)
+        cached = self._combined.get(key)
+        if cached is not None:
+            self.hits += 1
+            return cached
+        if key[0] not in self._folders:
+            if self._warmed is not None:
+                await self._warmed.wait()
+            if key[0] not in self._folders:
+                await asyncio.to_thread(self.scan, Path(folder))  # thư mục chưa đăng ký theo dõi
+
+        version = self._version
+        parts = []
+        for path in self._folders.get(key[0], [])[:max_files]:
+            entry = self._files.get(path)
+            if entry is not None and entry.text:
+                parts.append(f"\n\n=== TÀI LIỆU: {Path(path).name} ===\n{entry.text}\n")
+        combined = "".join(parts)
+        if version == self._version:
+            self._combined[key] = combined
+        self.builds += 1
+        return combined
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "folders": {Path(k).name: len(v) for k, v in self._folders.items()},
+            "files": len(self._files),
+            "chars": sum(len(entry.text) for entry in self._files.values()),
+            "watcher": "watchfiles" if awatch is not None else "polling",
+            "extractions": self.extractions,
+            "disk_loads": self.disk_loads,
+            "hits": self.hits,
+            "builds": self.builds,
+            "scans": self.scans,
+        }
+
+
+reference_corpus = ReferenceCorpus()
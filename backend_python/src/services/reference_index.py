@@ -0,0 +1,198 @@
+# src/services/reference_index.py
+"""Retrieval over the ``reference_materials`` folders.
+
+``/api/generate-exercises`` and ``/api/generate-test`` used to paste whole
+reference files (often tens of thousands of tokens) into the prompt whatever
+the topic. Each folder now has a small local index:
+
+- the text cached by ``reference_corpus`` is chunked with the RAG chunker and
+  embedded once (through ``embed_texts``, so unchanged chunks come from the
+  embedding cache when a file is added or edited);
+- vectors are L2-normalized float32 saved as ``<folder>.npy`` next to a
+  ``<folder>.json`` with the chunk texts under ``REFERENCE_INDEX_DIR``;
+  startup maps the array with ``np.load(mmap_mode="r")`` (zero-copy, pages
+  come from the OS cache) and only rebuilds when the corpus changed;
+- ``passages`` ranks chunks for the request topic (cosine + BM25, fused like
+  user RAG) and returns the top ``REFERENCE_TOP_K`` within
+  ``REFERENCE_TOKEN_BUDGET`` tokens.
+
+Until a folder has an index (first boot, embedding errors) the whole-file
+text from ``reference_corpus`` is used as before.
+"""
+import asyncio
+import hashlib
+import json
+import os
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+
+from src.services.chunker import split_into_chunks
+from src.services.lexical_index import RAG_CANDIDATE_FACTOR, BM25Index, hybrid_rank, tokenize
+from src.services.prompt_assembler import count_tokens
+from src.services.rag_service import EMBEDDING_MODEL, embed_texts
+from src.services.rate_limiter import INTERACTIVE
+from src.services.reference_corpus import reference_corpus
+
+REFERENCE_INDEX_DIR = os.getenv(
+    "REFERENCE_INDEX_DIR",
+    str(Path(__file__).resolve().parent.parent.parent / "cache" / "reference_index"),
+)
+REFERENCE_TOP_K = int(os.getenv("REFERENCE_TOP_K", "6"))
+REFERENCE_TOKEN_BUDGET = int(os.getenv("REFERENCE_TOKEN_BUDGET", "2500"))
+
+
+def _format(passage: Dict[str, str]) -> str:
+    return f"\n\n=== TÀI LIỆU: {passage['file']} ===\n{passage['text']}\n"
+
+
+class FolderIndex:
+    def __init__(self, signature: str, chunks: List[Dict[str, str]], matrix: np.ndarray) -> None:
+        self.signature = signature
+        self.chunks = chunks
+        self.matrix = matrix
+        self.lexical = BM25Index()
+        self.lexical.add([chunk["text"] for chunk in chunks])
+
+    def rank(self, query: str, query_embedding: Optional[List[float]], limit: int) -> List[int]:
+        candidates = limit * RAG_CANDIDATE_FACTOR
+        query_tokens = tokenize(query)
+        lexical_ranking = self.lexical.search(query_tokens, candidates)
+        vector_ranking: List[int] = []
+        if query_embedding and len(query_embedding) == self.matrix.shape[1]:
+            q = np.asarray(query_embedding, dtype=np.float32)
+            q /= np.linalg.norm(q) or 1.0
+            scores = self.matrix @ q
+            k = min(candidates, len(scores))
+            top = np.argpartition(-scores, k - 1)[:k]
+            vector_ranking = [int(i) for i in top[np.argsort(-scores[top])]]
+        texts = {i: self.chunks[i]["text"] for i in set(vector_ranking) | set(lexical_ranking)}
+        return hybrid_rank(query_tokens, texts, vector_ranking, lexical_ranking, limit)
+
+
+class ReferenceIndex:
+    def __init__(self, index_dir: str = REFERENCE_INDEX_DIR) -> None:
+        self.index_dir = Path(index_dir)
+        self._indexes: Dict[str, FolderIndex] = {}
+        self.builds = 0
+        self.searches = 0
+        self.fallbacks = 0
+
+    def _paths(self, folder: Path):
+        return self.index_dir / f"{folder.name}.npy", self.index_dir / f"{folder.name}.json"
+
+    # ----- load / build -----
+
+    def load(self, folders: List[Path]) -> None:
+        """Map index đã lưu (mmap, không đọc cả file vào RAM) khi khởi động."""
+        for folder in folders:
+            matrix_path, meta_path = self._paths(folder)
+            try:
+                meta = json.loads(meta_path.read_text(encoding="utf-8"))
+                matrix = np.load(matrix_path, mmap_mode="r")
+            except (OSError, ValueError):
+                continue
+            if matrix.shape[0] != len(meta["chunks"]):
+                continue
+            self._indexes[str(folder)] = FolderIndex(meta["signature"], meta["chunks"], matrix)
+            print(f"🗂️ Reference index {folder.name}: {len(meta['chunks'])} chunks (mmap)")
+
+    @staticmethod
+    def _chunks(folder: Path) -> List[Dict[str, str]]:
+        return [
+            {"file": Path(entry.path).name, "text": chunk}
+            for entry in reference_corpus.files(folder)
+            for chunk in split_into_chunks(entry.text)
+        ]
+
+    @staticmethod
+    def _signature(chunks: List[Dict[str, str]]) -> str:
+        digest = hashlib.sha256(EMBEDDING_MODEL.encode("utf-8"))
+        for chunk in chunks:
+            digest.update(b"\0" + chunk["file"].encode("utf-8") + b"\0" + chunk["text"].encode("utf-8"))
+        return digest.hexdigest()
+
+    def _save(self, folder: Path, signature: str, chunks: List[Dict[str, str]], vectors: np.ndarray) -> np.ndarray:
+        """Ghi .npy + .json (file tạm rồi replace), trả về bản mmap của ma trận vừa ghi."""
+        matrix_path, meta_path = self._paths(folder)
+        self.index_dir.mkdir(parents=True, exist_ok=True)
+        tmp_matrix, tmp_meta = matrix_path.with_suffix(".npy.tmp"), meta_path.with_suffix(".json.tmp")
+        with open(tmp_matrix, "wb") as file:
+            np.save(file, vectors)
+        tmp_meta.write_text(json.dumps({"signature": signature, "chunks": chunks}, ensure_ascii=False), encoding="utf-8")
+        os.replace(tmp_matrix, matrix_path)
+        os.replace(tmp_meta, meta_path)
+        return np.load(matrix_path, mmap_mode="r")
+
+    async def rebuild(self, folder: Path) -> None:
+        """Chunk + embed lại thư mục nếu nội dung đổi (listener của reference_corpus)."""
+        chunks = await asyncio.to_thread(self._chunks, folder)
+        signature = self._signature(chunks)
+        current = self._indexes.get(str(folder))
+        if current is not None and current.signature == signature:
+            return
+        if not chunks:
+            self._indexes.pop(str(folder), None)
+            return
+
+        try:
+            embeddings = await embed_texts([chunk["text"] for chunk in chunks])
+        except Exception as e:
+            # Lỗi embedding: giữ index cũ (hoặc text nguyên file), thử lại ở lần thay đổi / khởi động sau
+            # (các batch đã embed xong nằm trong embedding_cache)
+            print(f"⚠️ Reference index {folder.name}: lỗi embedding ({e})")
+            return
+
+        vectors = np.asarray(embeddings, dtype=np.float32)
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        vectors /= norms
+        matrix = await asyncio.to_thread(self._save, folder, signature, chunks, vectors)
+        self._indexes[str(folder)] = FolderIndex(signature, chunks, matrix)
+        self.builds += 1
+        print(f"🗂️ Reference index {folder.name}: {len(chunks)} chunks")
+
+    # ----- API -----
+
+    async def passages(
+        self,
+        folder: Path,
+        query: str,
+        max_files: int = 3,
+        top_k: int = REFERENCE_TOP_K,
+        token_budget: int = REFERENCE_TOKEN_BUDGET,
+    ) -> List[str]:
+        """Đoạn tài liệu mẫu liên quan tới ``query`` (theo thứ tự xếp hạng, trong ngân sách token)."""
+        index = self._indexes.get(str(folder))
+        if index is None or not query:
+            self.fallbacks += 1
+            text = await reference_corpus.text(folder, max_files)
+            return [text] if text else []
+
+        [query_embedding] = await embed_texts([query], priority=INTERACTIVE, hedge=True)
+        chosen = await asyncio.to_thread(index.rank, query, query_embedding, top_k)
+        self.searches += 1
+        result: List[str] = []
+        used = 0
+        for i in chosen:
+            passage = _format(index.chunks[i])
+            tokens = count_tokens(passage)
+            if used + tokens > token_budget:
+                continue
+            result.append(passage)
+            used += tokens
+        return result
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "folders": {Path(k).name: len(idx.chunks) for k, idx in self._indexes.items()},
+            "bytes": sum(int(idx.matrix.nbytes) for idx in self._indexes.values()),
+            "builds": self.builds,
+            "searches": self.searches,
+            "fallbacks": self.fallbacks,
+        }
+
+
+reference_index = ReferenceIndex()
+reference_corpus.subscribe(reference_index.rebuild)
@@ -0,0 +1,87 @@
+# src/services/request_prep.py
+"""Concurrent request preparation before the LLM call.
+
+Generation endpoints need several independent inputs before they can build a
+prompt (RAG retrieval, reference files, chat media). ``RequestPreparer.run``
+starts them together and waits for all of them, so pre-LLM latency is the
+slowest step instead of the sum. Every step has its own timeout; an optional
+step that times out or fails falls back to its default (e.g. no RAG context)
+instead of blocking the request. Required steps re-raise.
+"""
+import asyncio
+import os
+import time
+from dataclasses import dataclass
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+RAG_STEP_TIMEOUT_SECONDS = float(os.getenv("RAG_STEP_TIMEOUT_SECONDS", "3"))
+REFERENCE_STEP_TIMEOUT_SECONDS = float(os.getenv("REFERENCE_STEP_TIMEOUT_SECONDS", "8"))
+MEDIA_STEP_TIMEOUT_SECONDS = float(os.getenv("MEDIA_STEP_TIMEOUT_SECONDS", "20"))
+
+
+@dataclass
+class PrepStep:
+    name: str
+    run: Callable[[], Awaitable[Any]]
+    timeout: Optional[float] = None
+    default: Any = None
+    required: bool = False
+
+
+@dataclass
+class _StepStats:
+    calls: int = 0
+    timeouts: int = 0
+    errors: int = 0
+    total_ms: float = 0.0
+    max_ms: float = 0.0
+
+
+class RequestPreparer:
+    def __init__(self) -> None:
+        self._stats: Dict[str, _StepStats] = {}
+
+    async def _run_step(self, step: PrepStep) -> Any:
+        stats = self._stats.setdefault(step.name, _StepStats())
+        stats.calls += 1
+        started = time.perf_counter()
+        try:
+            if step.timeout:
+                return await asyncio.wait_for(step.run(), timeout=step.timeout)
+            return await step.run()
+        except asyncio.TimeoutError:
+            stats.timeouts += 1
+            if step.required:
+                raise
+            print(f"⏱️ Bước '{step.name}' quá {step.timeout}s, tiếp tục không có kết quả")
+            return step.default
+        except Exception as e:
+            stats.errors += 1
+            if step.required:
+                raise
+            print(f"⚠️ Bước '{step.name}' lỗi, bỏ qua: {e}")
+            return step.default
+        finally:
+            elapsed = (time.perf_counter() - started) * 1000
+            stats.total_ms += elapsed
+            stats.max_ms = max(stats.max_ms, elapsed)
+
+    async def run(self, *steps: PrepStep) -> Dict[str, Any]:
+        """Chạy song song các bước, trả ``{name: kết quả}``."""
+        results = await asyncio.gather(*(self._run_step(s) for s in steps))
+        return {step.name: result for step, result in zip(steps, results)}
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            name: {
+                "calls": s.calls,
+                "timeouts": s.timeouts,
+                "errors": s.errors,
+                "avg_ms": round(s.total_ms / s.calls, 1) if s.calls else 0.0,
+                "max_ms": round(s.max_ms, 1),
+            }
+            for name, s in self._stats.items()
+        }
+
+
+request_prep = RequestPreparer()
@@ -0,0 +1,205 @@
+# src/services/semantic_cache.py
+"""Embedding-keyed cache of chat answers for repeated first-turn questions.
+
+Many students ask near-identical questions on the same mindmap topic. For a
+first turn with no history, no media and no personal RAG context the answer
+does not depend on the student, so we embed the question (reusing
+``rag_service.generate_embedding``) and look it up by cosine similarity in a
+small in-process vector index per topic.
+
+Cosine alone is not enough for math: "giải x^2-5x+6=0" and "giải x^2-5x+7=0"
+embed almost identically. A hit therefore also requires the question's
+formula tokens (``$...$`` spans, numbers, expressions with operators) to be
+exactly equal (``math_signature``).
+"""
+import os
+import re
+import time
+import unicodedata
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+
+from src.services.rate_limiter import INTERACTIVE
+
+SEMANTIC_CACHE_ENABLED = os.getenv("SEMANTIC_CACHE_ENABLED", "1") == "1"
+SEMANTIC_CACHE_THRESHOLD = float(os.getenv("SEMANTIC_CACHE_THRESHOLD", "0.95"))
+SEMANTIC_CACHE_MAX_PER_TOPIC = int(os.getenv("SEMANTIC_CACHE_MAX_PER_TOPIC", "256"))
+SEMANTIC_CACHE_MAX_TOPICS = int(os.getenv("SEMANTIC_CACHE_MAX_TOPICS", "128"))
+SEMANTIC_CACHE_TTL_SECONDS = int(os.getenv("SEMANTIC_CACHE_TTL_SECONDS", str(24 * 3600)))
+
+DEFAULT_TOPIC = "general"
+
+_MATH_SPAN_RE = re.compile(r"\$\$.+?\$\$|\$[^$]+\$|\\\(.+?\\\)|\\\[.+?\\\]", re.DOTALL)
+_OPERATOR_SPACE_RE = re.compile(r"\s*([=+\-*/^<>≤≥≠])\s*")
+_FORMULA_CHARS = set("0123456789=+-*/^<>≤≥≠√∫()[]{}|!%")
+_TRAILING_PUNCTUATION = ".,;:?!…"
+
+
+def normalize_question(text: str) -> str:
+    """Chuẩn hoá câu hỏi trước khi embed (Unicode NFC, khoảng trắng, chữ thường)."""
+    text = unicodedata.normalize("NFC", text or "").strip().lower()
+    return re.sub(r"\s+", " ", text)
+
+
+def math_signature(text: str) -> Tuple[str, ...]:
+    """Các token công thức của câu hỏi theo thứ tự: span LaTeX (bỏ khoảng trắng),
+    rồi các từ ngoài LaTeX có chữ số / toán tử (``x^2-5x+6=0``, ``6``, ``=``)."""
+    text = normalize_question(text)
+    spans = [re.sub(r"\s+", "", span) for span in _MATH_SPAN_RE.findall(text)]
+    rest = _OPERATOR_SPACE_RE.sub(r"\1", _MATH_SPAN_RE.sub(" ", text))  # "x + 1" == "x+1"
+    words = (word.strip(_TRAILING_PUNCTUATION) for word in rest.split())
+    formula = [word for word in words if any(c in _FORMULA_CHARS for c in word)]
+    return tuple(spans + formula)
+
+
+@dataclass
+class _Entry:
+    question: str
+    payload: Dict[str, Any]
+    signature: Tuple[str, ...] = ()
+    created_at: float = field(default_factory=time.time)
+    last_hit: float = field(default_factory=time.time)
+    hits: int = 0
+
+
+class _TopicIndex:
+    """Ma trận embedding đã chuẩn hoá (float32) + entry tương ứng theo hàng."""
+
+    def __init__(self) -> None:
+        self.vectors: Optional[np.ndarray] = None
+        self.entries: List[_Entry] = []
+        self.lookups = 0
+        self.hits = 0
+
+    def search(self, query: np.ndarray, threshold: float, signature: Tuple[str, ...]) -> int:
+        """Entry giống nhất có cosine >= threshold và cùng token công thức (-1 nếu không có)."""
+        if self.vectors is None or not self.entries:
+            return -1
+        scores = self.vectors @ query
+        for idx in np.argsort(-scores):
+            if scores[idx] < threshold:
+                break
+            if self.entries[idx].signature == signature:
+                return int(idx)
+        return -1
+
+    def add(self, vector: np.ndarray, entry: _Entry) -> None:
+        row = vector.reshape(1, -1)
+        self.vectors = row if self.vectors is None else np.vstack([self.vectors, row])
+        self.entries.append(entry)
+
+    def remove(self, indices: List[int]) -> None:
+        if not indices:
+            return
+        keep = [i for i in range(len(self.entries)) if i not in set(indices)]
+        self.entries = [self.entries[i] for i in keep]
+        self.vectors = self.vectors[keep] if keep else None
+
+
+class SemanticAnswerCache:
+    def __init__(
+        self,
+        threshold: float = SEMANTIC_CACHE_THRESHOLD,
+        max_per_topic: int = SEMANTIC_CACHE_MAX_PER_TOPIC,
+        max_topics: int = SEMANTIC_CACHE_MAX_TOPICS,
+        ttl_seconds: int = SEMANTIC_CACHE_TTL_SECONDS,
+    ) -> None:
+        self.threshold = threshold
+        self.max_per_topic = max_per_topic
+        self.max_topics = max_topics
+        self.ttl_seconds = ttl_seconds
+        self._topics: "OrderedDict[str, _TopicIndex]" = OrderedDict()
+        self.lookups = 0
+        self.hits = 0
+        self.evictions = 0
+
+    @staticmethod
+    def topic_key(topic: Optional[str]) -> str:
+        return normalize_question(topic or "") or DEFAULT_TOPIC
+
+    async def embed(self, question: str) -> Optional[np.ndarray]:
+        from src.services import rag_service
+
+        embedding = await rag_service.generate_embedding(normalize_question(question), priority=INTERACTIVE)
+        if not embedding:
+            return None
+        vector = np.asarray(embedding, dtype=np.float32)
+        norm = float(np.linalg.norm(vector))
+        return vector / norm if norm else None
+
+    def lookup(self, topic: Optional[str], question: str, vector: np.ndarray) -> Optional[Dict[str, Any]]:
+        """Trả payload đã cache nếu có câu hỏi đủ giống (cosine >= threshold, cùng số / công thức)."""
+        key = self.topic_key(topic)
+        self.lookups += 1
+        index = self._topics.get(key)
+        if index is None:
+            return None
+        self._topics.move_to_end(key)
+        index.lookups += 1
+
+        idx = index.search(vector, self.threshold, math_signature(question))
+        if idx < 0:
+            return None
+        entry = index.entries[idx]
+        if time.time() - entry.created_at > self.ttl_seconds:
+            index.remove([idx])
+            self.evictions += 1
+            return None
+        entry.hits += 1
+        entry.last_hit = time.time()
+        index.hits += 1
+        self.hits += 1
+        return entry.payload
+
+    def store(self, topic: Optional[str], question: str, vector: np.ndarray, payload: Dict[str, Any]) -> None:
+        key = self.topic_key(topic)
+        index = self._topics.get(key)
+        if index is None:
+            index = _TopicIndex()
+            self._topics[key] = index
+        self._topics.move_to_end(key)
+
+        entry = _Entry(question=normalize_question(question), payload=payload, signature=math_signature(question))
+        index.add(vector, entry)
+        self._evict_topic(index)
+        while len(self._topics) > self.max_topics:
+            _, dropped = self._topics.popitem(last=False)
+            self.evictions += len(dropped.entries)
+
+    def _evict_topic(self, index: _TopicIndex) -> None:
+        """Bỏ entry hết hạn, sau đó bỏ entry lâu không được dùng nhất nếu topic quá đầy."""
+        now = time.time()
+        expired = [i for i, e in enumerate(index.entries) if now - e.created_at > self.ttl_seconds]
+        overflow = len(index.entries) - len(expired) - self.max_per_topic
+        if overflow > 0:
+            alive = [i for i in range(len(index.entries)) if i not in set(expired)]
+            alive.sort(key=lambda i: index.entries[i].last_hit)
+            expired.extend(alive[:overflow])
+        if expired:
+            index.remove(expired)
+            self.evictions += len(expired)
+
+    def invalidate_topic(self, topic: Optional[str]) -> bool:
+        return self._topics.pop(self.topic_key(topic), None) is not None
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "enabled": SEMANTIC_CACHE_ENABLED,
+            "lookups": self.lookups,
+            "hits": self.hits,
+            "hit_rate": round(self.hits / self.lookups, 4) if self.lookups else 0.0,
+            "evictions": self.evictions,
+            "topics": {
+                key: {
+                    "entries": len(index.entries),
+                    "hit_rate": round(index.hits / index.lookups, 4) if index.lookups else 0.0,
+                }
+                for key, index in self._topics.items()
+            },
+        }
+
+
+semantic_cache = SemanticAnswerCache()
@@ -0,0 +1,58 @@
+# src/services/single_flight.py
+"""Single-flight coalescing of identical in-flight generations.
+
+The first request for a key (the leader) starts the upstream call as a task;
+identical requests arriving while it runs (followers) await the same task and
+share its result or exception. The task is shielded, so a leader whose client
+disconnects does not cancel the work followers are waiting on. Nothing is
+kept after the task finishes: persistent caching stays with the callers
+(e.g. the generated-test file cache).
+"""
+import asyncio
+import hashlib
+import json
+from typing import Any, Awaitable, Callable, Dict, TypeVar
+
+T = TypeVar("T")
+
+
+def canonical_key(namespace: str, payload: Dict[str, Any]) -> str:
+    """Khoá ổn định cho một request: namespace + sha256 của payload (JSON, sort_keys)."""
+    raw = json.dumps(payload, ensure_ascii=False, sort_keys=True, default=str)
+    return f"{namespace}:{hashlib.sha256(raw.encode('utf-8')).hexdigest()}"
+
+
+class SingleFlight:
+    def __init__(self) -> None:
+        self._inflight: Dict[str, "asyncio.Future[Any]"] = {}
+        self.leaders = 0
+        self.followers = 0
+
+    async def do(self, key: str, fn: Callable[[], Awaitable[T]]) -> T:
+        task = self._inflight.get(key)
+        if task is None:
+            self.leaders += 1
+            task = asyncio.ensure_future(fn())
+            self._inflight[key] = task
+            task.add_done_callback(lambda t: self._forget(key, t))
+        else:
+            self.followers += 1
+            print(f"🔗 Gộp request trùng đang chạy: {key[:40]}")
+        return await asyncio.shield(task)
+
+    def _forget(self, key: str, task: "asyncio.Future[Any]") -> None:
+        if self._inflight.get(key) is task:
+            del self._inflight[key]
+        # Tránh cảnh báo "exception was never retrieved" khi mọi caller đã huỷ
+        if not task.cancelled():
+            task.exception()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "inflight": len(self._inflight),
+            "leaders": self.leaders,
+            "followers": self.followers,
+        }
+
+
+single_flight = SingleFlight()
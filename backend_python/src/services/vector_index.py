@@ -0,0 +1,298 @@
+# src/services/vector_index.py
+"""In-process vector index for per-user RAG retrieval.
+
+With ``RAG_LOCAL_INDEX=true``, ``search_similar_documents`` answers from memory
+instead of calling the ``match_documents`` / ``match_test_materials`` RPCs:
+
+- the first search for a (user, purpose) loads that user's completed chunks
+  from Supabase (paged) into one L2-normalized float32 matrix (``float16``
+  via ``RAG_INDEX_DTYPE`` halves memory at the cost of an upcast per query);
+- a search is a single matmul + ``argpartition`` (exact cosine, brute force;
+  a student's library is thousands of chunks, well below where HNSW pays off),
+  fused with a BM25 index over the same chunks when ``RAG_HYBRID`` is on;
+- without a query embedding (embedding API down) the BM25 index alone ranks
+  the chunks, so chat turns keep some context; ``search_similar_documents``
+  uses this path even with ``RAG_LOCAL_INDEX`` off;
+- ``process_document`` appends new chunks to an already loaded index, and
+  drops it when a re-upload changed or removed existing chunks;
+- indexes idle for ``RAG_INDEX_IDLE_SECONDS`` are evicted, at most
+  ``RAG_INDEX_MAX_USERS`` are kept, and each one is reloaded after
+  ``RAG_INDEX_REFRESH_SECONDS`` to pick up deletions made from the frontend.
+
+Local and RPC search latencies are both tracked in ``stats()`` so the win is
+visible in ``/api/metrics``.
+"""
+import asyncio
+import json
+import os
+import time
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+
+from src.services.lexical_index import (
+    RAG_CANDIDATE_FACTOR,
+    RAG_CANDIDATE_THRESHOLD,
+    RAG_HYBRID,
+    BM25Index,
+    hybrid_rank,
+    tokenize,
+)
+from src.supabase_client import supabase
+
+RAG_LOCAL_INDEX = os.getenv("RAG_LOCAL_INDEX", "false").lower() == "true"
+RAG_INDEX_DTYPE = np.float16 if os.getenv("RAG_INDEX_DTYPE", "float32") == "float16" else np.float32
+RAG_INDEX_IDLE_SECONDS = int(os.getenv("RAG_INDEX_IDLE_SECONDS", "1800"))
+RAG_INDEX_REFRESH_SECONDS = int(os.getenv("RAG_INDEX_REFRESH_SECONDS", "300"))
+RAG_INDEX_MAX_USERS = int(os.getenv("RAG_INDEX_MAX_USERS", "200"))
+
+_PAGE_SIZE = 1000  # giới hạn số dòng mỗi request của PostgREST
+_THREAD_THRESHOLD = 2_000_000  # matrix lớn hơn (phần tử) thì tính trong thread
+
+# purpose -> (bảng chunk, cột khoá ngoại, bảng metadata)
+SOURCES = {
+    "chat": ("document_chunks", "document_id", "user_documents"),
+    "test": ("test_material_chunks", "material_id", "test_materials"),
+}
+
+IndexKey = Tuple[str, str]  # (user_id, purpose)
+
+
+def _parse_embedding(value: Any) -> Optional[List[float]]:
+    """pgvector qua PostgREST trả về chuỗi "[0.1,...]"."""
+    if value is None:
+        return None
+    if isinstance(value, str):
+        value = json.loads(value)
+    return value or None
+
+
+class UserIndex:
+    def __init__(self, rows: List[Dict[str, Any]], vectors: List[List[float]]) -> None:
+        self.rows = rows
+        self.matrix = self._normalize(vectors)
+        self.lexical = BM25Index()
+        self.lexical.add([row["content"] or "" for row in rows])
+        self.loaded_at = time.time()
+        self.last_used = self.loaded_at
+
+    @staticmethod
+    def _normalize(vectors: List[List[float]]) -> np.ndarray:
+        if not vectors:
+            return np.zeros((0, 0), dtype=RAG_INDEX_DTYPE)
+        matrix = np.asarray(vectors, dtype=np.float32)
+        norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        return (matrix / norms).astype(RAG_INDEX_DTYPE)
+
+    def add(self, rows: List[Dict[str, Any]], vectors: List[List[float]]) -> None:
+        extra = self._normalize(vectors)
+        if not len(extra):
+            return
+        self.matrix = extra if not len(self.matrix) else np.vstack([self.matrix, extra])
+        self.rows.extend(rows)
+        self.lexical.add([row["content"] or "" for row in rows])
+
+    @staticmethod
+    def _top(scores: np.ndarray, k: int) -> np.ndarray:
+        k = min(k, len(scores))
+        top = np.argpartition(-scores, k - 1)[:k]
+        return top[np.argsort(-scores[top])]
+
+    def search(
+        self, query: Optional[np.ndarray], query_text: str, limit: int, threshold: float
+    ) -> List[Dict[str, Any]]:
+        if not len(self.rows):
+            return []
+        if query is None:
+            # Không có embedding câu hỏi: chỉ xếp hạng BM25 (+ rerank độ phủ thuật ngữ)
+            query_tokens = tokenize(query_text)
+            lexical_ranking = self.lexical.search(query_tokens, limit * RAG_CANDIDATE_FACTOR)
+            texts = {i: self.rows[i]["content"] or "" for i in lexical_ranking}
+            chosen = hybrid_rank(query_tokens, texts, [], lexical_ranking, limit)
+            return [{**self.rows[i], "similarity": None} for i in chosen]
+        scores = self.matrix.astype(np.float32, copy=False) @ query
+        if not RAG_HYBRID or not query_text:
+            return [
+                {**self.rows[i], "similarity": float(scores[i])}
+                for i in self._top(scores, limit)
+                if scores[i] >= threshold
+            ]
+
+        # Hybrid: nhiều ứng viên từ cả hai phía (ngưỡng cosine thấp hơn), rồi RRF + rerank
+        candidates = limit * RAG_CANDIDATE_FACTOR
+        vector_ranking = [int(i) for i in self._top(scores, candidates) if scores[i] >= RAG_CANDIDATE_THRESHOLD]
+        query_tokens = tokenize(query_text)
+        lexical_ranking = self.lexical.search(query_tokens, candidates)
+        texts = {i: self.rows[i]["content"] or "" for i in set(vector_ranking) | set(lexical_ranking)}
+        chosen = hybrid_rank(query_tokens, texts, vector_ranking, lexical_ranking, limit)
+        return [{**self.rows[i], "similarity": float(scores[i])} for i in chosen]
+
+    @property
+    def nbytes(self) -> int:
+        return int(self.matrix.nbytes)
+
+
+class LocalVectorIndex:
+    def __init__(self) -> None:
+        self._indexes: "OrderedDict[IndexKey, UserIndex]" = OrderedDict()
+        self._loading: Dict[IndexKey, "asyncio.Task[UserIndex]"] = {}
+        self.loads = 0
+        self.evictions = 0
+        self.local_searches = 0
+        self.local_ms_total = 0.0
+        self.remote_searches = 0
+        self.remote_ms_total = 0.0
+
+    @staticmethod
+    def supports(purpose: str) -> bool:
+        return RAG_LOCAL_INDEX and purpose in SOURCES
+
+    @staticmethod
+    def supports_lexical(purpose: str) -> bool:
+        """Tìm BM25 khi không embed được câu hỏi (không phụ thuộc RAG_LOCAL_INDEX)."""
+        return purpose in SOURCES
+
+    # ----- load -----
+
+    @staticmethod
+    def _fetch(user_id: str, purpose: str) -> UserIndex:
+        """Đọc toàn bộ chunk đã embed của user (đồng bộ, chạy trong thread)."""
+        chunk_table, fk_col, meta_table = SOURCES[purpose]
+        rows: List[Dict[str, Any]] = []
+        vectors: List[List[float]] = []
+        start = 0
+        while True:
+            response = (
+                supabase.table(chunk_table)
+                .select(f"id, {fk_col}, chunk_index, content, embedding, {meta_table}(file_name)")
+                .eq("user_id", user_id)
+                .eq("embedding_status", "completed")
+                .order("id")
+                .range(start, start + _PAGE_SIZE - 1)
+                .execute()
+            )
+            page = response.data or []
+            for record in page:
+                embedding = _parse_embedding(record.get("embedding"))
+                if not embedding:
+                    continue
+                meta = record.get(meta_table) or {}
+                rows.append({
+                    "id": record.get("id"),
+                    fk_col: record.get(fk_col),
+                    "chunk_index": record.get("chunk_index"),
+                    "content": record.get("content"),
+                    "file_name": meta.get("file_name"),
+                })
+                vectors.append(embedding)
+            if len(page) < _PAGE_SIZE:
+                break
+            start += _PAGE_SIZE
+        return UserIndex(rows, vectors)
+
+    async def _get(self, user_id: str, purpose: str) -> UserIndex:
+        key = (user_id, purpose)
+        index = self._indexes.get(key)
+        if index is not None and time.time() - index.loaded_at < RAG_INDEX_REFRESH_SECONDS:
+            self._indexes.move_to_end(key)
+            return index
+
+        # Nhiều request cùng lúc của một user chỉ tải một lần
+        task = self._loading.get(key)
+        if task is None:
+            task = asyncio.ensure_future(asyncio.to_thread(self._fetch, user_id, purpose))
+            self._loading[key] = task
+            task.add_done_callback(lambda _: self._loading.pop(key, None))
+        index = await asyncio.shield(task)
+        if self._indexes.get(key) is not index:
+            self.loads += 1
+            self._indexes[key] = index
+            print(f"🧭 Vector index: {len(index.rows)} chunks ({purpose}) cho user {user_id}")
+        self._indexes.move_to_end(key)
+        self._evict()
+        return index
+
+    def _evict(self) -> None:
+        now = time.time()
+        for key in [k for k, idx in self._indexes.items() if now - idx.last_used > RAG_INDEX_IDLE_SECONDS]:
+            del self._indexes[key]
+            self.evictions += 1
+        while len(self._indexes) > RAG_INDEX_MAX_USERS:
+            self._indexes.popitem(last=False)
+            self.evictions += 1
+
+    # ----- API -----
+
+    async def search(
+        self,
+        user_id: str,
+        purpose: str,
+        query_embedding: Optional[List[float]],
+        limit: int,
+        threshold: float,
+        query_text: str = "",
+    ) -> List[Dict[str, Any]]:
+        """Top ``limit`` chunk; ``query_embedding=None`` thì chỉ dùng BM25 trên ``query_text``."""
+        started = time.perf_counter()
+        index = await self._get(user_id, purpose)
+        index.last_used = time.time()
+        query: Optional[np.ndarray] = None
+        if query_embedding:
+            query = np.asarray(query_embedding, dtype=np.float32)
+            query /= np.linalg.norm(query) or 1.0
+        if index.matrix.size > _THREAD_THRESHOLD:
+            results = await asyncio.to_thread(index.search, query, query_text, limit, threshold)
+        else:
+            results = index.search(query, query_text, limit, threshold)
+        self.local_searches += 1
+        self.local_ms_total += (time.perf_counter() - started) * 1000
+        return results
+
+    def add_chunks(
+        self, user_id: str, purpose: str, file_name: str, rows: List[Dict[str, Any]]
+    ) -> None:
+        """Thêm chunk mới ghi từ process_document vào index đang nạp (nếu có)."""
+        index = self._indexes.get((user_id, purpose))
+        if index is None or purpose not in SOURCES:
+            return  # chưa nạp: lần search đầu tiên sẽ đọc cả chunk mới
+        _, fk_col, _ = SOURCES[purpose]
+        index.add(
+            [
+                {
+                    "id": row.get("id"),
+                    fk_col: row.get(fk_col),
+                    "chunk_index": row["chunk_index"],
+                    "content": row["content"],
+                    "file_name": file_name,
+                }
+                for row in rows
+            ],
+            [row["embedding"] for row in rows],
+        )
+
+    def invalidate(self, user_id: str, purpose: str) -> None:
+        """Bỏ index đã nạp (vd: tài liệu được tải lại, chunk bị sửa / xoá); lần search sau sẽ nạp lại."""
+        self._indexes.pop((user_id, purpose), None)
+
+    def record_remote_search(self, elapsed_ms: float) -> None:
+        self.remote_searches += 1
+        self.remote_ms_total += elapsed_ms
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "enabled": RAG_LOCAL_INDEX,
+            "users": len(self._indexes),
+            "chunks": sum(len(idx.rows) for idx in self._indexes.values()),
+            "bytes": sum(idx.nbytes for idx in self._indexes.values()),
+            "loads": self.loads,
+            "evictions": self.evictions,
+            "local_searches": self.local_searches,
+            "local_avg_ms": round(self.local_ms_total / self.local_searches, 2) if self.local_searches else 0.0,
+            "rpc_searches": self.remote_searches,
+            "rpc_avg_ms": round(self.remote_ms_total / self.remote_searches, 2) if self.remote_searches else 0.0,
+        }
+
+
+vector_index = LocalVectorIndex()
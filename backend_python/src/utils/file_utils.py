@@ -1,18 +1,69 @@
 """Shared helpers for reading and extracting text from files."""
+import codecs
+import math
+import os
 from pathlib import Path
-import PyPDF2
+from typing import Iterator, Optional
+
 from docx import Document
 
+from src.utils.pdf_extract import count_pdf_pages, iter_pdf_pages  # nhiều process, timeout từng trang
+
+TEXT_BLOCK_BYTES = 64 * 1024
+WORD_BLOCK_PARAGRAPHS = 50
+
+
+def iter_word_blocks(docx_path: str, paragraphs: int = WORD_BLOCK_PARAGRAPHS) -> Iterator[str]:
+    """Yield a Word (.docx) file's text in groups of paragraphs."""
+    doc = Document(docx_path)
+    block = []
+    for paragraph in doc.paragraphs:
+        block.append(paragraph.text)
+        if len(block) >= paragraphs:
+            yield "\n".join(block) + "\n"
+            block = []
+    if block:
+        yield "\n".join(block) + "\n"
+
+
+def iter_text_blocks(text_path: str, block_bytes: int = TEXT_BLOCK_BYTES) -> Iterator[str]:
+    """Yield a UTF-8 text file in blocks (incremental decoding, never splits a character)."""
+    decoder = codecs.getincrementaldecoder("utf-8")()
+    with open(text_path, "rb") as file:
+        while True:
+            raw = file.read(block_bytes)
+            if not raw:
+                break
+            yield decoder.decode(raw)
+    tail = decoder.decode(b"", final=True)
+    if tail:
+        yield tail
+
+
+def iter_file_text(file_path: str, extension: Optional[str] = None) -> Iterator[str]:
+    """Stream text from PDF, Word or plain-text file based on extension."""
+    extension = (extension or Path(file_path).suffix).lower()
+    if extension == ".pdf":
+        return iter_pdf_pages(file_path)
+    if extension in [".docx", ".doc"]:
+        return iter_word_blocks(file_path)
+    return iter_text_blocks(file_path)
+
+
+def count_file_units(file_path: str, extension: Optional[str] = None) -> int:
+    """Number of pieces ``iter_file_text`` will yield (pages / paragraph groups / text blocks)."""
+    extension = (extension or Path(file_path).suffix).lower()
+    if extension == ".pdf":
+        return count_pdf_pages(file_path)
+    if extension in [".docx", ".doc"]:
+        return math.ceil(len(Document(file_path).paragraphs) / WORD_BLOCK_PARAGRAPHS)
+    return math.ceil(os.path.getsize(file_path) / TEXT_BLOCK_BYTES)
+
 
 def extract_text_from_pdf(pdf_path: str) -> str:
     """Extract text from a PDF file path."""
     try:
-        with open(pdf_path, "rb") as file:
-            pdf_reader = PyPDF2.PdfReader(file)
-            text = ""
-            for page in pdf_reader.pages:
-                text += page.extract_text() + "\n"
-        return text
+        return "".join(iter_pdf_pages(pdf_path))
     except Exception as exc:  # pragma: no cover - defensive logging
         print(f"Error reading PDF {pdf_path}: {exc}")
         return ""
@@ -21,11 +72,7 @@ def extract_text_from_pdf(pdf_path: str) -> str:
 def extract_text_from_word(docx_path: str) -> str:
     """Extract text from a Word (.docx) file path."""
     try:
-        doc = Document(docx_path)
-        text = ""
-        for paragraph in doc.paragraphs:
-            text += paragraph.text + "\n"
-        return text
+        return "".join(iter_word_blocks(docx_path))
     except Exception as exc:  # pragma: no cover - defensive logging
         print(f"Error reading Word file {docx_path}: {exc}")
         return ""
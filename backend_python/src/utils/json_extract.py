@@ -0,0 +1,368 @@
+"""Single-pass extraction and repair of the JSON object in a model answer.
+
+Model answers are "almost JSON": wrapped in ```json fences or prose, with raw
+LaTeX backslashes (``\\frac``, ``\\lim``), raw newlines inside strings, smart
+quotes used as delimiters, unescaped inner quotes and trailing commas.
+``JsonRepairScanner`` walks the text once, starting at the first ``{``, and
+emits repaired JSON up to the matching ``}``; a truncated answer is closed
+off. It can be fed chunk by chunk, so streamed output is repaired as it
+arrives. ``escape_kind`` / ``decode_escape`` are shared with
+``ChatStreamParser`` so both paths read LaTeX the same way.
+"""
+import json
+import re
+from typing import Any, List, Optional, Tuple
+
+JSON_ESCAPES = {
+    '"': '"',
+    "\\": "\\",
+    "/": "/",
+    "b": "\b",
+    "f": "\f",
+    "n": "\n",
+    "r": "\r",
+    "t": "\t",
+}
+
+# Lệnh LaTeX bắt đầu bằng b/f/n/r/t: trùng với escape JSON hợp lệ nên phải
+# nhận diện theo cả từ (vd "\frac" là LaTeX, "\nTa có" là xuống dòng).
+LATEX_ESCAPE_WORDS = frozenset("""
+    backslash bar because begin beta bf big bigcap bigcup bigg binom bmod
+    boldsymbol bot box boxed bullet
+    fbox flat forall frac frown
+    nabla ne neg neq newline nexists ngeq ni nleq nmid not notin nparallel
+    nsubseteq nu
+    rangle rbrace rceil rfloor rho right rightarrow rightleftharpoons rm rvert
+    tan tanh tau text textbf textit textrm tfrac therefore theta tilde times to
+    top triangle triangleq
+""".split())
+
+_HEX = frozenset("0123456789abcdefABCDEF")
+_SMART_DOUBLE_QUOTES = "“”"
+_VALUE_TERMINATORS = ",:}]"
+
+# Các đoạn ký tự "thường" được chép nguyên khối thay vì từng ký tự
+# Trong chuỗi: ký tự thường hoặc cặp "\\x" (để "\\\\" và "\\"" đi theo cặp)
+_STRING_RUN = re.compile(r'(?:[^\\"“”\x00-\x1f\x7f]|\\[^\x00-\x1f\x7f])+')
+_ESCAPE_IN_RUN = re.compile(r"\\(u[0-9a-fA-F]{4}|[bfnrt][A-Za-z]*|.)", re.S)
+_SCALAR_RUN = re.compile(r'[^\s"“”{}\[\],\x00-\x1f\x7f]+')
+_SPACE_RUN = re.compile(r"[ \t\r\n]+")
+# Escape hợp lệ về cú pháp nhưng thực ra là LaTeX (vd "\\frac" bị đọc thành form feed)
+_LATEX_MISREAD = re.compile(
+    r"\\+(?:" + "|".join(sorted(LATEX_ESCAPE_WORDS, key=len, reverse=True)) + r")(?![A-Za-z])"
+)
+
+
+def _is_ascii_letter(ch: str) -> bool:
+    return ("a" <= ch <= "z") or ("A" <= ch <= "Z")
+
+
+def escape_kind(buf: str, pos: int, final: bool = False) -> Tuple[str, int]:
+    """Phân loại dấu ``\\`` tại ``buf[pos]`` bên trong một chuỗi JSON.
+
+    - ``("escape", n)``: escape JSON hợp lệ dài ``n`` ký tự
+    - ``("literal", 1)``: backslash thật (LaTeX như ``\\frac``, ``\\lim``, ``\\(``)
+    - ``("more", 0)``: cần thêm input mới quyết định được
+    """
+    if pos + 1 >= len(buf):
+        return ("literal", 1) if final else ("more", 0)
+    nxt = buf[pos + 1]
+    if nxt in '"\\/':
+        return "escape", 2
+    if nxt == "u":
+        digits = buf[pos + 2:pos + 6]
+        if not all(c in _HEX for c in digits):
+            return "literal", 1
+        if len(digits) == 4:
+            return "escape", 6
+        return ("literal", 1) if final else ("more", 0)
+    if nxt in "bfnrt":
+        end = pos + 1
+        while end < len(buf) and _is_ascii_letter(buf[end]):
+            end += 1
+        if end == len(buf) and not final:
+            return "more", 0
+        if buf[pos + 1:end] in LATEX_ESCAPE_WORDS:
+            return "literal", 1
+        return "escape", 2
+    return "literal", 1
+
+
+def _repair_escape(match: "re.Match") -> str:
+    tail = match.group(1)
+    head = tail[0]
+    if head in '"\\/' or (head == "u" and len(tail) == 5):
+        return match.group(0)
+    if head in "bfnrt" and tail not in LATEX_ESCAPE_WORDS:
+        return match.group(0)
+    return "\\" + match.group(0)
+
+
+def _raw_escape(match: "re.Match") -> str:
+    tail = match.group(1)
+    if tail == '"':
+        return match.group(0)
+    return "\\\\" + tail.replace("\\", "\\\\")
+
+
+def decode_escape(buf: str, pos: int, final: bool = False) -> Tuple[str, int]:
+    """Giải mã escape tại ``buf[pos]``; ``consumed == 0`` nghĩa là cần thêm input."""
+    kind, length = escape_kind(buf, pos, final)
+    if kind == "more":
+        return "", 0
+    if kind == "literal":
+        return "\\", 1
+    if length == 6:
+        return chr(int(buf[pos + 2:pos + 6], 16)), 6
+    return JSON_ESCAPES[buf[pos + 1]], 2
+
+
+class JsonRepairScanner:
+    """Quét một lượt, xuất JSON đã sửa của object ngoài cùng.
+
+    ``raw_backslashes=True`` coi mọi ``\\`` trong chuỗi là ký tự thật (trừ
+    ``\\"``), giữ đúng định dạng đề thi cũ của /api/generate-test.
+    """
+
+    def __init__(self, raw_backslashes: bool = False) -> None:
+        self.raw_backslashes = raw_backslashes
+        self._buf = ""
+        self._pos = 0
+        self._state = "seek"
+        self._stack: List[str] = []
+        self._out: List[str] = []
+        self._emitted = 0
+        self._last_sig: Optional[int] = None
+        self._smart_string = False
+
+    @property
+    def done(self) -> bool:
+        return self._state == "done"
+
+    @property
+    def found(self) -> bool:
+        return self._state != "seek"
+
+    def text(self) -> str:
+        return "".join(self._out)
+
+    def feed(self, chunk: str) -> str:
+        """Nhận thêm output của model; trả phần JSON đã sửa mới sinh ra."""
+        self._buf += chunk
+        self._run(final=False)
+        return self._delta()
+
+    def finish(self) -> str:
+        """Hết input: xử lý phần còn lại và đóng chuỗi/ngoặc còn mở."""
+        self._run(final=True)
+        if self._state == "string":
+            self._out.append('"')
+            self._last_sig = len(self._out) - 1
+            self._state = "object"
+        if self._state == "object":
+            self._drop_trailing_comma()
+            self._out.extend(reversed(self._stack))
+            self._stack.clear()
+            self._state = "done"
+        return self._delta()
+
+    def _delta(self) -> str:
+        end = len(self._out)
+        if self._state != "done" and self._last_sig is not None and self._out[self._last_sig] == ",":
+            # Giữ lại dấu phẩy cho tới khi biết nó không phải dấu phẩy thừa
+            end = self._last_sig
+        delta = "".join(self._out[self._emitted:end])
+        self._emitted = end
+        return delta
+
+    def _emit_sig(self, text: str) -> None:
+        self._out.append(text)
+        self._last_sig = len(self._out) - 1
+
+    def _drop_trailing_comma(self) -> None:
+        if self._last_sig is not None and self._out[self._last_sig] == ",":
+            self._out[self._last_sig] = ""
+
+    def _string_ends_here(self, after: int, final: bool) -> Optional[bool]:
+        """Dấu nháy là kết thúc chuỗi nếu theo sau (bỏ khoảng trắng) là , : } ]."""
+        buf = self._buf
+        while after < len(buf) and buf[after] in " \t\r\n":
+            after += 1
+        if after == len(buf):
+            return True if final else None
+        return buf[after] in _VALUE_TERMINATORS
+
+    def _run(self, final: bool) -> None:
+        buf = self._buf
+        out = self._out
+        while self._pos < len(buf) and self._state != "done":
+            ch = buf[self._pos]
+            state = self._state
+
+            if state == "seek":
+                start = buf.find("{", self._pos)
+                if start < 0:
+                    self._pos = len(buf)
+                    break
+                self._pos = start
+                self._stack.append("}")
+                self._emit_sig("{")
+                self._state = "object"
+                self._pos += 1
+
+            elif state == "object":
+                run = _SPACE_RUN.match(buf, self._pos) or _SCALAR_RUN.match(buf, self._pos)
+                if run:
+                    if ch in " \t\r\n":
+                        out.append(run.group())
+                    else:
+                        self._emit_sig(run.group())
+                    self._pos = run.end()
+                    continue
+                if ch == '"' or ch in _SMART_DOUBLE_QUOTES:
+                    self._smart_string = ch != '"'
+                    self._emit_sig('"')
+                    self._state = "string"
+                elif ch in "{[":
+                    self._stack.append("}" if ch == "{" else "]")
+                    self._emit_sig(ch)
+                elif ch in "}]":
+                    self._drop_trailing_comma()
+                    self._emit_sig(self._stack.pop())
+                    if not self._stack:
+                        self._state = "done"
+                elif ch == ",":
+                    self._emit_sig(ch)
+                else:
+                    out.append(" ")
+                self._pos += 1
+
+            elif state == "string":
+                run = _STRING_RUN.match(buf, self._pos)
+                if run:
+                    text = run.group()
+                    end = run.end()
+                    if "\\" in text:
+                        if end == len(buf) and not final:
+                            # Escape cuối buffer có thể chưa đủ (vd "\\fr"): để lượt sau
+                            cut = text.rfind("\\")
+                            while cut > 0 and text[cut - 1] == "\\":
+                                cut -= 1
+                            if cut == 0:
+                                break
+                            text, end = text[:cut], self._pos + cut
+                        text = _ESCAPE_IN_RUN.sub(_raw_escape if self.raw_backslashes else _repair_escape, text)
+                    out.append(text)
+                    self._pos = end
+                    continue
+                if ch == "\\":
+                    if self.raw_backslashes:
+                        if self._pos + 1 >= len(buf) and not final:
+                            break
+                        if buf[self._pos + 1:self._pos + 2] == '"':
+                            out.append('\\"')
+                            self._pos += 2
+                        else:
+                            out.append("\\\\")
+                            self._pos += 1
+                        continue
+                    kind, length = escape_kind(buf, self._pos, final)
+                    if kind == "more":
+                        break
+                    out.append("\\\\" if kind == "literal" else buf[self._pos:self._pos + length])
+                    self._pos += length
+                    continue
+                closes = ch == '"' if not self._smart_string else ch in _SMART_DOUBLE_QUOTES + '"'
+                if closes:
+                    ends = self._string_ends_here(self._pos + 1, final)
+                    if ends is None:
+                        break
+                    if ends:
+                        self._emit_sig('"')
+                        self._state = "object"
+                    else:
+                        # Nháy kép bên trong nội dung mà model quên escape
+                        out.append('\\"')
+                elif ch == "\n":
+                    out.append("\\n")
+                elif ch == "\t":
+                    out.append("\\t")
+                elif ch == "\r":
+                    pass
+                elif ch < " " or ch == "\x7f":
+                    out.append(" ")
+                else:
+                    out.append(ch)
+                self._pos += 1
+
+
+def extract_json(raw_text: str, raw_backslashes: bool = False) -> str:
+    """Trả JSON đã sửa của object ngoài cùng trong ``raw_text`` ("" nếu không có)."""
+    if not raw_text:
+        return ""
+    scanner = JsonRepairScanner(raw_backslashes=raw_backslashes)
+    scanner.feed(raw_text)
+    scanner.finish()
+    return scanner.text() if scanner.found else ""
+
+
+def _has_latex_misread(text: str) -> bool:
+    """Có lệnh LaTeX đứng sau một số lẻ dấu ``\`` (tức JSON sẽ đọc nhầm thành escape)?"""
+    for match in _LATEX_MISREAD.finditer(text):
+        run = len(match.group()) - len(match.group().lstrip("\\"))
+        if run % 2:
+            return True
+    return False
+
+
+def parse_model_json(raw_text: str, raw_backslashes: bool = False) -> Any:
+    """Parse object JSON trong output của model; raise ``ValueError`` nếu không được.
+
+    Đường nhanh: cắt từ ``{`` đầu tới ``}`` cuối và ``json.loads`` thẳng (C) khi
+    chắc chắn không có LaTeX bị đọc nhầm thành escape; còn lại mới chạy scanner.
+    """
+    start = raw_text.find("{") if raw_text else -1
+    if start < 0:
+        raise ValueError("Không tìm thấy JSON trong output AI")
+    candidate = raw_text[start:raw_text.rfind("}") + 1]
+    if candidate:
+        if raw_backslashes and '\\"' not in candidate:
+            fast = candidate.replace("\\", "\\\\")
+        elif not raw_backslashes and not _has_latex_misread(candidate):
+            fast = candidate
+        else:
+            fast = None
+        if fast is not None:
+            try:
+                value = json.loads(fast, strict=False)
+                if isinstance(value, dict):
+                    return value
+            except ValueError:
+                pass
+    repaired = extract_json(raw_text, raw_backslashes=raw_backslashes)
+    if not repaired:
+        raise ValueError("Không tìm thấy JSON trong output AI")
+    return json.loads(repaired)
+
+
+def loads_tolerant(raw: str) -> Any:
+    """``json.loads``; nếu lỗi thì sửa bằng ``JsonRepairScanner`` rồi thử lại. Trả None nếu vẫn hỏng."""
+    try:
+        return json.loads(raw)
+    except (json.JSONDecodeError, ValueError):
+        pass
+    text = raw.strip()
+    if text.startswith("["):
+        # Scanner chỉ tìm object: bọc mảng vào một object tạm
+        repaired = extract_json('{"_": ' + text + "}")
+        key = "_"
+    else:
+        repaired = extract_json(text)
+        key = None
+    if not repaired:
+        return None
+    try:
+        value = json.loads(repaired)
+    except (json.JSONDecodeError, ValueError):
+        return None
+    return value.get(key) if key else value
@@ -0,0 +1,200 @@
+"""Incremental parser for the chat JSON object streamed by Gemini.
+
+The chat model answers with ``{"reply": ..., "mindmap_insights": ..., "geogebra": ...}``.
+When the response is streamed we do not want to wait for the closing brace:
+``reply`` text is emitted as soon as it is decoded, and every other top-level
+field is emitted as one block once its value closes.
+"""
+from typing import Any, Dict, List, Optional, Tuple
+
+from src.utils.json_extract import decode_escape, loads_tolerant
+
+StreamEvent = Tuple[str, Any]
+
+STREAMED_TEXT_KEY = "reply"
+
+class ChatStreamParser:
+    """Feed raw text chunks, get back ``(field, value)`` events.
+
+    - ``("reply", "<delta>")`` for every newly decoded piece of the reply string.
+    - ``(key, value)`` for any other top-level key once its JSON value is complete.
+    """
+
+    def __init__(self) -> None:
+        self._buf = ""
+        self._pos = 0
+        self._state = "seek_object"
+        self._key_chars: List[str] = []
+        self._key: Optional[str] = None
+        self._value_start = 0
+        self._value_depth = 0
+        self._value_in_string = False
+        self._value_escaped = False
+        self._final = False
+        self.reply_parts: List[str] = []
+        self.blocks: Dict[str, Any] = {}
+
+    @property
+    def raw_text(self) -> str:
+        return self._buf
+
+    @property
+    def reply_text(self) -> str:
+        return "".join(self.reply_parts)
+
+    @property
+    def complete(self) -> bool:
+        """True once the top-level JSON object has been closed."""
+        return self._state == "done"
+
+    def feed(self, chunk: str) -> List[StreamEvent]:
+        """Consume one chunk of model output and return the events it completes."""
+        if not chunk:
+            return []
+        self._buf += chunk
+        return self._run()
+
+    def close(self) -> List[StreamEvent]:
+        """Flush at end of stream.
+
+        If the model never produced a usable ``reply`` string (plain text or
+        broken JSON), fall back to the ``message`` block or the raw text.
+        """
+        self._final = True
+        events: List[StreamEvent] = self._run()
+        if not self.reply_parts:
+            fallback = self.blocks.get("message")
+            if not isinstance(fallback, str) or not fallback:
+                fallback = self._buf.strip() if self._state == "seek_object" else ""
+            if fallback:
+                self.reply_parts.append(fallback)
+                events.append((STREAMED_TEXT_KEY, fallback))
+        return events
+
+    # ----- state machine -----
+
+    def _run(self) -> List[StreamEvent]:
+        events: List[StreamEvent] = []
+        reply_delta: List[str] = []
+        buf = self._buf
+
+        while self._pos < len(buf) and self._state != "done":
+            state = self._state
+            ch = buf[self._pos]
+
+            if state == "seek_object":
+                if ch == "{":
+                    self._state = "expect_key"
+                self._pos += 1
+
+            elif state == "expect_key":
+                if ch == '"':
+                    self._key_chars = []
+                    self._state = "in_key"
+                elif ch == "}":
+                    self._state = "done"
+                self._pos += 1
+
+            elif state == "in_key":
+                if ch == "\\":
+                    if self._pos + 1 >= len(buf):
+                        break
+                    self._key_chars.append(buf[self._pos + 1])
+                    self._pos += 2
+                    continue
+                if ch == '"':
+                    self._key = "".join(self._key_chars)
+                    self._state = "expect_colon"
+                else:
+                    self._key_chars.append(ch)
+                self._pos += 1
+
+            elif state == "expect_colon":
+                if ch == ":":
+                    self._state = "expect_value"
+                self._pos += 1
+
+            elif state == "expect_value":
+                if ch.isspace():
+                    self._pos += 1
+                elif ch == '"' and self._key == STREAMED_TEXT_KEY:
+                    self._state = "in_reply"
+                    self._pos += 1
+                else:
+                    self._value_start = self._pos
+                    self._value_depth = 0
+                    self._value_in_string = False
+                    self._value_escaped = False
+                    self._state = "in_value"
+
+            elif state == "in_reply":
+                if ch == "\\":
+                    decoded, consumed = decode_escape(buf, self._pos, self._final)
+                    if consumed == 0:
+                        break
+                    reply_delta.append(decoded)
+                    self._pos += consumed
+                    continue
+                if ch == '"':
+                    self._state = "after_value"
+                else:
+                    reply_delta.append(ch)
+                self._pos += 1
+
+            elif state == "in_value":
+                done = self._scan_value(ch)
+                if done:
+                    raw = buf[self._value_start:self._pos].strip()
+                    value = _loads_block(raw)
+                    self.blocks[self._key or ""] = value
+                    events.append((self._key or "", value))
+                    self._state = "after_value"
+                    continue
+                self._pos += 1
+
+            elif state == "after_value":
+                if ch == ",":
+                    self._state = "expect_key"
+                elif ch == "}":
+                    self._state = "done"
+                self._pos += 1
+
+        if reply_delta:
+            delta = "".join(reply_delta)
+            self.reply_parts.append(delta)
+            events.insert(0, (STREAMED_TEXT_KEY, delta))
+        return events
+
+    def _scan_value(self, ch: str) -> bool:
+        """Advance over a non-reply value; True when ``self._pos`` is just past it."""
+        if self._value_in_string:
+            if self._value_escaped:
+                self._value_escaped = False
+            elif ch == "\\":
+                self._value_escaped = True
+            elif ch == '"':
+                self._value_in_string = False
+                if self._value_depth == 0:
+                    self._pos += 1
+                    return True
+            return False
+
+        if ch == '"':
+            self._value_in_string = True
+        elif ch in "{[":
+            self._value_depth += 1
+        elif ch in "}]":
+            if self._value_depth == 0:
+                # Closing brace of the outer object ends a scalar value.
+                return True
+            self._value_depth -= 1
+            if self._value_depth == 0:
+                self._pos += 1
+                return True
+        elif ch == "," and self._value_depth == 0:
+            return True
+        return False
+
+
+def _loads_block(raw: str) -> Any:
+    return loads_tolerant(raw)
@@ -0,0 +1,267 @@
+# src/utils/pdf_extract.py
+"""Multi-core PDF text extraction.
+
+PyPDF2 is pure Python: ``page.extract_text()`` holds the GIL, so a long exam
+compilation used to be parsed on one core, page after page. Here page ranges
+(``PDF_PAGES_PER_TASK``) are handed to a shared ``ProcessPoolExecutor``:
+
+- ``iter_pdf_pages`` yields page texts in order, like the sequential version,
+  with at most ``2 * workers`` ranges in flight (bounded memory);
+- each worker keeps the last opened ``PdfReader`` so consecutive ranges of
+  the same file do not re-parse the xref table;
+- a page that raises or runs longer than ``PDF_PAGE_TIMEOUT_SECONDS`` (timer
+  signal inside the worker) becomes an empty page instead of failing or
+  stalling the document; a worker that stops responding altogether is killed
+  and the pool recreated. The pool is shared, so every generator re-sends its
+  unfinished ranges to the new pool (also after a worker crash), at most
+  ``_RANGE_RETRIES`` times per range;
+- small files (< ``PDF_PARALLEL_MIN_PAGES``) or ``PDF_EXTRACT_WORKERS=1`` stay
+  sequential in the calling thread.
+
+Benchmark on a local folder of PDFs::
+
+    python -m src.utils.pdf_extract /path/to/pdfs
+"""
+import multiprocessing
+import os
+import signal
+import sys
+import time
+from collections import deque
+from concurrent.futures import CancelledError, Future, ProcessPoolExecutor, TimeoutError as FutureTimeout
+from concurrent.futures.process import BrokenProcessPool
+from pathlib import Path
+from typing import Any, Deque, Iterator, List, Optional, Tuple
+
+import PyPDF2
+
+PDF_EXTRACT_WORKERS = int(os.getenv("PDF_EXTRACT_WORKERS", str(os.cpu_count() or 1)))
+PDF_PAGES_PER_TASK = int(os.getenv("PDF_PAGES_PER_TASK", "8"))
+PDF_PAGE_TIMEOUT_SECONDS = float(os.getenv("PDF_PAGE_TIMEOUT_SECONDS", "20"))
+PDF_PARALLEL_MIN_PAGES = int(os.getenv("PDF_PARALLEL_MIN_PAGES", "16"))
+
+# Thời gian chờ thêm cho một range ngoài timeout từng trang (khởi động worker, mở file)
+_TASK_GRACE_SECONDS = 30
+# Số lần gửi lại một range khi pool bị dựng lại / worker chết
+_RANGE_RETRIES = 2
+_HAS_TIMER = hasattr(signal, "setitimer")
+
+_pool: Optional[ProcessPoolExecutor] = None
+_stats = {
+    "documents": 0,
+    "parallel_documents": 0,
+    "pages": 0,
+    "failed_pages": 0,
+    "timed_out_pages": 0,
+    "pool_restarts": 0,
+    "resubmitted_ranges": 0,
+}
+
+
+class _PageTimeout(Exception):
+    pass
+
+
+def _page_text(page: Any) -> str:
+    return (page.extract_text() or "") + "\n"
+
+
+def count_pdf_pages(pdf_path: str) -> int:
+    with open(pdf_path, "rb") as file:
+        return len(PyPDF2.PdfReader(file).pages)
+
+
+def iter_pdf_pages_sequential(pdf_path: str) -> Iterator[str]:
+    """Yield text page by page in this thread (PyPDF2 parses pages lazily)."""
+    with open(pdf_path, "rb") as file:
+        pdf_reader = PyPDF2.PdfReader(file)
+        for page in pdf_reader.pages:
+            yield _page_text(page)
+
+
+# ----- worker process -----
+
+_worker_reader: Optional[Tuple[Tuple[str, float], Any, PyPDF2.PdfReader]] = None
+
+
+def _on_alarm(signum, frame):
+    raise _PageTimeout()
+
+
+def _reader_for(pdf_path: str) -> PyPDF2.PdfReader:
+    global _worker_reader
+    key = (pdf_path, os.path.getmtime(pdf_path))
+    if _worker_reader is None or _worker_reader[0] != key:
+        if _worker_reader is not None:
+            _worker_reader[1].close()
+        file = open(pdf_path, "rb")
+        _worker_reader = (key, file, PyPDF2.PdfReader(file))
+    return _worker_reader[2]
+
+
+def _extract_range(pdf_path: str, start: int, stop: int, page_timeout: float) -> List[Tuple[str, str]]:
+    """(status, text) cho các trang [start, stop); status: ok / error / timeout."""
+    reader = _reader_for(pdf_path)
+    results: List[Tuple[str, str]] = []
+    if _HAS_TIMER:
+        signal.signal(signal.SIGALRM, _on_alarm)
+    for index in range(start, stop):
+        try:
+            if _HAS_TIMER:
+                signal.setitimer(signal.ITIMER_REAL, page_timeout)
+            results.append(("ok", _page_text(reader.pages[index])))
+        except _PageTimeout:
+            results.append(("timeout", "\n"))
+        except Exception as exc:
+            results.append(("error", f"{type(exc).__name__}: {exc}"))
+        finally:
+            if _HAS_TIMER:
+                signal.setitimer(signal.ITIMER_REAL, 0)
+    return results
+
+
+# ----- pool -----
+
+def _get_pool() -> ProcessPoolExecutor:
+    global _pool
+    if _pool is not None and getattr(_pool, "_broken", False):
+        # Một worker chết đột ngột (OOM, segfault): pool không nhận task nữa
+        _stats["pool_restarts"] += 1
+        _pool.shutdown(wait=False, cancel_futures=True)
+        _pool = None
+    if _pool is None:
+        # spawn: không fork một process đang chạy event loop + thread pool
+        _pool = ProcessPoolExecutor(max_workers=PDF_EXTRACT_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+    return _pool
+
+
+def _restart_pool(pool: ProcessPoolExecutor) -> None:
+    """Bỏ pool có worker bị treo (không phản hồi cả timer signal), nếu chưa ai dựng lại."""
+    global _pool
+    if pool is not _pool:
+        return
+    _pool = None
+    _stats["pool_restarts"] += 1
+    processes = list((getattr(pool, "_processes", None) or {}).values())
+    pool.shutdown(wait=False, cancel_futures=True)
+    for process in processes:
+        process.kill()
+
+
+def shutdown_pool() -> None:
+    global _pool
+    if _pool is not None:
+        _pool.shutdown(wait=False, cancel_futures=True)
+        _pool = None
+
+
+def _collect(pdf_path: str, start: int, results: List[Tuple[str, str]], page_timeout: float) -> Iterator[str]:
+    for offset, (status, text) in enumerate(results):
+        _stats["pages"] += 1
+        if status == "ok":
+            yield text
+            continue
+        if status == "timeout":
+            _stats["timed_out_pages"] += 1
+            print(f"⚠️ PDF {Path(pdf_path).name}: trang {start + offset + 1} quá {page_timeout}s, bỏ qua")
+        else:
+            _stats["failed_pages"] += 1
+            print(f"⚠️ PDF {Path(pdf_path).name}: trang {start + offset + 1} lỗi ({text}), bỏ qua")
+        yield "\n"
+
+
+def iter_pdf_pages(
+    pdf_path: str,
+    workers: int = PDF_EXTRACT_WORKERS,
+    pages_per_task: int = PDF_PAGES_PER_TASK,
+    page_timeout: float = PDF_PAGE_TIMEOUT_SECONDS,
+) -> Iterator[str]:
+    """Yield page texts in order, extracting page ranges in parallel worker processes."""
+    _stats["documents"] += 1
+    total = count_pdf_pages(pdf_path)
+    if workers <= 1 or total < PDF_PARALLEL_MIN_PAGES:
+        for text in iter_pdf_pages_sequential(pdf_path):
+            _stats["pages"] += 1
+            yield text
+        return
+
+    _stats["parallel_documents"] += 1
+    pdf_path = os.path.abspath(pdf_path)
+    ranges = iter([(start, min(start + pages_per_task, total)) for start in range(0, total, pages_per_task)])
+    # (start, stop, pool đã nhận task, future, số lần đã gửi lại)
+    pending: Deque[Tuple[int, int, ProcessPoolExecutor, Future, int]] = deque()
+
+    def submit(start: int, stop: int, retries: int = 0) -> Tuple[int, int, ProcessPoolExecutor, Future, int]:
+        pool = _get_pool()
+        return start, stop, pool, pool.submit(_extract_range, pdf_path, start, stop, page_timeout), retries
+
+    def submit_next() -> None:
+        for start, stop in ranges:
+            pending.append(submit(start, stop))
+            return
+
+    def resubmit_orphans() -> None:
+        """Gửi lại vào pool hiện tại các range còn chờ của pool đã bị bỏ (kể cả do generator khác)."""
+        current = _get_pool()
+        for i, (start, stop, pool, future, retries) in enumerate(pending):
+            finished = future.done() and not future.cancelled() and future.exception() is None
+            if pool is not current and not finished:
+                _stats["resubmitted_ranges"] += 1
+                pending[i] = submit(start, stop, retries)
+
+    try:
+        for _ in range(workers * 2):
+            submit_next()
+        while pending:
+            start, stop, pool, future, retries = pending.popleft()
+            results: Optional[List[Tuple[str, str]]] = None
+            try:
+                results = future.result(timeout=(stop - start) * page_timeout + _TASK_GRACE_SECONDS)
+            except FutureTimeout:
+                if pool is _pool:
+                    # Worker treo hẳn: bỏ range này, dựng lại pool (các range đang chờ được gửi lại bên dưới)
+                    results = [("timeout", "\n")] * (stop - start)
+                    _restart_pool(pool)
+            except (CancelledError, BrokenProcessPool):
+                pass  # pool đã bị dựng lại hoặc worker chết giữa chừng
+            if results is None:
+                if retries < _RANGE_RETRIES:
+                    _stats["resubmitted_ranges"] += 1
+                    pending.appendleft(submit(start, stop, retries + 1))
+                    resubmit_orphans()
+                    continue
+                results = [("error", "worker process lost")] * (stop - start)
+            resubmit_orphans()
+            submit_next()
+            yield from _collect(pdf_path, start, results, page_timeout)
+    finally:
+        for _, _, _, future, _ in pending:
+            future.cancel()
+
+
+def stats() -> dict:
+    return {"workers": PDF_EXTRACT_WORKERS, "pool_started": _pool is not None, **_stats}
+
+
+def _benchmark(folder: str) -> None:
+    files = sorted(Path(folder).glob("*.pdf"))
+    if not files:
+        print(f"No PDF files in {folder}")
+        return
+    print(f"{len(files)} PDF files, {PDF_EXTRACT_WORKERS} workers, {PDF_PAGES_PER_TASK} pages/task")
+    list(iter_pdf_pages(str(files[0])))  # khởi động pool, không tính vào thời gian
+
+    for label, run in (("sequential", iter_pdf_pages_sequential), ("parallel", iter_pdf_pages)):
+        pages = chars = 0
+        started = time.perf_counter()
+        for path in files:
+            for text in run(str(path)):
+                pages += 1
+                chars += len(text)
+        elapsed = time.perf_counter() - started
+        print(f"{label:>10}: {pages} pages, {chars} chars in {elapsed:.2f}s ({pages / elapsed:.1f} pages/s)")
+    shutdown_pool()
+
+
+if __name__ == "__main__":
+    _benchmark(sys.argv[1] if len(sys.argv) > 1 else ".")
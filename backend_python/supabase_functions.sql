@@ -39,6 +39,7 @@ create table public.document_chunks (
   chunk_index integer not null,
   content text not null,
   content_length integer null,
+  content_hash text null,
   source_path text not null,
   embedding_status text null default 'pending'::text,
   visibility text null default 'private'::text,
@@ -367,6 +368,7 @@ create table public.test_material_chunks (
   chunk_index integer not null,
   content text not null,
   content_length integer null,
+  content_hash text null,
   source_path text not null,
   embedding_status text null default 'pending'::text,
   visibility text null default 'private'::text,
@@ -582,4 +584,116 @@ from
 group by
   u.id,
   sp.full_name;
-  
\ No newline at end of file
+  
+-- Ingestion (job ingestion_jobs) đánh dấu tài liệu xong bằng 'ready' (frontend hiển thị "Sẵn sàng")
+alter table public.user_documents drop constraint if exists user_documents_rag_status_check;
+alter table public.user_documents add constraint user_documents_rag_status_check check (
+  rag_status = any (array['uploaded'::text, 'processing'::text, 'ready'::text, 'completed'::text, 'failed'::text])
+);
+alter table public.test_materials drop constraint if exists test_materials_rag_status_check;
+alter table public.test_materials add constraint test_materials_rag_status_check check (
+  rag_status = any (array['uploaded'::text, 'processing'::text, 'ready'::text, 'completed'::text, 'failed'::text])
+);
+
+create table public.ingestion_jobs (
+  id uuid not null default gen_random_uuid (),
+  user_id uuid not null,
+  document_id uuid not null,
+  purpose text not null default 'chat'::text,
+  status text not null default 'queued'::text,
+  attempts integer not null default 0,
+  max_attempts integer not null default 3,
+  chunks_done integer not null default 0,
+  chunks_total integer null,
+  progress double precision not null default 0,
+  last_error text null,
+  locked_by text null,
+  locked_at timestamp with time zone null,
+  run_after timestamp with time zone not null default now(),
+  created_at timestamp with time zone not null default now(),
+  updated_at timestamp with time zone not null default now(),
+  constraint ingestion_jobs_pkey primary key (id),
+  constraint ingestion_jobs_user_id_fkey foreign KEY (user_id) references auth.users (id) on delete CASCADE,
+  constraint ingestion_jobs_status_check check (
+    (
+      status = any (
+        array[
+          'queued'::text,
+          'running'::text,
+          'completed'::text,
+          'failed'::text
+        ]
+      )
+    )
+  )
+) TABLESPACE pg_default;
+
+create index IF not exists idx_ingestion_jobs_claim on public.ingestion_jobs using btree (status, run_after) TABLESPACE pg_default;
+
+create index IF not exists idx_ingestion_jobs_document on public.ingestion_jobs using btree (document_id, status) TABLESPACE pg_default;
+
+create trigger update_ingestion_jobs_updated_at BEFORE
+update on ingestion_jobs for EACH row
+execute FUNCTION update_updated_at_column ();
+
+-- Worker lấy một job: job đang chờ đã tới hạn, hoặc job 'running' mà worker giữ nó
+-- không heartbeat quá p_stale_seconds (worker chết) -> chạy tiếp từ chunk đã lưu.
+-- Job 'running' quá hạn mà đã dùng hết max_attempts thì chuyển failed (job + tài liệu), không lấy lại.
+create or replace function public.claim_ingestion_job (p_worker text, p_stale_seconds integer default 300)
+returns setof public.ingestion_jobs
+language plpgsql
+as $$
+begin
+  with exhausted as (
+    update public.ingestion_jobs c
+    set
+      status = 'failed',
+      locked_by = null,
+      last_error = coalesce(c.last_error, 'worker stopped heartbeating on the last attempt')
+    where
+      c.status = 'running'
+      and c.locked_at < now() - make_interval(secs => p_stale_seconds)
+      and c.attempts >= c.max_attempts
+    returning c.document_id, c.purpose
+  ),
+  failed_documents as (
+    update public.user_documents d
+    set rag_status = 'failed'
+    from exhausted e
+    where e.purpose = 'chat' and d.id = e.document_id
+    returning d.id
+  )
+  update public.test_materials m
+  set rag_status = 'failed'
+  from exhausted e
+  where e.purpose <> 'chat' and m.id = e.document_id;
+
+  return query
+  update public.ingestion_jobs j
+  set
+    status = 'running',
+    attempts = j.attempts + 1,
+    locked_by = p_worker,
+    locked_at = now()
+  where j.id = (
+    select c.id
+    from public.ingestion_jobs c
+    where
+      (c.status = 'queued' and c.run_after <= now())
+      or (
+        c.status = 'running'
+        and c.locked_at < now() - make_interval(secs => p_stale_seconds)
+        and c.attempts < c.max_attempts
+      )
+    order by c.run_after
+    limit 1
+    for update skip locked
+  )
+  returning j.*;
+end;
+$$;
+
+
+-- Fingerprint nội dung chunk (sha256) để tải lại tài liệu chỉ embed các chunk đã đổi
+alter table public.document_chunks add column if not exists content_hash text null;
+alter table public.test_material_chunks add column if not exists content_hash text null;
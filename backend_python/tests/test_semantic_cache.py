@@ -0,0 +1,37 @@
+import pytest
+
+np = pytest.importorskip("numpy")
+pytest.importorskip("fastapi")
+
+from src.services.semantic_cache import SemanticAnswerCache, math_signature
+
+
+def _vector(seed: int = 0) -> "np.ndarray":
+    vector = np.ones(8, dtype=np.float32)
+    vector[0] += seed * 0.01
+    return vector / np.linalg.norm(vector)
+
+
+def test_math_signature_ignores_spacing_but_keeps_numbers():
+    assert math_signature("Giải x^2 - 5x + 6 = 0.") == math_signature("giải x^2-5x+6=0")
+    assert math_signature("Giải $x^2 - 5x + 6 = 0$") == math_signature("giải  $x^2-5x+6=0$ ?")
+    assert math_signature("giải x^2-5x+6=0") != math_signature("giải x^2-5x+7=0")
+    assert math_signature("Đạo hàm là gì?") == ()
+
+
+def test_numerically_different_question_misses_cache():
+    cache = SemanticAnswerCache(threshold=0.95)
+    # Hai câu hỏi gần như cùng embedding, chỉ khác hệ số
+    cache.store("phương trình bậc hai", "Giải $x^2-5x+6=0$", _vector(0), {"reply": "x = 2, x = 3"})
+
+    assert cache.lookup("phương trình bậc hai", "Giải $x^2-5x+7=0$", _vector(1)) is None
+    assert cache.lookup("phương trình bậc hai", "giải $x^2 - 5x + 6 = 0$", _vector(1)) == {"reply": "x = 2, x = 3"}
+
+
+def test_best_match_with_same_numbers_wins():
+    cache = SemanticAnswerCache(threshold=0.95)
+    cache.store("tích phân", "Tính tích phân từ 0 đến 1 của x", _vector(0), {"reply": "1/2"})
+    cache.store("tích phân", "Tính tích phân từ 0 đến 2 của x", _vector(3), {"reply": "2"})
+
+    assert cache.lookup("tích phân", "tính tích phân từ 0 đến 2 của x", _vector(0)) == {"reply": "2"}
+    assert cache.lookup("tích phân", "tính tích phân từ 0 đến 3 của x", _vector(0)) is None